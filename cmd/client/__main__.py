@@ -65,19 +65,28 @@ if not service_addr["host"]:
 # the main thread waits until it's set, then runs its UI loop.
 tui_liner = SyncVar()
 
+# the chatter consumer, lasting across reconnections to chat service
+chatter = None
+
 
 def create_he():  # Create a hosting env reacting to chat service
     he = HostingEnv()
 
     async def __hbi_init__(po: PostingEnd, ho: HostingEnd):
         # sync variables to be set, they are read by main thread
-        global tui_liner
+        global tui_liner, chatter
+
+        if chatter is not None:
+            # reconnected, continue the session with the same chatter
+            he.expose_reactor(chatter)
+            chatter.reconnected(po, ho)
+            return
 
         # TUI loop of this line getter is to be run by main thread
         line_getter = GetLine(f">{po.remote_addr!s}> ")
 
         # create a chatter consumer instance and expose as reactor
-        chatter = Chatter(line_getter, po, ho)
+        chatter = Chatter(line_getter, po, ho, service_addr)
         he.expose_reactor(chatter)
 
         # assign the sync variable to tell main thread to start TUI loop
@@ -123,7 +132,25 @@ async def do_chatting():
             create_he(),
         )
 
-        await ho.wait_disconnected()
+        while True:
+            await ho.wait_disconnected()
+            if chatter is None or chatter.ended:
+                break
+
+            # reconnect with backoff, until chatting ended by the user
+            backoff = 1.0
+            while not chatter.ended:
+                await asyncio.sleep(backoff)
+                if chatter.ended:
+                    break
+                try:
+                    po, ho = await dial_tcp(service_addr, create_he())
+                    break
+                except OSError as exc:
+                    logger.warning(f"Failed reconnecting chat service: {exc!s}")
+                    backoff = min(2 * backoff, 30.0)
+            if chatter.ended:
+                break
 
         logger.debug("Done chatting.")
 
@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import time
+
+from ...pkg._service import *
+from ...pkg.ds import *
+
+# take arguments from command line
+cmdl_parser = argparse.ArgumentParser(
+    prog="python -m hbichat.cmd.coalescebench",
+    description="HBI chatting msg coalescing benchmark",
+    epilog="measure notifications sent and CPU per delivered msg, for a burst of msgs "
+    "broadcast to a room, one notification per msg vs coalesced per window",
+)
+cmdl_parser.add_argument(
+    "--msgs", metavar="n_msgs", type=int, default=1000, help="number of msgs posted"
+)
+cmdl_parser.add_argument(
+    "--recipients",
+    metavar="n_chatters",
+    type=int,
+    default=100,
+    help="number of chatters in the room",
+)
+cmdl_parser.add_argument(
+    "--interval-us",
+    metavar="us",
+    type=int,
+    default=100,
+    help="interval between msgs posted",
+)
+cmdl_parser.add_argument(
+    "--coalesce-ms",
+    metavar="ms",
+    type=float,
+    default=5,
+    help="coalescing window to compare against no coalescing",
+)
+cmdl_parser.add_argument(
+    "--coalesce-msgs",
+    metavar="n_msgs",
+    type=int,
+    default=50,
+    help="max msgs per batch to compare against no coalescing",
+)
+prog_args = cmdl_parser.parse_args()
+
+
+class StubPostingEnd:
+    # a posting end writing nowhere, counting what would go onto the wire
+    remote_addr = "stub"
+
+    def __init__(self):
+        self.n_notifs = 0
+        self.n_bytes = 0
+
+    def is_connected(self):
+        return True
+
+    async def notif(self, code):
+        self.n_notifs += 1
+        if isinstance(code, str):
+            code = code.encode("utf-8")
+        self.n_bytes += len(code)
+
+    async def notif_data(self, code, bufs):
+        self.n_notifs += 1
+        self.n_bytes += len(code.encode("utf-8"))
+        if isinstance(bufs, (bytes, bytearray, memoryview)):
+            bufs = [bufs]
+        self.n_bytes += sum(len(buf) for buf in bufs)
+
+    async def disconnect(self, err_reason=None):
+        pass
+
+
+async def bench(window: float, max_msgs: int, binary: bool):
+    service_config.coalesce_window = window
+    service_config.coalesce_msgs = max_msgs
+    pos = [StubPostingEnd() for _ in range(prog_args.recipients)]
+    outboxes = [Outbox(po) for po in pos]
+    for outbox in outboxes:
+        outbox.binary = binary
+
+    t0 = time.process_time()
+    for i in range(prog_args.msgs):
+        # encoded once, shared by all recipients, as `Room.accept_msg()` does
+        msg = Msg("Chatter$1", f"msg #{i}", time.time())
+        msg_repr = repr(msg)
+        msg_bin = memoryview(msg.to_bin())
+        for outbox in outboxes:
+            outbox.notif_room_msg("Lobby", msg_repr, msg_bin)
+        await asyncio.sleep(prog_args.interval_us / 1e6)
+    while any(outbox.pending for outbox in outboxes):
+        await asyncio.sleep(0.001)
+    cpu_secs = time.process_time() - t0
+
+    for outbox in outboxes:
+        outbox.close()
+    n_notifs = sum(po.n_notifs for po in pos)
+    n_bytes = sum(po.n_bytes for po in pos)
+    n_delivered = prog_args.msgs * prog_args.recipients
+    return n_notifs, n_bytes, 1e6 * cpu_secs / n_delivered
+
+
+async def main():
+    print(
+        f"{prog_args.msgs} msgs to {prog_args.recipients} recipients, "
+        f"{prog_args.interval_us} us apart"
+    )
+    for binary in (False, True):
+        for window, max_msgs in (
+            (0, 1),
+            (prog_args.coalesce_ms / 1000, prog_args.coalesce_msgs),
+        ):
+            n_notifs, n_bytes, cpu_us = await bench(window, max_msgs, binary)
+            print(
+                f"{'bin' if binary else 'repr'} window {1000 * window:g}ms / "
+                f"{max_msgs} msgs: {n_notifs} notifs, {n_bytes / 1e6:.2f} MB, "
+                f"{cpu_us:.2f} CPU us per delivered msg"
+            )
+
+
+asyncio.run(main())
@@ -0,0 +1,98 @@
+import argparse
+import random
+import time
+
+from ...pkg.ds import *
+
+# take arguments from command line
+cmdl_parser = argparse.ArgumentParser(
+    prog="python -m hbichat.cmd.codecbench",
+    description="HBI chatting codec benchmark",
+    epilog="compare costs of encoding & landing msg batches, repr vs binary",
+)
+cmdl_parser.add_argument(
+    "--batch",
+    metavar="n_msgs",
+    type=int,
+    default=50,
+    help="number of msgs per batch",
+)
+cmdl_parser.add_argument(
+    "--content",
+    metavar="n_chars",
+    type=int,
+    default=40,
+    help="average length of msg content",
+)
+cmdl_parser.add_argument(
+    "--rounds", metavar="n_rounds", type=int, default=200, help="number of batches"
+)
+prog_args = cmdl_parser.parse_args()
+
+rnd = random.Random(0)
+now = time.time()
+batches = [
+    MsgsInRoom(
+        "Lobby",
+        [
+            Msg(
+                f"Chatter${rnd.randrange(100)}",
+                "x" * rnd.randrange(1, 2 * prog_args.content),
+                now + i,
+            )
+            for i in range(prog_args.batch)
+        ],
+    )
+    for _ in range(prog_args.rounds)
+]
+
+# the artifacts a consumer exposes for room msgs to be landed
+land_env = {"MsgsInRoom": MsgsInRoom, "Msg": Msg}
+
+
+def bench_repr():
+    n_bytes = 0
+    encode_secs = land_secs = 0.0
+    for batch in batches:
+        t0 = time.perf_counter()
+        payload = f"RoomMsgs({batch!r})".encode("utf-8")
+        t1 = time.perf_counter()
+        landed = eval(payload.decode("utf-8")[9:-1], land_env)
+        t2 = time.perf_counter()
+        assert len(landed.msgs) == len(batch.msgs)
+        n_bytes += len(payload)
+        encode_secs += t1 - t0
+        land_secs += t2 - t1
+    return n_bytes, encode_secs, land_secs
+
+
+def bench_bin():
+    n_bytes = 0
+    encode_secs = land_secs = 0.0
+    for batch in batches:
+        t0 = time.perf_counter()
+        payload = batch.to_bin()
+        code = f"RoomMsgsBin({len(payload)!r})".encode("utf-8")
+        t1 = time.perf_counter()
+        eval(code.decode("utf-8"), {"RoomMsgsBin": lambda n_bytes: None})
+        landed = MsgsInRoom.from_bin(payload)
+        t2 = time.perf_counter()
+        assert len(landed.msgs) == len(batch.msgs)
+        n_bytes += len(code) + len(payload)
+        encode_secs += t1 - t0
+        land_secs += t2 - t1
+    return n_bytes, encode_secs, land_secs
+
+
+n_k_msgs = prog_args.batch * prog_args.rounds / 1000
+print(
+    f"Encoding & landing {prog_args.rounds} batch(es) of {prog_args.batch} msg(s), "
+    f"~{prog_args.content} char(s) of content each:"
+)
+for name, bench in [("repr", bench_repr), ("binary", bench_bin)]:
+    n_bytes, encode_secs, land_secs = bench()
+    print(
+        f"  * {name:>6}: {1e3 * encode_secs / n_k_msgs:8.3f} ms encode "
+        f"+ {1e3 * land_secs / n_k_msgs:8.3f} ms land per 1k msgs, "
+        f"{n_bytes / (1000 * n_k_msgs):0.1f} bytes/msg"
+    )
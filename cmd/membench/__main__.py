@@ -0,0 +1,105 @@
+import argparse
+import random
+import time
+import tracemalloc
+from collections import deque
+
+from ...pkg._service.msgring import *
+from ...pkg.ds import *
+
+# take arguments from command line
+cmdl_parser = argparse.ArgumentParser(
+    prog="python -m hbichat.cmd.membench",
+    description="HBI chatting memory benchmark",
+    epilog="measure heap bytes per msg retained as room history",
+)
+cmdl_parser.add_argument(
+    "--rooms", metavar="n_rooms", type=int, default=1000, help="number of rooms"
+)
+cmdl_parser.add_argument(
+    "--hist",
+    metavar="n_msgs",
+    type=int,
+    default=100,
+    help="number of msgs retained per room",
+)
+cmdl_parser.add_argument(
+    "--nicks",
+    metavar="n_nicks",
+    type=int,
+    default=50,
+    help="number of distinct chatters posting to each room",
+)
+cmdl_parser.add_argument(
+    "--content",
+    metavar="n_chars",
+    type=int,
+    default=40,
+    help="average length of msg content",
+)
+prog_args = cmdl_parser.parse_args()
+
+
+class PlainMsg:
+    # how `Msg` used to be, with a per-instance `__dict__`
+    def __init__(self, from_, content, time_):
+        self.from_ = str(from_)
+        self.content = str(content)
+        self.time_ = time_
+
+
+def gen_posts(room_idx: int):
+    # as posted, every nick arrives as a fresh str decoded from the wire
+    rnd = random.Random(room_idx)
+    now = time.time()
+    for i in range(prog_args.hist):
+        nick = f"Chatter${room_idx}-{rnd.randrange(prog_args.nicks)}"
+        n_chars = rnd.randrange(1, 2 * prog_args.content)
+        yield nick, "x" * n_chars, now + i
+
+
+def retain_plain():
+    # a deque of msg objects, and a deque of their reprs, per room
+    rooms = []
+    for room_idx in range(prog_args.rooms):
+        msgs = deque(maxlen=prog_args.hist)
+        msg_reprs = deque(maxlen=prog_args.hist)
+        for nick, content, time_ in gen_posts(room_idx):
+            msg = PlainMsg(nick, content, time_)
+            msgs.append(msg)
+            msg_reprs.append(f"Msg(({msg.from_!r}),({msg.content!r}),({msg.time_!r}))")
+        rooms.append((msgs, msg_reprs))
+    return rooms
+
+
+def retain_ring():
+    # a columnar msg ring per room
+    rooms = []
+    for room_idx in range(prog_args.rooms):
+        ring = MsgRing(prog_args.hist)
+        for nick, content, time_ in gen_posts(room_idx):
+            ring.append(Msg(nick, content, time_))
+        rooms.append(ring)
+    return rooms
+
+
+def measure(retain) -> float:
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    rooms = retain()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rooms
+    return (used - base) / (prog_args.rooms * prog_args.hist)
+
+
+n_msgs = prog_args.rooms * prog_args.hist
+print(
+    f"Retaining {n_msgs} msg(s) in {prog_args.rooms} room(s), "
+    f"~{prog_args.content} char(s) of content each:"
+)
+plain = measure(retain_plain)
+print(f"  * before (dict based msgs + reprs): {plain:0.1f} bytes/msg")
+ring = measure(retain_ring)
+print(f"  * after (columnar msg rings): {ring:0.1f} bytes/msg")
+print(f"  = {plain / ring:0.2f}x smaller")
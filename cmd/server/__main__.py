@@ -1,12 +1,18 @@
 import argparse
 import asyncio
+import os
 import runpy
+import shutil
+import signal
+import socket
+import tempfile
 
 from hbi import *
 
 from ...pkg._service import *
 from ...pkg.ds import *
 from ...pkg.log import *
+from ...pkg.xfer import *
 
 logger = get_logger(__package__)
 
@@ -40,6 +46,201 @@ cmdl_parser.add_argument(
     default=None,
     help="IP port number to listen on",
 )
+cmdl_parser.add_argument(
+    "-w",
+    "--workers",
+    metavar="n_workers",
+    type=int,
+    default=1,
+    help="number of worker processes to pre-fork, sharing the listening port",
+)
+cmdl_parser.add_argument(
+    "--outbox-size",
+    metavar="max_pending",
+    type=int,
+    default=service_config.outbox_max_pending,
+    help="max number of notifications pending delivery to a consumer",
+)
+cmdl_parser.add_argument(
+    "--overflow",
+    choices=OVERFLOW_POLICIES,
+    default=service_config.outbox_overflow,
+    help="what to do when a consumer's outbox overflows",
+)
+cmdl_parser.add_argument(
+    "--coalesce-ms",
+    metavar="window_ms",
+    type=float,
+    default=1000 * service_config.coalesce_window,
+    help="room msgs posted within this window go to a consumer as one notification",
+)
+cmdl_parser.add_argument(
+    "--coalesce-msgs",
+    metavar="max_msgs",
+    type=int,
+    default=service_config.coalesce_msgs,
+    help="max number of room msgs coalesced into one notification",
+)
+cmdl_parser.add_argument(
+    "--log-dir",
+    metavar="dir",
+    default=service_config.log_dir,
+    help="dir to keep durable room msg logs in",
+)
+cmdl_parser.add_argument(
+    "--hist-msgs",
+    metavar="n_msgs",
+    type=int,
+    default=service_config.room_hist_msgs,
+    help="number of recent msgs per room kept in memory",
+)
+cmdl_parser.add_argument(
+    "--room-ttl",
+    metavar="seconds",
+    type=float,
+    default=service_config.room_idle_ttl,
+    help="hibernate empty rooms idle for this long",
+)
+cmdl_parser.add_argument(
+    "--max-rooms",
+    metavar="n_rooms",
+    type=int,
+    default=service_config.max_resident_rooms,
+    help="max number of rooms resident in memory",
+)
+cmdl_parser.add_argument(
+    "--presence-ms",
+    metavar="window_ms",
+    type=float,
+    default=1000 * service_config.presence_window,
+    help="presence changes of a room within this window go out as one delta",
+)
+cmdl_parser.add_argument(
+    "--presence-max",
+    metavar="n_chatters",
+    type=int,
+    default=service_config.presence_max_occupancy,
+    help="suppress presence notifications for rooms with more chatters",
+)
+cmdl_parser.add_argument(
+    "--welcome-rooms",
+    metavar="n_rooms",
+    type=int,
+    default=service_config.welcome_top_rooms,
+    help="list this many most populated rooms in the welcome notice",
+)
+cmdl_parser.add_argument(
+    "--chunk-kb",
+    metavar="kb",
+    type=int,
+    default=service_config.chunk_initial // 1024,
+    help="initial chunk size of file data streams",
+)
+cmdl_parser.add_argument(
+    "--chunk-max-kb",
+    metavar="kb",
+    type=int,
+    default=service_config.chunk_max // 1024,
+    help="max chunk size file data streams adapt up to",
+)
+cmdl_parser.add_argument(
+    "--io-threads",
+    metavar="n_threads",
+    type=int,
+    default=service_config.io_threads,
+    help="number of threads doing blocking file I/O",
+)
+cmdl_parser.add_argument(
+    "--no-compression",
+    dest="compression",
+    action="store_false",
+    help="never compress file data streams",
+)
+cmdl_parser.add_argument(
+    "--max-transfers",
+    metavar="n_transfers",
+    type=int,
+    default=service_config.max_transfers,
+    help="max number of file transfers in progress, more are queued",
+)
+cmdl_parser.add_argument(
+    "--max-chatter-transfers",
+    metavar="n_transfers",
+    type=int,
+    default=service_config.max_transfers_per_chatter,
+    help="max number of file transfers in progress per chatter, more are queued",
+)
+cmdl_parser.add_argument(
+    "--transfer-mbps",
+    metavar="mb_per_sec",
+    type=float,
+    default=service_config.transfer_rate / 1024 / 1024,
+    help="bandwidth shared by file transfers in MB/s, 0 for unlimited",
+)
+cmdl_parser.add_argument(
+    "--data-port",
+    metavar="port",
+    type=int,
+    default=service_config.data_port,
+    help="port to serve side connections for file data on, plus worker index, "
+    "0 to pick a free port",
+)
+cmdl_parser.add_argument(
+    "--no-data-conn",
+    dest="data_conns",
+    action="store_false",
+    help="stream file data over chatting connections only",
+)
+cmdl_parser.add_argument(
+    "--hot-cache-mb",
+    metavar="mb",
+    type=int,
+    default=service_config.hot_cache_bytes // 1024 // 1024,
+    help="memory to cache contents of hot files in, 0 to disable",
+)
+cmdl_parser.add_argument(
+    "--hot-file-kb",
+    metavar="kb",
+    type=int,
+    default=service_config.hot_file_max // 1024,
+    help="max size of files to cache contents of",
+)
+cmdl_parser.add_argument(
+    "--blob-gc-secs",
+    metavar="seconds",
+    type=float,
+    default=service_config.blob_gc_interval,
+    help="collect file blobs no longer in any room at this interval, 0 to disable",
+)
+cmdl_parser.add_argument(
+    "--partial-max-age",
+    metavar="seconds",
+    type=float,
+    default=service_config.partial_max_age,
+    help="remove partial files of uploads interrupted this long ago, 0 to keep them",
+)
+cmdl_parser.add_argument(
+    "--rate-limit",
+    metavar="[room:]method=rate/burst",
+    action="append",
+    default=[],
+    help="limit calls of a service method per chatter, optionally in a room only, "
+    "a rate of 0 for unlimited",
+)
+cmdl_parser.add_argument(
+    "--rate-delay",
+    metavar="seconds",
+    type=float,
+    default=service_config.rate_limit_max_delay,
+    help="delay calls over limit up to this long, reject those would wait longer",
+)
+cmdl_parser.add_argument(
+    "--stats-interval",
+    metavar="seconds",
+    type=float,
+    default=0,
+    help="log service stats at this interval, 0 to disable",
+)
 prog_args = cmdl_parser.parse_args()
 
 # apply command line arguments
@@ -57,6 +258,42 @@ if prog_args.port is not None:
 if len(service_addr["host"]) < 1:
     # listen on loopback by default
     service_addr["host"].append("127.0.0.1")
+service_config.outbox_max_pending = prog_args.outbox_size
+service_config.outbox_overflow = prog_args.overflow
+service_config.coalesce_window = prog_args.coalesce_ms / 1000
+service_config.coalesce_msgs = max(1, prog_args.coalesce_msgs)
+service_config.log_dir = prog_args.log_dir
+service_config.room_hist_msgs = prog_args.hist_msgs
+service_config.room_idle_ttl = prog_args.room_ttl
+service_config.max_resident_rooms = max(1, prog_args.max_rooms)
+service_config.presence_window = prog_args.presence_ms / 1000
+service_config.presence_max_occupancy = prog_args.presence_max
+service_config.welcome_top_rooms = prog_args.welcome_rooms
+service_config.chunk_initial = prog_args.chunk_kb * 1024
+service_config.chunk_max = prog_args.chunk_max_kb * 1024
+service_config.compression = prog_args.compression
+service_config.io_threads = prog_args.io_threads
+service_config.blob_gc_interval = prog_args.blob_gc_secs
+service_config.partial_max_age = prog_args.partial_max_age
+service_config.hot_cache_bytes = prog_args.hot_cache_mb * 1024 * 1024
+service_config.hot_file_max = prog_args.hot_file_kb * 1024
+service_config.data_conns = prog_args.data_conns
+service_config.data_port = prog_args.data_port
+service_config.max_transfers = max(1, prog_args.max_transfers)
+service_config.max_transfers_per_chatter = max(1, prog_args.max_chatter_transfers)
+service_config.transfer_rate = prog_args.transfer_mbps * 1024 * 1024
+for spec in prog_args.rate_limit:
+    target, limits = spec.split("=", 1)
+    rate, burst = limits.split("/", 1)
+    room_id, _, method = target.rpartition(":")
+    if room_id:
+        service_config.room_rate_limits.setdefault(room_id, {})[method] = (
+            float(rate),
+            int(burst),
+        )
+    else:
+        service_config.rate_limits[method] = (float(rate), int(burst))
+service_config.rate_limit_max_delay = prog_args.rate_delay
 
 
 def he_factory():  # Create a hosting env reacting to chat consumers
@@ -84,7 +321,12 @@ def he_factory():  # Create a hosting env reacting to chat consumers
         else:
             logger.debug(f"Chatting consumer {chatter.po.remote_addr!s} disconnected.")
 
-        chatter.in_room.chatters.discard(chatter)
+        if chatter.in_room is not None:  # or `welcome_chatter()` never got there
+            chatter.in_room.leave(chatter)
+        chatter.outbox.close()
+        chatter.release_held()
+        if chatter.data_token is not None:
+            data_tokens.revoke(chatter.data_token)
 
     # expose standard named values for interop
     expose_interop_values(he)
@@ -99,26 +341,133 @@ def he_factory():  # Create a hosting env reacting to chat consumers
     return he
 
 
-async def serve_chatting():
+def data_he_factory():  # Create a hosting env for data connections of chatters
+    he = HostingEnv()
+
+    data_chatter = None
+
+    async def __hbi_init__(po: PostingEnd, ho: HostingEnd):
+        nonlocal data_chatter
+
+        # nothing to welcome, the consumer attaches it to its chatter by a token
+        data_chatter = DataChatter(po, ho)
+        he.expose_reactor(data_chatter)
+
+    async def __hbi_cleanup__(po: PostingEnd, ho: HostingEnd, disc_reason=None):
+        if disc_reason is not None:
+            logger.debug(f"Data connection {po.remote_addr!s} lost: {disc_reason!s}")
+
+        if data_chatter is not None:  # or `__hbi_init__()` never ran
+            data_chatter.detach()
+
+    # expose standard named values for interop
+    expose_interop_values(he)
+
+    # expose magic functions
+    he.expose_function(None, __hbi_init__)
+    he.expose_function(None, __hbi_cleanup__)
+
+    return he
+
+
+async def serve_data_conns(worker_idx: int):
+    # serve data connections on a port of this worker's own, so they attach to
+    # chatters of this process
+    port = service_config.data_port and service_config.data_port + worker_idx
+    for host in service_addr["host"]:
+        # the same port on all IPs, the one picked for the first if not configured
+        server = await serve_tcp({"host": [host], "port": port}, data_he_factory)
+        port = server.sockets[0].getsockname()[1]
+    data_tokens.port = port
+    logger.info(f"Serving data connections (worker {worker_idx}) on port {port}.")
+
+
+async def serve_chatting(hub_path: str = None, worker_idx: int = 0):
+    n_workers = prog_args.workers
+    # blocking file I/O is done by a thread pool of this process
+    io_executor(service_config.io_threads)
+    if hub_path is not None:
+        # join the room bus before accepting any chatter
+        await join_room_bus(hub_path, worker_idx, n_workers)
+
+    if service_config.data_conns:
+        await serve_data_conns(worker_idx)
+
     server = await serve_tcp(
         # listening IP address(es)
         service_addr,
         # the hosting env factory function
         he_factory,
+        # workers each listen on the same port, the kernel balances connections
+        net_opts={"reuse_port": True} if n_workers > 1 else None,
     )
     logger.info(
-        "HBI Chatting Server listening:\n  * "
+        f"HBI Chatting Server (worker {worker_idx}/{n_workers}) listening:\n  * "
         + "\n  * ".join(
             ":".join(str(v) for v in s.getsockname()) for s in server.sockets
         )
     )
 
+    asyncio.create_task(sweep_idle_rooms())
+    if service_config.blob_gc_interval > 0:
+        asyncio.create_task(collect_blobs_periodically(service_config.blob_gc_interval))
+    if service_config.partial_max_age > 0:
+        asyncio.create_task(
+            collect_partials_periodically(service_config.partial_gc_interval)
+        )
+    if prog_args.stats_interval > 0:
+        asyncio.create_task(log_stats_periodically(prog_args.stats_interval))
+
     await server.wait_closed()
 
 
+def serve_with_workers(n_workers: int):
+    # bind the room bus hub before forking, so workers can connect right away
+    bus_dir = tempfile.mkdtemp(prefix="hbichat-bus-")
+    hub_path = os.path.join(bus_dir, "hub.sock")
+    hub_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    hub_sock.bind(hub_path)
+    hub_sock.listen(n_workers)
+
+    worker_pids = []
+    for worker_idx in range(n_workers):
+        pid = os.fork()
+        if pid == 0:  # in a worker process
+            hub_sock.close()
+            # have SIGTERM from the master shut down the worker gracefully
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                asyncio.run(serve_chatting(hub_path, worker_idx))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                # flush room logs, atexit hooks of the master don't apply to workers
+                log_writer.stop()
+                os._exit(0)
+        worker_pids.append(pid)
+
+    try:
+        asyncio.run(serve_room_bus(hub_sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in worker_pids:
+            os.waitpid(pid, 0)
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
 handle_signals()
 
 try:
-    asyncio.run(serve_chatting())
+    if prog_args.workers > 1:
+        serve_with_workers(prog_args.workers)
+    else:
+        asyncio.run(serve_chatting())
 except KeyboardInterrupt:
-    logger.info("HBI Chatting Server shut down.")
+    pass
+logger.info("HBI Chatting Server shut down.")
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import os
+import socket
+import tempfile
+import time
+from zlib import crc32
+
+from ...pkg.xfer import *
+
+# take arguments from command line
+cmdl_parser = argparse.ArgumentParser(
+    prog="python -m hbichat.cmd.xferbench",
+    description="HBI chatting file transfer benchmark",
+    epilog="measure MB/s of streaming a file over loopback, fixed 1 KB chunks on the "
+    "event loop vs adaptive chunks with I/O offloaded",
+)
+cmdl_parser.add_argument(
+    "--mb", metavar="n_mb", type=int, default=200, help="size of the file to stream"
+)
+cmdl_parser.add_argument(
+    "--chunk-kb",
+    metavar="kb",
+    type=int,
+    default=CHUNK_INITIAL // 1024,
+    help="initial chunk size",
+)
+cmdl_parser.add_argument(
+    "--chunk-max-kb",
+    metavar="kb",
+    type=int,
+    default=CHUNK_MAX // 1024,
+    help="max chunk size",
+)
+prog_args = cmdl_parser.parse_args()
+
+
+def fixed_send_chunks(f, fsz, state):
+    # how file data used to be sent, 1 KB a chunk, newly allocated
+    bytes_remain = fsz
+    while bytes_remain > 0:
+        chunk = f.read(min(1024, bytes_remain))
+        assert len(chunk) > 0, "file shrunk !?!"
+        bytes_remain -= len(chunk)
+        yield chunk
+        state["chksum"] = crc32(chunk, state["chksum"])
+
+
+def fixed_recv_chunks(f, fsz, state):
+    # how file data used to be received, 1 KB a chunk, into a reused buffer
+    buf = bytearray(1024)
+    bytes_remain = fsz
+    while bytes_remain > 0:
+        if len(buf) > bytes_remain:
+            buf = buf[:bytes_remain]
+        yield buf
+        f.write(buf)
+        bytes_remain -= len(buf)
+        state["chksum"] = crc32(buf, state["chksum"])
+
+
+def each_buf(bufs):
+    # as HBI conversations do, take a single buffer, or pull buffers from a sync
+    # iterable, never an async one
+    if isinstance(bufs, (bytes, bytearray, memoryview)):
+        yield bufs
+        return
+    for buf in bufs:
+        yield from each_buf(buf)
+
+
+class SockCo:
+    """
+    Stand-in of an HBI conversation over a socket, with `send_data()`/`recv_data()`
+
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+    async def send_data(self, bufs):
+        # write out chunks one by one
+        loop = asyncio.get_running_loop()
+        for chunk in each_buf(bufs):
+            await loop.sock_sendall(self.sock, chunk)
+
+    async def recv_data(self, bufs):
+        # fill each buffer from the wire
+        loop = asyncio.get_running_loop()
+        for buf in each_buf(bufs):
+            view = memoryview(buf)
+            while len(view) > 0:
+                n = await loop.sock_recv_into(self.sock, view)
+                assert n > 0, "peer closed !?!"
+                view = view[n:]
+
+
+async def watch_loop_lag(lags: list):
+    # how late the event loop gets to a ticker, i.e. how long it's been blocked
+    while True:
+        start_time = time.monotonic()
+        await asyncio.sleep(0.001)
+        lags.append(time.monotonic() - start_time - 0.001)
+
+
+async def bench(src_path: str, dst_path: str, adaptive: bool):
+    fsz = os.path.getsize(src_path)
+    lags = [0.0]
+    watcher = asyncio.create_task(watch_loop_lag(lags))
+    s1, s2 = socket.socketpair()
+    s1.setblocking(False)
+    s2.setblocking(False)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        start_time = time.monotonic()
+        if adaptive:
+            chunk_initial = prog_args.chunk_kb * 1024
+            chunk_max = prog_args.chunk_max_kb * 1024
+            out = FileStream(src, fsz, chunk_initial, chunk_max)
+            in_ = FileStream(dst, fsz, chunk_initial, chunk_max)
+            await asyncio.gather(
+                send_bufs(SockCo(s1), out.send_chunks()),
+                recv_bufs(SockCo(s2), in_.recv_chunks()),
+            )
+            chksums = out.chksum, in_.chksum
+        else:
+            out, in_ = {"chksum": 0}, {"chksum": 0}
+            await asyncio.gather(
+                SockCo(s1).send_data(fixed_send_chunks(src, fsz, out)),
+                SockCo(s2).recv_data(fixed_recv_chunks(dst, fsz, in_)),
+            )
+            chksums = out["chksum"], in_["chksum"]
+        elapsed = time.monotonic() - start_time
+    watcher.cancel()
+    s1.close()
+    s2.close()
+    assert chksums[0] == chksums[1], "checksum mismatch !?!"
+    return fsz / 1024 / 1024 / elapsed, 1e3 * max(lags)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = os.path.join(tmp_dir, "src")
+        with open(src_path, "wb") as f:
+            for _ in range(prog_args.mb):
+                f.write(os.urandom(1024 * 1024))
+        dst_path = os.path.join(tmp_dir, "dst")
+
+        print(f"Streaming {prog_args.mb} MB over loopback:")
+        mbps, max_lag = await bench(src_path, dst_path, False)
+        print(
+            f"  * fixed 1 KB chunks: {mbps:0.1f} MB/s, "
+            f"event loop blocked {max_lag:0.1f} ms at most"
+        )
+        mbps, max_lag = await bench(src_path, dst_path, True)
+        print(
+            f"  * adaptive {prog_args.chunk_kb} ~ {prog_args.chunk_max_kb} KB chunks: "
+            f"{mbps:0.1f} MB/s, event loop blocked {max_lag:0.1f} ms at most"
+        )
+
+
+asyncio.run(main())
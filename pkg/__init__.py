@@ -1,13 +1,19 @@
 from .consumer import *
+from .delta import *
 from .ds import *
 from .getline import *
 from .log import *
+from .xfer import *
 
 __all__ = [
 
     # exports from .consumer
     'Chatter',
 
+    # exports from .delta
+    'BLOCK_SIZE', 'strong_sum', 'block_sums', 'compute_delta', 'BlockVerifier',
+    'DeltaStream',
+
     # exports from .ds
     'expose_shared_data_structures', 'MsgsInRoom', 'Msg',
 
@@ -17,4 +23,7 @@ __all__ = [
     # exports from .log
     'root_logger', 'get_logger',
 
+    # exports from .xfer
+    'ChunkSizer', 'FileStream', 'CHUNK_INITIAL', 'CHUNK_MAX',
+
 ]
@@ -6,15 +6,75 @@ from exports of the root `hbichat` package. while the `consumer`
 package is supposed to be part of the public exports.
 
 """
+from .blobs import *
+from .bus import *
 from .chatter import *
+from .config import *
+from .dataconn import *
+from .fileindex import *
+from .files import *
+from .hotfiles import *
+from .msgring import *
+from .outbox import *
+from .ratelimit import *
 from .room import *
+from .roomindex import *
+from .roomlog import *
+from .stats import *
+from .transfers import *
 
 __all__ = [
 
+    # exports from .blobs
+    'blob_path', 'blob_refs', 'link_blob', 'ingest_blob', 'collect_blobs',
+    'collect_blobs_periodically',
+
+    # exports from .bus
+    'RoomBus', 'room_bus', 'serve_room_bus',
+
     # exports from .chatter
-    'Chatter',
+    'Chatter', 'DataChatter', 'sweep_idle_rooms', 'join_room_bus',
+
+    # exports from .config
+    'ServiceConfig', 'service_config',
+
+    # exports from .dataconn
+    'DataTokens', 'data_tokens',
+
+    # exports from .fileindex
+    'RoomFiles', 'FileIndex', 'file_index', 'FILE_SORTS',
+
+    # exports from .files
+    'content_id', 'cached_crc', 'cache_crc', 'file_crc', 'upload_status',
+    'open_partial', 'save_partial', 'discard_partial', 'finish_partial',
+    'collect_partials', 'collect_partials_periodically', 'range_crc',
+    'block_manifest', 'open_download', 'close_file',
+
+    # exports from .hotfiles
+    'HotFile', 'HotFiles', 'hot_files',
+
+    # exports from .msgring
+    'MsgRing',
+
+    # exports from .outbox
+    'Outbox', 'SharedCode', 'OVERFLOW_POLICIES',
+
+    # exports from .ratelimit
+    'TokenBucket', 'RateLimiter',
 
     # exports from .room
     'Room',
 
+    # exports from .roomindex
+    'OccupancyIndex', 'room_index',
+
+    # exports from .roomlog
+    'RoomLog', 'LogWriter', 'log_writer', 'log_dir_name', 'logged_rooms',
+
+    # exports from .stats
+    'service_stats', 'log_stats_periodically',
+
+    # exports from .transfers
+    'Transfer', 'TransferScheduler', 'transfer_scheduler',
+
 ]
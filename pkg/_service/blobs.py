@@ -0,0 +1,189 @@
+"""
+Content addressed store of file data shared in rooms.
+
+Data of an uploaded file is kept once, as a blob named by its sha256 under
+`service_config.blob_dir`, and files in room dirs are hard links to blobs. So the
+same file uploaded to many rooms, or under many names, takes disk space only once,
+and the link count of a blob tells how many room files reference it. A blob left
+linked by no room file is garbage, collected periodically.
+
+"""
+import asyncio
+import os
+import re
+import stat
+
+from ..log import *
+from ..xfer import *
+from .config import *
+from .stats import *
+
+__all__ = [
+    "blob_path",
+    "blob_refs",
+    "link_blob",
+    "ingest_blob",
+    "collect_blobs",
+    "collect_blobs_periodically",
+]
+
+logger = get_logger(__package__)
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+def blob_path(digest: str) -> str:
+    # blobs are spread into sub dirs by first 2 hex digits of the hash
+    return os.path.join(service_config.blob_dir, digest[:2], digest)
+
+
+def blob_refs(st: os.stat_result) -> int:
+    # number of room files referencing a blob, the blob dir holds a link itself
+    return st.st_nlink - 1
+
+
+def _link_over(src: str, fpth: str):
+    # hard link `src` as `fpth`, replacing whatever is there atomically
+    room_dir, fn = os.path.split(fpth)
+    tmp_pth = os.path.join(room_dir, f".{fn}.link")
+    try:
+        os.unlink(tmp_pth)
+    except FileNotFoundError:
+        pass
+    os.link(src, tmp_pth)
+    os.replace(tmp_pth, fpth)
+
+
+def _in_dir(room_dir: str, bst: os.stat_result) -> bool:
+    # whether some file in a room dir is a link to the blob
+    try:
+        entries = os.scandir(room_dir)
+    except FileNotFoundError:
+        return False
+    with entries:
+        for entry in entries:
+            if entry.inode() != bst.st_ino:
+                continue
+            try:
+                if os.path.samestat(entry.stat(follow_symlinks=False), bst):
+                    return True
+            except FileNotFoundError:
+                continue
+    return False
+
+
+def _link_blob(digest: str, fsz: int, fpth: str):
+    if not _DIGEST.fullmatch(digest):
+        return None  # not a sha256 hex digest
+    bpth = blob_path(digest)
+    try:
+        bst = os.stat(bpth)
+        if bst.st_size != fsz:
+            return None
+        if not _in_dir(os.path.dirname(fpth), bst):
+            return None
+        _link_over(bpth, fpth)
+    except FileNotFoundError:
+        return None  # no such blob, or just collected
+    return os.stat(fpth)
+
+
+async def link_blob(digest: str, fsz: int, fpth: str):
+    """
+    Make `fpth` a link to the blob of `fsz` bytes with sha256 `digest`, return stat of
+    the file linked, or None if there's no such blob, then the data is to be uploaded.
+
+    Knowing the digest proves nothing about having the data, so a blob is linked only
+    if it's in the room already, under another name or the same. Data uploaded to
+    other rooms is still stored once, by `ingest_blob()`.
+
+    """
+    st = await run_io(_link_blob, digest, fsz, fpth)
+    if st is not None:
+        service_stats["blob_dedup_hits"] += 1
+        service_stats["blob_dedup_bytes"] += fsz
+    return st
+
+
+def _ingest_blob(part_pth: str, fsz: int, digest: str, fpth: str):
+    with open(part_pth, "rb") as f:
+        pst = os.fstat(f.fileno())
+    if not stat.S_ISREG(pst.st_mode) or pst.st_size != fsz:
+        raise ValueError(f"Partial file of {pst.st_size} bytes, not {fsz}.")
+    bpth = blob_path(digest)
+    os.makedirs(os.path.dirname(bpth), exist_ok=True)
+    try:
+        os.link(part_pth, bpth)
+        if not os.path.samestat(os.stat(bpth), pst):
+            os.unlink(bpth)  # not the file checked
+            raise ValueError(f"Partial file replaced: [{part_pth}]")
+    except FileExistsError:
+        # the same data has been stored meanwhile, link to that instead
+        try:
+            _link_over(bpth, fpth)
+            os.unlink(part_pth)
+            return os.stat(fpth)
+        except FileNotFoundError:
+            pass  # just collected, keep the data as received
+    except OSError as exc:
+        # hard links not supported by the file system, or the like, keep the data
+        # as received, not deduplicated
+        logger.warning(f"Failed storing blob [{bpth}]: {exc!s}")
+    # rename over the old file, so if someone has opened it for download, that can
+    # finish normally.
+    os.replace(part_pth, fpth)
+    return os.stat(fpth)
+
+
+async def ingest_blob(
+    part_pth: str, fsz: int, digest: str, fpth: str
+) -> os.stat_result:
+    """
+    Make the data of `fsz` bytes completely received in `part_pth`, private to the
+    upload, with sha256 `digest`, the file `fpth`, stored as a blob, return stat of
+    the file.
+
+    """
+    return await run_io(_ingest_blob, part_pth, fsz, digest, fpth)
+
+
+def _collect_blobs():
+    blob_dir = service_config.blob_dir
+    if not os.path.isdir(blob_dir):
+        return 0, 0
+    n_blobs = n_bytes = 0
+    for sub_dir in os.scandir(blob_dir):
+        if not sub_dir.is_dir(follow_symlinks=False):
+            continue
+        for entry in os.scandir(sub_dir.path):
+            try:
+                st = entry.stat(follow_symlinks=False)
+                if blob_refs(st) > 0:
+                    continue
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            n_blobs += 1
+            n_bytes += st.st_size
+    return n_blobs, n_bytes
+
+
+async def collect_blobs():
+    """
+    Remove blobs no longer referenced by any room file.
+
+    """
+    n_blobs, n_bytes = await run_io(_collect_blobs)
+    if n_blobs > 0:
+        service_stats["blobs_collected"] += n_blobs
+        service_stats["blob_bytes_collected"] += n_bytes
+        logger.info(f"Collected {n_blobs} blob(s) of {n_bytes} bytes.")
+
+
+async def collect_blobs_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await collect_blobs()
+        except Exception:
+            logger.error("Failed collecting blobs.", exc_info=True)
@@ -0,0 +1,175 @@
+"""
+Inter-process room bus, for multiple worker processes to serve a single chat.
+
+The master process runs a hub over a unix socket, every worker connects to it, and
+frames published by a worker are relayed to all other workers as is.
+
+A frame is a pickled tuple, led by its kind, and prefixed by its length:
+
+    ("hello", worker_idx)                             a worker joined the bus
+    ("gone", worker_idx)                              a worker left the bus
+    ("post", room_id, nick, content, time)            a msg posted to a room
+    ("presence", room_id, nick, joined, mover)        a chatter joined/left a room
+    ("occupancy", room_id, worker_idx, n_chatters)    chatters of a room in a worker
+
+Each room is owned by one worker, decided by hash of its id, only the owner writes
+the room log. Rooms of a worker gone are taken over by the live workers, spread by
+rendezvous hashing, so they keep being logged.
+
+"""
+import asyncio
+import hashlib
+import pickle
+import socket
+import struct
+from typing import *
+from zlib import crc32
+
+from ..log import *
+
+__all__ = ["RoomBus", "room_bus", "serve_room_bus"]
+
+logger = get_logger(__package__)
+
+_FRAME_HEAD = struct.Struct("<I")
+
+
+class RoomBus:
+    """
+    A worker's end of the room bus
+
+    It stays standalone, i.e. owning all rooms and publishing nothing, unless joined
+    to a hub.
+
+    """
+
+    def __init__(self):
+        self.worker_idx = 0
+        self.n_workers = 1
+        self.writer = None
+        self.on_frame = None
+
+        # workers on the bus, all forked together, so presumed live till gone
+        self.live_workers = {0}
+
+        # room_id -> {worker_idx: n_chatters} of other workers
+        self.remote_occupancy = {}
+
+    @property
+    def joined(self) -> bool:
+        return self.writer is not None
+
+    def owns(self, room_id: str) -> bool:
+        if self.n_workers <= 1:
+            return True
+        return self.owner_of(room_id) == self.worker_idx
+
+    def owner_of(self, room_id: str) -> int:
+        room_key = room_id.encode("utf-8")
+        worker_idx = crc32(room_key) % self.n_workers
+        if worker_idx in self.live_workers:
+            return worker_idx
+        # the same pick by all live workers, and mostly stable as more ones go
+        return max(
+            self.live_workers,
+            key=lambda worker_idx: hashlib.blake2b(
+                room_key, digest_size=8, salt=worker_idx.to_bytes(8, "little")
+            ).digest(),
+        )
+
+    def remote_population(self, room_id: str) -> int:
+        return sum(self.remote_occupancy.get(room_id, {}).values())
+
+    async def join(
+        self,
+        hub_path: str,
+        worker_idx: int,
+        n_workers: int,
+        on_frame: Callable[..., None],
+    ):
+        self.worker_idx = worker_idx
+        self.n_workers = n_workers
+        self.live_workers = set(range(n_workers))
+        self.on_frame = on_frame
+
+        reader, self.writer = await asyncio.open_unix_connection(hub_path)
+        self.publish("hello", worker_idx)
+        asyncio.create_task(self._read_frames(reader))
+
+    def publish(self, *frame):
+        if self.writer is None:
+            return
+        data = pickle.dumps(frame, pickle.HIGHEST_PROTOCOL)
+        self.writer.write(_FRAME_HEAD.pack(len(data)) + data)
+
+    async def _read_frames(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                (n,) = _FRAME_HEAD.unpack(await reader.readexactly(_FRAME_HEAD.size))
+                frame = pickle.loads(await reader.readexactly(n))
+                kind = frame[0]
+                if kind == "occupancy":
+                    room_id, worker_idx, n_chatters = frame[1:]
+                    occupancy = self.remote_occupancy.setdefault(room_id, {})
+                    if n_chatters > 0:
+                        occupancy[worker_idx] = n_chatters
+                    else:
+                        occupancy.pop(worker_idx, None)
+                        if not occupancy:
+                            del self.remote_occupancy[room_id]
+                elif kind == "gone":
+                    (worker_idx,) = frame[1:]
+                    self.live_workers.discard(worker_idx)
+                    for room_id, occupancy in [*self.remote_occupancy.items()]:
+                        occupancy.pop(worker_idx, None)
+                        if not occupancy:
+                            del self.remote_occupancy[room_id]
+                try:
+                    self.on_frame(*frame)
+                except Exception:
+                    logger.error(f"Failed handling bus frame {kind}", exc_info=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.fatal(f"Worker {self.worker_idx} lost the room bus.")
+        finally:
+            self.writer = None
+
+
+room_bus = RoomBus()
+
+
+async def serve_room_bus(sock: socket.socket):
+    """
+    Run the hub of room bus on a listening unix socket, till cancelled.
+
+    """
+    peers = {}  # worker_idx -> StreamWriter
+
+    def relay(from_idx, data: bytes):
+        for worker_idx, writer in peers.items():
+            if worker_idx != from_idx:
+                writer.write(data)
+
+    async def serve_worker(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_idx = None
+        try:
+            while True:
+                head = await reader.readexactly(_FRAME_HEAD.size)
+                (n,) = _FRAME_HEAD.unpack(head)
+                data = await reader.readexactly(n)
+                if worker_idx is None:  # 1st frame must be the hello
+                    kind, worker_idx = pickle.loads(data)
+                    assert kind == "hello", f"unexpected {kind} frame before hello"
+                    peers[worker_idx] = writer
+                relay(worker_idx, head + data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            if worker_idx is not None:
+                del peers[worker_idx]
+                data = pickle.dumps(("gone", worker_idx), pickle.HIGHEST_PROTOCOL)
+                relay(worker_idx, _FRAME_HEAD.pack(len(data)) + data)
+
+    server = await asyncio.start_unix_server(serve_worker, sock=sock)
+    async with server:
+        await server.serve_forever()
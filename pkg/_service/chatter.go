@@ -94,6 +94,7 @@ func (chatter *Chatter) NamesToExpose() []string {
 		"RecvFile",
 		"ListFiles",
 		"SendFile",
+		"Features",
 	}
 }
 
@@ -148,6 +149,11 @@ ChatterJoined(%#v, %#v)
 	})
 }
 
+// Features is declared by consumers about optional protocol features they support,
+// this service implements none of them, so the declaration is simply accepted.
+func (chatter *Chatter) Features(features []interface{}) {
+}
+
 func (chatter *Chatter) SetNick(nick string) {
 	co := chatter.ho.Co()
 	// transit the hosting conversation to `send` stage a.s.a.p.
@@ -1,35 +1,239 @@
 import asyncio
 from datetime import datetime
+import hashlib
 import math
 import os.path
+import secrets
 import time
 import traceback
-from collections import deque
-from zlib import crc32
+from collections import OrderedDict, deque
 
 from hbi import *
 
+from ..delta import *
 from ..ds import *
 from ..log import *
+from ..xfer import *
+from .blobs import *
+from .config import *
+from .dataconn import *
+from .fileindex import *
+from .files import *
+from .hotfiles import *
+from .outbox import *
+from .ratelimit import *
+from .bus import *
 from .room import *
+from .roomindex import *
+from .roomlog import *
+from .stats import *
+from .transfers import *
 
-__all__ = ["Chatter"]
+__all__ = ["Chatter", "DataChatter", "sweep_idle_rooms", "join_room_bus"]
 
 logger = get_logger(__package__)
 
 
-rooms = {}
+# resident rooms in LRU order, the most recently used last
+rooms = OrderedDict()
+# ids of rooms with history on disk, but not resident
+hibernated_rooms = set()
+# rooms evicted, with msgs still being written to disk, by id
+draining_rooms = {}
+# rooms being created or rehydrated, with logs recovered off the event loop, by id
+opening_rooms = {}
+# msgs relayed from other workers to rooms being prepared here, by id
+pending_posts = {}
 
 
-def prepare_room(room_id: str = None):
+def room_name(room_id: str = None) -> str:
     if not room_id:
-        room_id = "Lobby"
-    room = rooms.get(room_id, None)
-    if room is None:
-        room = rooms[room_id] = Room(room_id)
+        return "Lobby"
+    # fits in u16 of binary msg batches even all 4-byte chars
+    return room_id[:0x3FFF]
+
+
+async def prepare_room(room_id: str = None):
+    room_id = room_name(room_id)
+    while room_id not in rooms:
+        room = draining_rooms.pop(room_id, None)
+        if room is not None:  # evicted but not flushed yet, still good to reuse
+            service_stats["rooms_rehydrated"] += 1
+            admit_room(room)
+            break
+        # create or rehydrate the room, its history is recovered from its log, and
+        # concurrent preparations share a single recovery
+        opening = opening_rooms.get(room_id, None)
+        if opening is None:
+            opening = opening_rooms[room_id] = asyncio.ensure_future(open_room(room_id))
+        await asyncio.shield(opening)
+    else:
+        rooms.move_to_end(room_id)
+    room = rooms[room_id]
+    room.touch()
     return room
 
 
+async def open_room(room_id: str):
+    try:
+        room = Room(room_id)
+        await room.recover()
+        if room_id in hibernated_rooms:
+            hibernated_rooms.discard(room_id)
+            service_stats["rooms_rehydrated"] += 1
+        admit_room(room)
+        if room.log.follower and room_bus.owns(room_id):  # owner gone meanwhile
+            asyncio.create_task(room.take_over())
+    finally:
+        del opening_rooms[room_id]
+
+
+def admit_room(room: Room):
+    rooms[room.room_id] = room
+    if len(rooms) > service_config.max_resident_rooms:
+        evict_lru_rooms(room)
+    count_rooms()
+
+
+def hibernate_room(room: Room) -> bool:
+    # a room can only be dropped when nobody is in it. one with msgs not on disk yet
+    # is kept draining till they are, or a rehydrated room would recover a stale log.
+    if room.chatters:
+        return False
+    del rooms[room.room_id]
+    if not room.log.all_durable():
+        draining_rooms[room.room_id] = room
+        asyncio.create_task(drain_room(room))
+        return True
+    retire_room(room)
+    return True
+
+
+async def drain_room(room: Room):
+    await room.log.wait_durable(room.log.next_seq - 1)
+    if draining_rooms.get(room.room_id, None) is not room:
+        return  # rehydrated meanwhile
+    del draining_rooms[room.room_id]
+    retire_room(room)
+    count_rooms()
+
+
+def retire_room(room: Room):
+    room.log.close()
+    if room.log.next_seq > 0:
+        hibernated_rooms.add(room.room_id)
+        service_stats["rooms_hibernations"] += 1
+    else:  # nothing to keep for a room never spoken in
+        service_stats["rooms_evicted_empty"] += 1
+
+
+def evict_lru_rooms(keep: Room):
+    for room in [*rooms.values()]:  # from the least recently used
+        if len(rooms) <= service_config.max_resident_rooms:
+            break
+        if room is not keep:
+            hibernate_room(room)
+
+
+def count_rooms():
+    service_stats["rooms_resident"] = len(rooms)
+    service_stats["rooms_hibernated"] = len(hibernated_rooms)
+
+
+def room_population(room_id: str) -> int:
+    room = rooms.get(room_id, None)
+    if room is not None:
+        return room.population()
+    return room_bus.remote_population(room_id)
+
+
+def on_bus_frame(kind: str, *args):
+    if kind == "post":
+        room_id, nick, content, time_ = args
+        msg = Msg(nick, content, time_)
+        room = rooms.get(room_id, None)
+        if room_id in pending_posts:  # after those relayed before it
+            pending_posts[room_id].append(msg)
+        elif room is not None:
+            room.accept_msg(msg)
+        elif room_bus.owns(room_id):  # have it logged even nobody is in room here
+            pending_posts[room_id] = [msg]
+            asyncio.create_task(accept_pending_posts(room_id))
+    elif kind == "presence":
+        room_id, nick, joined, mover = args
+        room = rooms.get(room_id, None)
+        if room is not None:
+            room.notif_presence(nick, joined, mover=mover)
+    elif kind == "occupancy":
+        room_id = args[0]
+        room_index.update(room_id, room_population(room_id))
+    elif kind == "gone":
+        for room_id in [*room_index.populations]:
+            room_index.update(room_id, room_population(room_id))
+        # rooms of the worker gone, now owned by this one, get logged here
+        for room in rooms.values():
+            if room.log.follower and room_bus.owns(room.room_id):
+                asyncio.create_task(room.take_over())
+    elif kind == "hello":
+        # a worker joined the bus, tell it about chatters here
+        for room in rooms.values():
+            if room.chatters:
+                room_bus.publish(
+                    "occupancy", room.room_id, room_bus.worker_idx, len(room.chatters)
+                )
+
+
+async def accept_pending_posts(room_id: str):
+    try:
+        room = await prepare_room(room_id)
+    except Exception:
+        msgs = pending_posts.pop(room_id)
+        logger.error(
+            f"Failed preparing room [{room_id}], {len(msgs)} msg(s) relayed dropped",
+            exc_info=True,
+        )
+        return
+    for msg in pending_posts.pop(room_id):
+        room.accept_msg(msg)
+
+
+async def join_room_bus(hub_path: str, worker_idx: int, n_workers: int):
+    await room_bus.join(hub_path, worker_idx, n_workers, on_bus_frame)
+
+
+async def sweep_idle_rooms():
+    # rooms logged by previous runs are hibernated ones
+    hibernated_rooms.update(
+        room_id for room_id in logged_rooms() if room_id not in rooms
+    )
+    count_rooms()
+
+    ttl = service_config.room_idle_ttl
+    while True:
+        await asyncio.sleep(max(1.0, ttl / 4))
+        for room in [*rooms.values()]:
+            if room.is_idle(ttl):
+                hibernate_room(room)
+        count_rooms()
+
+
+def upload_refusal(room_id: str, fn: str, fsz: int) -> str:
+    # why an upload is refused, or None if it's acceptable. it's checked again as data
+    # comes, or a consumer can skip `UploadReq()` to get around it
+    if fsz > 200 * 1024 * 1024:  # 200 MB at most
+        return "file too large!"
+    if fsz < 2 * 1024:  # 2 KB at least
+        return "file too small!"
+    files_dir = os.path.abspath("chat-server-files")
+    room_dir = os.path.abspath(os.path.join(files_dir, str(room_id)))
+    if os.path.dirname(room_dir) != files_dir:
+        return "bad room!"
+    # hidden names are taken by partial files
+    if not fn or os.path.basename(fn) != fn or fn.startswith("."):
+        return "bad file name!"
+    return None
+
+
 class Chatter:
     """
     Server side chatter object
@@ -43,59 +247,152 @@ class Chatter:
         "Say",
         "UploadReq",
         "RecvFile",
+        "BlockSums",
+        "RecvDelta",
         "ListFiles",
         "SendFile",
+        "HistoryBefore",
+        "Features",
+        "ListRooms",
     ]
 
     def __init__(self, po: PostingEnd, ho: HostingEnd):
         self.po = po
         self.ho = ho
 
-        self.in_room = prepare_room()
+        # all notifications to this chatter go through its outbox
+        self.outbox = Outbox(po)
+        # optional protocol features the consumer declared to support
+        self.features = set()
+        # throttles hot service methods called by this chatter
+        self.rate_limiter = RateLimiter()
+
+        # the lobby is entered by `welcome_chatter()`
+        self.in_room = None
         self.nick = f"Stranger${self.po.remote_addr!s}"
+        # for data connections to attach to this chatter, issued on demand
+        self.data_token = None
+        # upload id -> transfer admitted by `UploadReq()`, ahead of its data
+        self.held_transfers = {}
 
     async def welcome_chatter(self):
-        async with self.po.co() as co:
-            # send welcome notice to new comer
-            welcome_lines = [
-                f"""
+        self.in_room = await prepare_room()
+
+        # send welcome notice to new comer, listing most populated rooms only
+        welcome_lines = [
+            f"""
 @@ Welcome {self.nick!s}, this is chat service at {self.ho.local_addr!s} !
  -
-@@ There're {len(rooms)} room(s) open, and you are in #{self.in_room.room_id!s} now.
+@@ There're {room_index.total_chatters} chatter(s) in {len(room_index)} room(s), and you are in #{self.in_room.room_id!s} now.
 """
-            ]
-            for room_id, room in rooms.items():
-                welcome_lines.append(
-                    f"""  -*-\t{len(room.chatters)!r} chatter(s) in room #{room.room_id!s}"""
-                )
-            welcome_text = "\n".join(str(line) for line in welcome_lines)
-            await co.send_code(
-                f"""
+        ]
+        n_listed = 0
+        for population, room_id in room_index.top(service_config.welcome_top_rooms):
+            welcome_lines.append(
+                f"""  -*-\t{population!r} chatter(s) in room #{room_id!s}"""
+            )
+            n_listed += 1
+        if len(room_index) > n_listed:
+            welcome_lines.append(
+                f"""  -*-\t... and {len(room_index) - n_listed} more room(s)"""
+            )
+        welcome_text = "\n".join(str(line) for line in welcome_lines)
+        self.outbox.notif(
+            f"""
 NickChanged({self.nick!r})
 InRoom({self.in_room.room_id!r})
 ShowNotice({welcome_text!r})
 """
-            )
+        )
 
         # send new comer info to other chatters already in room
-        async def notif_chatter_join(chatter: "Chatter"):
-            assert chatter is not self, "how can that be ?!"
-            await chatter.po.notif(
+        self.in_room.notif_presence(self.nick, True, self)
+
+        # add this chatter into its 1st room
+        self.in_room.enter(self)
+
+    async def ListRooms(self, offset: int = 0, limit: int = 20):
+        co: HoCo = self.ho.co()
+        # transit the hosting conversation to `send` stage a.s.a.p.
+        await co.start_send()
+
+        ril = [
+            [population, room_id]
+            for population, room_id in room_index.top(
+                min(limit, service_config.list_rooms_max), max(0, offset)
+            )
+        ]
+
+        # send back [total-rooms, [[population, room-id], ...]] for peer to land &
+        # receive as obj
+        await co.send_obj(repr([len(room_index), ril]))
+
+    async def Features(self, features: list):
+        # consumers declare optional protocol features they support, by notif
+        self.features = set(str(feature) for feature in features)
+        self.outbox.binary = "msgs-bin" in self.features
+
+        if (
+            "data-conn" in self.features
+            and data_tokens.port is not None
+            and self.data_token is None
+        ):
+            # offer a side connection for file data
+            self.data_token = data_tokens.issue(self)
+            self.outbox.notif(
                 f"""
-ChatterJoined({self.nick!r}, {self.in_room.room_id!r})
+DataConn({self.data_token!r}, {data_tokens.port!r})
 """
             )
 
-        await self.in_room.each_in_room(notif_chatter_join)
+    def transfer(self) -> Transfer:
+        # an upload or download by this chatter over its own wire, to be run as
+        # `async with`
+        return Transfer(transfer_scheduler, self, self.po)
 
-        # add this chatter into its 1st room
-        self.in_room.chatters.add(self)
+    def hold_transfer(self, upload_id: str, xfer: Transfer):
+        # an upload admitted ahead of its data, released if that doesn't come in time
+        self.held_transfers[upload_id] = xfer
+        asyncio.get_running_loop().call_later(
+            service_config.transfer_hold, self._expire_held, upload_id, xfer
+        )
+
+    def _expire_held(self, upload_id: str, xfer: Transfer):
+        if self.held_transfers.get(upload_id, None) is xfer:
+            del self.held_transfers[upload_id]
+            xfer.release()
+
+    def held_transfer(self, upload_id: str = None) -> Transfer:
+        # the upload admitted by `UploadReq()`, or a new one to be admitted
+        xfer = None
+        if upload_id is not None:
+            xfer = self.held_transfers.pop(str(upload_id), None)
+        if xfer is None:
+            xfer = self.transfer()
+        return xfer
+
+    def release_held(self):
+        # on disconnection
+        for xfer in self.held_transfers.values():
+            xfer.release()
+        self.held_transfers.clear()
+
+    def codecs(self) -> list:
+        # compression codecs of file data, supported by both sides
+        if not service_config.compression:
+            return []
+        return sorted(codec for codec in CODECS if codec in self.features)
 
     async def SetNick(self, nick: str):
         co: HoCo = self.ho.co()
         # transit the hosting conversation to `send` stage a.s.a.p.
         await co.start_send()
 
+        if not await self.rate_limiter.admit("SetNick", self.in_room.room_id):
+            # peer expects a nick back anyway, the unchanged one
+            await co.send_obj(repr(self.nick))
+            return
+
         # note: the nick can be moderated here
         self.nick = str(nick).strip() or f"Anonymous@{self.po.remote_addr!s}"
 
@@ -107,53 +404,45 @@ ChatterJoined({self.nick!r}, {self.in_room.room_id!r})
         # transit the hosting conversation to `send` stage a.s.a.p.
         await co.start_send()
 
+        # normalized as by prepare_room(), for limits of the room to apply
+        room_id = room_name(str(room_id).strip())
+        if not await self.rate_limiter.admit("GotoRoom", room_id):
+            notice = f"@@ Too many room changes, still in #{self.in_room.room_id!s}."
+            self.outbox.notif(
+                f"""
+ShowNotice({notice!r})
+"""
+            )
+            return
+
+        new_room = await prepare_room(room_id)
         old_room = self.in_room
-        new_room = prepare_room(str(room_id).strip())
 
         # leave old room, enter new room
-        old_room.chatters.discard(self)
-        new_room.chatters.add(self)
+        old_room.leave(self)
+        new_room.enter(self)
         # change record state
         self.in_room = new_room
 
         welcome_lines = [
             f"""
-@@ You are in #{new_room.room_id!s} now, {len(new_room.chatters)} chatter(s).
+@@ You are in #{new_room.room_id!s} now, {new_room.population()} chatter(s).
 """
         ]
 
-        # send feedback
-        room_msgs = new_room.recent_msg_log()
+        # send feedback through the outbox, so it's ordered after notifications
+        # already pending from the old room
         welcome_text = "\n".join(str(line) for line in welcome_lines)
-        await co.send_code(
+        self.outbox.notif(
             f"""
 InRoom({new_room.room_id!r})
 ShowNotice({welcome_text!r})
-RoomMsgs({room_msgs!r})
 """
         )
+        new_room.notif_recent_msgs(self)
 
-        async def notif_chatter_leave(chatter: "Chatter"):
-            if chatter is self:
-                return  # may occur under frequent room changes like being spammed
-            await chatter.po.notif(
-                f"""
-ChatterLeft({self.nick!r}, {old_room.room_id!r})
-"""
-            )
-
-        async def notif_chatter_join(chatter: "Chatter"):
-            if chatter is self:
-                return  # may occur under frequent room changes like being spammed
-            await chatter.po.notif(
-                f"""
-ChatterJoined({self.nick!r}, {new_room.room_id!r})
-"""
-            )
-
-        # start new po co to others in new aio tasks to avoid deadlocks
-        asyncio.create_task(old_room.each_in_room(notif_chatter_leave))
-        asyncio.create_task(new_room.each_in_room(notif_chatter_join))
+        old_room.notif_presence(self.nick, False, self)
+        new_room.notif_presence(self.nick, True, self)
 
     # showcase a service method with binary payload, that to be received from
     # current hosting conversation
@@ -171,8 +460,25 @@ ChatterJoined({self.nick!r}, {new_room.room_id!r})
         # transit the hosting conversation to `send` stage a.s.a.p.
         await co.start_send()
 
+        if not await self.rate_limiter.admit("Say", self.in_room.room_id):
+            notice = f"@@ Too many messages, [{msg_id!s}] is not posted."
+            if "not-said" in self.features:
+                # the consumer has the msg pending till told it's not posted
+                await co.send_code(
+                    f"""
+NotSaid({msg_id!r}, {notice!r})
+"""
+                )
+            else:
+                await co.send_code(
+                    f"""
+ShowNotice({notice!r})
+"""
+                )
+            return
+
         # post the msg to current room
-        await self.in_room.post_msg(self, msg)
+        self.in_room.post_msg(self, msg)
 
         # back-script the consumer to notify it about the success-of-display of the message
         await co.send_code(
@@ -181,75 +487,269 @@ Said({msg_id!r})
 """
         )
 
-    async def UploadReq(self, room_id: str, fn: str, fsz: int):
+    async def UploadReq(self, room_id: str, fn: str, fsz: int, digest: str = None):
         co: HoCo = self.ho.co()
-        # transit the hosting conversation to `send` stage a.s.a.p.
-        await co.start_send()
-
-        if fsz > 200 * 1024 * 1024:  # 200 MB at most
-            # send the reason as string, why it's refused
-            await co.send_obj(repr(f"file too large!"))
-            return
-        if fsz < 2 * 1024:  # 2 KB at least
-            # send the reason as string, why it's refused
-            await co.send_obj(repr(f"file too small!"))
-            return
-
-        # None as refuse_reason means the upload is accepted
-        await co.send_obj(None)
-
-    async def RecvFile(self, room_id: str, fn: str, fsz: int):
+        xfer = None
+        if "resumable" in self.features:
+            # admitted before taking the wire to send, so the consumer is told to
+            # stream data only when it won't wait on the wire
+            xfer = self.transfer()
+            await xfer.admit()
+        try:
+            # transit the hosting conversation to `send` stage a.s.a.p.
+            await co.start_send()
+
+            if not await self.rate_limiter.admit("UploadReq", room_id):
+                # send the reason as string, why it's refused
+                await co.send_obj(repr(f"too many uploads, retry later!"))
+                return
+
+            refuse_reason = upload_refusal(room_id, fn, fsz)
+            if refuse_reason is not None:
+                # send the reason as string, why it's refused
+                await co.send_obj(repr(refuse_reason))
+                return
+
+            fpth = os.path.abspath(os.path.join("chat-server-files", room_id, fn))
+            if digest is not None:
+                # the consumer tells sha256 of the file, no data needs to be sent if
+                # it's in the room already, e.g. under another name
+                f, s = (None, None)
+                if await link_blob(str(digest), fsz, fpth) is not None:
+                    f, s = await open_download(fpth)
+                if f is not None:
+                    try:
+                        chksum = await file_crc(fpth, f.fileno(), s)
+                    finally:
+                        f.close()
+                    file_index.update(fpth, s, chksum)
+                    hot_files.discard(fpth)
+                    # all data there as if received, i.e. [None, fsz, crc32-of-all]
+                    await co.send_obj(repr([None, fsz, chksum]))
+                    self.announce_upload(fn, fsz, chksum)
+                    return
+
+            if "resumable" not in self.features:
+                # None as refuse_reason means the upload is accepted
+                await co.send_obj(None)
+                return
+
+            # tell how much has been received by an interrupted upload, i.e.
+            # [refuse-reason, offset, crc32-before-offset, codecs, upload-id], for the
+            # consumer to resume from, and compress data with one of the codecs if it
+            # likes, the data goes to a partial file private to the upload id
+            upload_id, offset, chksum = await upload_status(fpth, fsz)
+            # held for its `RecvFile()` or `RecvDelta()`
+            self.hold_transfer(upload_id, xfer)
+            xfer = None
+            await co.send_obj(repr([None, offset, chksum, self.codecs(), upload_id]))
+        finally:
+            if xfer is not None:
+                # refused, or no data to be sent
+                xfer.release()
+
+    async def RecvFile(
+        self,
+        room_id: str,
+        fn: str,
+        fsz: int,
+        offset: int = 0,
+        block_size: int = None,
+        sums: list = None,
+        codec: str = None,
+        upload_id: str = None,
+    ):
         co: HoCo = self.ho.co()
 
-        # TODO in a real world application, the same validation rules as in UploadReq()
-        # should be checked again, or it's a security hole that a consumer can exploit.
-
+        refuse_reason = upload_refusal(room_id, fn, fsz)
         room_dir = os.path.abspath(f"chat-server-files/{room_id}")
-        os.makedirs(room_dir, exist_ok=True)
-
         fpth = os.path.join(room_dir, fn)
-        try:
-            # unlink the file before creating a new one, so if someone has opened it for
-            # download, that can finish normally.
-            os.unlink(fpth)
-        except FileNotFoundError:
-            pass
-        f = open(fpth, "wb")
-
-        # prepare to recv file data from beginning, calculate chksum by the way
-        chksum = 0
-
-        try:
-
-            def stream_file_data():  # a generator function is ideal for binary data streaming
-                nonlocal chksum  # this is needed outer side, write to that var
-
-                # receive 1 KB at most at a time
-                buf = bytearray(1024)
+        # the upload is admitted by `UploadReq()` already, or waits to be, then its
+        # data goes chunk by chunk in turns with other transfers
+        async with self.held_transfer(upload_id) as xfer:
+            if upload_id is None:
+                # not told by `UploadReq()`, the upload can not be resumed
+                upload_id = secrets.token_hex(8) if offset == 0 else ""
+            if refuse_reason is not None:
+                logger.warning(f"Upload of [{fpth}] refused: {refuse_reason}")
+                f, chksum = None, None
+            else:
+                # all blocking file I/O goes to the I/O executor
+                f, chksum = await open_partial(fpth, fsz, str(upload_id), offset)
+            if f is None:
+                # can not resume from the offset, data on the wire is to be discarded,
+                # and None sent back as chksum
+                f = await run_io(open, os.devnull, "wb")
+
+            # prepare to recv file data from offset, calculate chksum and sha256 by the
+            # way, the data is to be stored as a blob named by the latter
+            hasher = await run_io(
+                sha256_upto, f.fileno(), offset if chksum is not None else 0
+            )
+            if sums is not None and chksum is not None:
+                # with block sums of the file told, check blocks as data streams in
+                hasher = BlockVerifier(block_size, sums, hasher, offset, chksum)
+            # keep data of a small file in memory as received, for downloads likely to
+            # follow its announcement
+            keep = None
+            if offset == 0 and chksum is not None and hot_files.cacheable(fsz):
+                keep = bytearray()
+            fs = FileStream(
+                f,
+                fsz - offset,
+                service_config.chunk_initial,
+                service_config.chunk_max,
+                chksum or 0,
+                hasher,
+                keep,
+            )
 
-                bytes_remain = fsz
-                while bytes_remain > 0:
+            try:
+                # receive data stream from client, a generator is ideal for binary data
+                # streaming
+                if codec is None:
+                    await recv_bufs(co, fs.recv_chunks(), xfer.turn)
+                else:
+                    # compressed by the consumer, with a codec told by `UploadReq()`
+                    if codec not in self.codecs():
+                        raise ValueError(f"Codec not negotiated: {codec!r}")
+                    await recv_bufs(co, fs.recv_frames(codec), xfer.turn)
+                    service_stats["upload_raw_bytes"] += fsz - offset
+                    service_stats["upload_wire_bytes"] += fs.wire_bytes
+                assert fs.bytes_remain == 0, "?!"
+                digest = hasher.hexdigest()
+            except BaseException as exc:
+                if chksum is None:
+                    closing = close_file(f)
+                elif "resumable" not in self.features:
+                    # the consumer won't resume it, nothing to keep
+                    closing = discard_partial(f, fpth, upload_id)
+                else:
+                    # record what's received, for the upload to be resumed
+                    received, received_chksum = fsz - fs.bytes_remain, fs.chksum
+                    if isinstance(hasher, BlockVerifier):
+                        # or what's verified, if a block is found corrupted
+                        received, received_chksum = (
+                            hasher.verified,
+                            hasher.verified_chksum,
+                        )
+                    if isinstance(exc, ValueError):
+                        service_stats["upload_blocks_corrupted"] += 1
+                    closing = save_partial(
+                        f, fpth, fsz, upload_id, received, received_chksum
+                    )
+                # this task may be being cancelled, the record is not to be lost by
+                # a further cancellation
+                await asyncio.shield(closing)
+                raise
+            await close_file(f)
+
+            if chksum is not None:
+                chksum = fs.chksum
+                s = await finish_partial(fpth, fsz, upload_id, digest)
+                # downloads of this file will use the checksum as is
+                cache_crc(fpth, s, chksum)
+                file_index.update(fpth, s, chksum)
+                if keep is not None:
+                    hot_files.put(fpth, s, keep, chksum)
+                else:
+                    hot_files.discard(fpth)
 
-                    if len(buf) > bytes_remain:
-                        buf = buf[:bytes_remain]
+        # transit the hosting conversation to `send` stage a.s.a.p.
+        await co.start_send()
 
-                    yield buf  # yield it so as to be streamed from client
+        # send back chksum for client to verify
+        await co.send_obj(repr(chksum))
 
-                    f.write(buf)  # write received data to file
+        # close the hosting conversation a.s.a.p.
+        await co.close()
 
-                    bytes_remain -= len(buf)
+        if chksum is None:
+            return  # nothing uploaded
 
-                    chksum = crc32(buf, chksum)  # update chksum
+        self.announce_upload(fn, fsz, chksum)
 
-                    # time.sleep(0.01)  # simulate slow uploading
+    async def BlockSums(self, room_id: str, fn: str):
+        co: HoCo = self.ho.co()
+        # transit the hosting conversation to `send` stage a.s.a.p.
+        await co.start_send()
 
-                assert bytes_remain == 0, "?!"
+        # send [content-id, block-size, [(adler32, blake2b), ...]] of the file, for a
+        # changed version to be uploaded as delta against it, or None if no such file
+        fpth = os.path.abspath(os.path.join("chat-server-files", room_id, fn))
+        manifest = await block_manifest(fpth)
+        await co.send_obj(repr(manifest))
+
+    async def RecvDelta(
+        self,
+        room_id: str,
+        fn: str,
+        fsz: int,
+        base_id: list,
+        block_size: int,
+        ops: list,
+        sums: list,
+        upload_id: str = None,
+    ):
+        co: HoCo = self.ho.co()
 
-            # receive data stream from client
-            await co.recv_data(stream_file_data())
+        refuse_reason = upload_refusal(room_id, fn, fsz)
+        room_dir = os.path.abspath(f"chat-server-files/{room_id}")
+        fpth = os.path.join(room_dir, fn)
+        # the file must still be the version the delta is against
+        # the upload is admitted by `UploadReq()` already, or waits to be, then its
+        # data goes chunk by chunk in turns with other transfers
+        async with self.held_transfer(upload_id) as xfer:
+            base_f, s = None, None
+            if refuse_reason is not None:
+                logger.warning(f"Upload of [{fpth}] refused: {refuse_reason}")
+            else:
+                base_f, s = await open_download(fpth)
+            if base_f is not None and list(content_id(s)) != list(base_id):
+                base_f.close()
+                base_f = None
+            # a delta is not resumable, its partial file is private to this upload
+            upload_id = secrets.token_hex(8)
+            f = None
+            if base_f is not None:
+                f, _ = await open_partial(fpth, fsz, upload_id)
+            if f is None:
+                # data on the wire is to be discarded, and None sent back as chksum
+                f, base_fd, hasher = await run_io(open, os.devnull, "wb"), None, None
+            else:
+                base_fd = base_f.fileno()
+                hasher = BlockVerifier(block_size, sums, hashlib.sha256())
+            ds = DeltaStream(f, base_fd, block_size, ops, hasher)
 
-        finally:
-            f.close()
+            try:
+                # receive literal data from client, blocks are copied in between
+                await recv_bufs(co, ds.recv_chunks(), xfer.turn)
+                if hasher is not None:
+                    digest = hasher.hexdigest()
+            except BaseException as exc:
+                if isinstance(exc, ValueError):
+                    service_stats["upload_blocks_corrupted"] += 1
+                await asyncio.shield(
+                    close_file(f)
+                    if hasher is None
+                    else discard_partial(f, fpth, upload_id)
+                )
+                raise
+            finally:
+                if base_f is not None:
+                    base_f.close()
+            await close_file(f)
+
+            chksum = None
+            if hasher is not None:
+                chksum = ds.chksum
+                s = await finish_partial(fpth, fsz, upload_id, digest)
+                # downloads of this file will use the checksum as is
+                cache_crc(fpth, s, chksum)
+                file_index.update(fpth, s, chksum)
+                hot_files.discard(fpth)
+                service_stats["delta_bytes_sent"] += ds.literal_bytes()
+                service_stats["delta_bytes_saved"] += fsz - ds.literal_bytes()
 
         # transit the hosting conversation to `send` stage a.s.a.p.
         await co.start_send()
@@ -260,85 +760,295 @@ Said({msg_id!r})
         # close the hosting conversation a.s.a.p.
         await co.close()
 
-        # announce this new upload
-        await self.in_room.post_msg(
+        if chksum is None:
+            return  # nothing uploaded
+
+        self.announce_upload(fn, fsz, chksum)
+
+    def announce_upload(self, fn: str, fsz: int, chksum: int):
+        self.in_room.post_msg(
             self,
             rf"""
  @*@ I just uploaded a file {chksum:x} {int(math.ceil(fsz / 1024))} KB [{fn}]
 """,
         )
 
-    async def ListFiles(self, room_id: str):
+    async def ListFiles(
+        self,
+        room_id: str,
+        offset: int = None,
+        limit: int = 20,
+        sort: str = "name",
+        prefix: str = "",
+    ):
         co: HoCo = self.ho.co()
         # transit the hosting conversation to `send` stage a.s.a.p.
         await co.start_send()
 
         room_dir = os.path.abspath(f"chat-server-files/{room_id}")
-        if not os.path.isdir(room_dir):
-            logger.info(f"Making room dir [{room_dir}] ...")
-            os.makedirs(room_dir, exist_ok=True)
-
-        fil = []
-        for fn in os.listdir(room_dir):
-            if fn[0] in ".~!?*":
-                continue  # ignore strange file names
+        files = await file_index.room_files(room_dir)
+
+        if offset is None:
+            # send back [[size, name], ...] of all files, for peers not paging
+            fil = [[fsz, fn] for fsz, fn, *_ in files.view("name")]
+            await co.send_obj(repr(fil))
+            return
+
+        if sort.lstrip("-") not in FILE_SORTS:
+            sort = "name"
+        total, fil = files.listing(
+            max(0, offset),
+            max(0, min(limit, service_config.list_files_max)),
+            sort,
+            str(prefix),
+        )
+
+        # send back [total-matched, [[size, name, mtime, crc32-or-None], ...]] for peer
+        # to land & receive as obj
+        await co.send_obj(repr([total, fil]))
+
+    async def SendFile(
+        self,
+        room_id: str,
+        fn: str,
+        offset: int = None,
+        length: int = None,
+        crc_from: int = 0,
+        codec: str = None,
+    ):
+        co: HoCo = self.ho.co()
+
+        fpth = os.path.abspath(os.path.join("chat-server-files", room_id, fn))
+        # wait for the download to be admitted, before taking the wire to send, then
+        # its data goes chunk by chunk in turns with other transfers
+        async with self.transfer() as xfer:
+            # transit the hosting conversation to `send` stage a.s.a.p.
+            await co.start_send()
+
+            # small files recently transferred are served from memory, with one buffer
+            # shared by concurrent downloads
+            hot = await hot_files.lookup(fpth)
+            if hot is not None:
+                f, s = None, hot.st
+            else:
+                f, s = await open_download(fpth)
+            if s is None:
+                # send negative file size, meaning download refused
+                await co.send_obj(repr([-1, f"no such file"]))
+                return
+
             try:
-                s = os.stat(os.path.join(room_dir, fn))
-            except OSError:
-                pass
-            fil.append([s.st_size, fn])
+                # get file data size
+                fsz = s.st_size
+                msg = "last modified: " + datetime.fromtimestamp(s.st_mtime).strftime(
+                    "%F %T"
+                )
 
-        # send back repr for peer to land & receive as obj
-        await co.send_obj(repr(fil))
+                if offset is None and codec is None:
+                    # send [file-size, msg] to peer, telling it the data size to receive
+                    # and last modification time of the file.
+                    start, end = 0, fsz
+                    await co.send_obj(repr([fsz, msg]))
+                else:
+                    # a ranged download, to resume an interrupted one, or with data to
+                    # be compressed if the codec asked for is supported, send
+                    # [range-size, msg, file-size, codec-or-None, content-id,
+                    # crc32-of-file-or-None] to peer, for ranges downloaded in parallel
+                    # to be checked as of the same version, and the whole file as
+                    # assembled
+                    start = max(0, min(int(offset or 0), fsz))
+                    end = (
+                        fsz if length is None else max(start, min(start + length, fsz))
+                    )
+                    if codec not in self.codecs():
+                        codec = None
+                    if hot is not None:
+                        file_chksum = hot.chksum
+                    elif end > start:
+                        file_chksum = cached_crc(fpth, s)
+                    else:
+                        # probing the file, compute it if not cached
+                        file_chksum = await file_crc(fpth, f.fileno(), s)
+                    await co.send_obj(
+                        repr([end - start, msg, fsz, codec, content_id(s), file_chksum])
+                    )
+                    if f is not None:
+                        f.seek(start)
+
+                crc_start = max(0, min(int(crc_from), start))
+                if hot is not None:
+                    chksum = await hot_files.send(
+                        co, xfer, hot, start, end, crc_start, codec
+                    )
+                else:
+                    # data is sent without being touched here, the checksum of data
+                    # from `crc_from` till range end comes from cache, or gets computed
+                    # off the event loop meanwhile
+                    crc_task = asyncio.ensure_future(
+                        range_crc(fpth, f.fileno(), s, end, crc_start)
+                    )
+                    try:
+                        fs = FileStream(
+                            f,
+                            end - start,
+                            service_config.chunk_initial,
+                            service_config.chunk_max,
+                        )
+                        if codec is not None:
+                            # compress file data as read ahead
+                            await send_bufs(co, fs.send_frames(codec), xfer.turn)
+                            assert fs.bytes_remain == 0, "?!"
+                            service_stats["download_raw_bytes"] += end - start
+                            service_stats["download_wire_bytes"] += fs.wire_bytes
+                        else:
+                            # or stream file data from the file mmap'ed, no copy made
+                            # till it's written to the wire
+                            await send_bufs(co, fs.mapped_chunks(), xfer.turn)
+                            assert fs.bytes_remain == 0, "?!"
+                            service_stats["mmap_bytes"] += end - start
+                        chksum = await crc_task
+                    finally:
+                        if not crc_task.done():
+                            # a thread of the I/O executor can't be interrupted, let it
+                            # finish before the file gets closed under it, the crc32 is
+                            # cached anyway if that's of the whole file
+                            await asyncio.wait([crc_task])
+                if crc_start == 0 and end == fsz:
+                    file_index.learn_crc(fpth, s, chksum)
+            finally:
+                if f is not None:
+                    f.close()
+
+        # send chksum at last, of all data till range end for a ranged download by
+        # default, so the peer verifies what it already has as well, or of the range
+        # only with `crc_from=offset`, for ranges downloaded in parallel
+        await co.send_obj(repr(chksum))
 
-    async def SendFile(self, room_id: str, fn: str):
+    async def HistoryBefore(
+        self, room_id: str, before_seq: int = None, limit: int = 10
+    ):
         co: HoCo = self.ho.co()
         # transit the hosting conversation to `send` stage a.s.a.p.
         await co.start_send()
 
-        fpth = os.path.abspath(os.path.join("chat-server-files", room_id, fn))
-        if not os.path.exists(fpth) or not os.path.isfile(fpth):
-            # send negative file size, meaning download refused
-            await co.send_obj(repr([-1, f"no such file"]))
-            return
+        # only rooms with history here are paged, others are not to be created for it
+        room_id = room_name(str(room_id).strip())
+        if (
+            room_id in hibernated_rooms
+            or room_id in draining_rooms
+            or room_id in opening_rooms
+        ):
+            room = await prepare_room(room_id)
+        else:
+            room = rooms.get(room_id, None)
+        if room is None:
+            first_seq, msgs = 0, []
+        else:
+            first_seq, msgs = await room.history_before(
+                before_seq, min(limit, service_config.history_page_max)
+            )
 
-        s = os.stat(fpth)
+        # send back [first-seq, msgs] for peer to land & receive as obj, the peer passes
+        # first-seq as `before_seq` to get the page before this one
+        room_msgs = MsgsInRoom(room_id, msgs)
+        if "msgs-bin" not in self.features:
+            await co.send_obj(repr([first_seq, room_msgs]))
+            return
 
-        with open(fpth, "rb") as f:
-            # get file data size
-            f.seek(0, 2)
-            fsz = f.tell()
+        # or [first-seq, n-bytes] followed by the msgs binary encoded as data
+        payload = room_msgs.to_bin()
+        await co.send_obj(repr([first_seq, len(payload)]))
+        await co.send_data(payload)
 
-            # send [file-size, msg] to peer, telling it the data size to receive and last
-            # modification time of the file.
-            msg = "last modified: " + datetime.fromtimestamp(s.st_mtime).strftime(
-                "%F %T"
-            )
-            await co.send_obj(repr([fsz, msg]))
 
-            # prepare to send file data from beginning, calculate checksum by the way
-            f.seek(0, 0)
-            chksum = 0
+class DataChatter:
+    """
+    Server side end of a data connection, attached to a chatter by a token
 
-            def stream_file_data():  # a generator function is ideal for binary data streaming
-                nonlocal chksum  # this is needed outer side, write to that var
+    File transfers of the chatter run here, with data streamed over this connection,
+    and notifications kept going through the chatter's own connection.
 
-                # nothing prevents the file from growing as we're sending, we only send
-                # as much as glanced above, so count remaining bytes down,
-                # send one 1-KB-chunk at max at a time.
-                bytes_remain = fsz
-                while bytes_remain > 0:
-                    chunk = f.read(min(1024, bytes_remain))
-                    assert len(chunk) > 0, "file shrunk !?!"
-                    bytes_remain -= len(chunk)
+    """
 
-                    yield chunk  # yield it so as to be streamed to client
-                    chksum = crc32(chunk, chksum)  # update chksum
+    # name of artifacts to be exposed for peer scripting
+    names_to_expose = [
+        "AttachData",
+        "RecvFile",
+        "RecvDelta",
+        "SendFile",
+    ]
 
-                assert bytes_remain == 0, "?!"
+    def __init__(self, po: PostingEnd, ho: HostingEnd):
+        self.po = po
+        self.ho = ho
 
-            # stream file data to consumer end
-            await co.send_data(stream_file_data())
+        self.chatter = None
+        self.token = None
+        # a connection not attached in time is disconnected
+        self.attach_timer = asyncio.get_running_loop().call_later(
+            service_config.data_attach_timeout, self._attach_timeout
+        )
 
-        # send chksum at last
-        await co.send_obj(repr(chksum))
+    def _attach_timeout(self):
+        self.attach_timer = None
+        if self.chatter is not None or not self.po.is_connected():
+            return
+        logger.warning(
+            f"Disconnecting data connection {self.po.remote_addr!s} not attached."
+        )
+        service_stats["data_conns_timed_out"] += 1
+        asyncio.create_task(self.po.disconnect("data connection not attached"))
+
+    async def AttachData(self, token: str):
+        # consumers attach by notif, right after connected
+        if self.attach_timer is None:
+            return  # timed out
+        self.attach_timer.cancel()
+        self.attach_timer = None
+        chatter = data_tokens.attach(str(token), self.po)
+        if chatter is None:
+            logger.warning(
+                f"Refusing data connection {self.po.remote_addr!s} with invalid token."
+            )
+            asyncio.create_task(self.po.disconnect("invalid data token"))
+            return
+        self.chatter, self.token = chatter, token
+
+    def detach(self):
+        if self.attach_timer is not None:
+            self.attach_timer.cancel()
+            self.attach_timer = None
+        if self.token is not None:
+            data_tokens.detach(self.token, self.po)
+            self.chatter = self.token = None
+
+    def transfer(self) -> Transfer:
+        if self.chatter is None:
+            raise RuntimeError("Data connection not attached.")
+        # scheduled as the chatter's own transfer, but with data over this wire, not
+        # held by notifications to the chatter
+        xfer = self.chatter.transfer()
+        xfer.wire = self.po
+        return xfer
+
+    def held_transfer(self, upload_id: str = None) -> Transfer:
+        if self.chatter is None:
+            raise RuntimeError("Data connection not attached.")
+        xfer = self.chatter.held_transfer(upload_id)
+        xfer.wire = self.po
+        return xfer
+
+    @property
+    def features(self) -> set:
+        return self.chatter.features
+
+    def codecs(self) -> list:
+        return self.chatter.codecs()
+
+    def announce_upload(self, fn: str, fsz: int, chksum: int):
+        self.chatter.announce_upload(fn, fsz, chksum)
+
+    # service methods of file transfers, run with the hosting end of this connection
+    RecvFile = Chatter.RecvFile
+    RecvDelta = Chatter.RecvDelta
+    SendFile = Chatter.SendFile
@@ -0,0 +1,125 @@
+"""
+Tunables of the chatting service.
+
+"""
+
+__all__ = ["ServiceConfig", "service_config"]
+
+
+class ServiceConfig:
+    """
+    Service wide tunables
+
+    Defaults here suit a demo box, `hbichat.cmd.server` overrides them from command line.
+
+    """
+
+    def __init__(self):
+        # max number of notifications pending delivery to a single consumer
+        self.outbox_max_pending = 1000
+        # what to do when an outbox overflows, one of `OVERFLOW_POLICIES`
+        self.outbox_overflow = "coalesce"
+        # a consumer lagging behind by this many bytes of coalesced notifications
+        # is considered hopeless, and disconnected
+        self.outbox_max_coalesced = 8 * 1024 * 1024
+
+        # room messages posted within this many seconds go out to a consumer as a
+        # single notification
+        self.coalesce_window = 0.005
+        # but a batch is sent out as soon as it has this many messages
+        self.coalesce_msgs = 50
+
+        # room msgs are logged under this dir, a sub dir per room
+        self.log_dir = "chat-server-logs"
+        # a room log segment is rolled over once it grows beyond this size
+        self.log_segment_bytes = 4 * 1024 * 1024
+        # every this many records of a log segment get their file offsets indexed
+        self.log_index_interval = 64
+        # number of recent msgs per room kept in memory
+        self.room_hist_msgs = 10
+        # max number of msgs to serve per page of history
+        self.history_page_max = 100
+
+        # empty rooms without activity for this many seconds are hibernated, i.e.
+        # dropped from memory, to be rehydrated from their logs on demand
+        self.room_idle_ttl = 300.0
+        # empty rooms are hibernated in LRU order to keep at most this many resident
+        self.max_resident_rooms = 10000
+
+        # presence changes of a room within this many seconds go out as one delta
+        self.presence_window = 0.05
+        # no presence notifications for rooms with more chatters than this
+        self.presence_max_occupancy = 500
+
+        # file data is streamed in chunks of this many bytes initially, growing up to
+        # `chunk_max` while throughput keeps improving
+        self.chunk_initial = 64 * 1024
+        self.chunk_max = 1024 * 1024
+        # number of threads doing blocking file I/O
+        self.io_threads = 4
+        # compress file data streams with codecs consumers support
+        self.compression = True
+        # number of files to cache crc32 of
+        self.crc_cache_size = 10000
+        # files are checksummed by blocks of this size, for changed versions to be
+        # uploaded as delta, and corrupted uploads to be detected early
+        self.block_size = 64 * 1024
+        # max number of file transfers in progress, service wide and per chatter,
+        # more are queued in FIFO order
+        self.max_transfers = 16
+        self.max_transfers_per_chatter = 2
+        # bandwidth shared by file transfers in bytes per second, 0 for unlimited
+        self.transfer_rate = 0
+        # data of file transfers waits at most this many seconds per chunk, for
+        # notifications being written to the same wire
+        self.transfer_chat_defer = 0.05
+        # an upload admitted on request is held this many seconds at most, for its
+        # data to come
+        self.transfer_hold = 30.0
+        # serve side connections for file data, offered to consumers supporting them
+        self.data_conns = True
+        # port data connections are served on, worker `i` on `data_port + i`, 0 to pick
+        # a free port
+        self.data_port = 0
+        # a data connection is disconnected if not attached in this many seconds
+        self.data_attach_timeout = 5.0
+        # contents of files recently uploaded or downloaded are cached in memory, up to
+        # this many bytes in all, for files of `hot_file_max` bytes at most
+        self.hot_cache_bytes = 64 * 1024 * 1024
+        self.hot_file_max = 4 * 1024 * 1024
+        # number of room dirs to keep file indices of
+        self.file_index_rooms = 1000
+        # max number of files to list per page
+        self.list_files_max = 100
+        # data of uploaded files is stored once under this dir, as blobs named by
+        # sha256, room files are hard links to them, so it should be on the same file
+        # system as room dirs
+        self.blob_dir = "chat-server-files/.blobs"
+        # blobs no longer linked by any room file are collected every this many seconds
+        self.blob_gc_interval = 600.0
+        # partial files of uploads interrupted this many seconds ago are swept, every
+        # `partial_gc_interval` seconds, 0 to keep them
+        self.partial_max_age = 86400.0
+        self.partial_gc_interval = 3600.0
+
+        # token bucket limits of hot service methods, per chatter, as
+        # `method -> (calls per second, burst)`, a rate of 0 means unlimited
+        self.rate_limits = {
+            "Say": (50.0, 200),
+            "GotoRoom": (50.0, 200),
+            "SetNick": (50.0, 200),
+            "UploadReq": (10.0, 50),
+        }
+        # per room overrides, as `room_id -> {method: (calls per second, burst)}`
+        self.room_rate_limits = {}
+        # a call over limit is delayed if it can be admitted within this many seconds,
+        # or rejected
+        self.rate_limit_max_delay = 1.0
+
+        # number of most populated rooms listed in the welcome notice
+        self.welcome_top_rooms = 10
+        # max number of rooms to list per page
+        self.list_rooms_max = 100
+
+
+service_config = ServiceConfig()
@@ -0,0 +1,70 @@
+"""
+Side connections for file data.
+
+Bulk data of file transfers going through the HBI wire of a chatter would delay
+notifications queued behind it on the same socket. A consumer declaring the
+`data-conn` feature is offered a token, and the port data connections are served on,
+by a `DataConn()` notification. It dials there and attaches the new connection to its
+session with the token, then runs file transfers over it, keeping its own connection
+low latency for chatting.
+
+"""
+import asyncio
+import secrets
+
+from .stats import *
+
+__all__ = ["DataTokens", "data_tokens"]
+
+
+class DataTokens:
+    """
+    Tokens issued to chatters, for data connections to attach to them
+
+    A token is valid as long as the chatter stays connected, data connections attached
+    with it are disconnected once it's revoked.
+
+    """
+
+    def __init__(self):
+        # port data connections are served on by this process, None if not served
+        self.port = None
+        self.chatters = {}  # token -> chatter
+        self.attached = {}  # token -> {posting end of data connection}
+
+    def issue(self, chatter) -> str:
+        token = secrets.token_urlsafe(24)
+        self.chatters[token] = chatter
+        service_stats["data_tokens_issued"] += 1
+        return token
+
+    def attach(self, token: str, po):
+        """
+        Attach a data connection by its posting end, return the chatter the token is
+        issued to, or None if it's not valid.
+
+        """
+        chatter = self.chatters.get(token, None)
+        if chatter is None:
+            service_stats["data_conns_refused"] += 1
+            return None
+        self.attached.setdefault(token, set()).add(po)
+        service_stats["data_conns_attached"] += 1
+        return chatter
+
+    def detach(self, token: str, po):
+        attached = self.attached.get(token, None)
+        if attached is None:
+            return
+        attached.discard(po)
+        if not attached:
+            del self.attached[token]
+
+    def revoke(self, token: str):
+        self.chatters.pop(token, None)
+        for po in self.attached.pop(token, ()):
+            if po.is_connected():
+                asyncio.create_task(po.disconnect("chatter gone"))
+
+
+data_tokens = DataTokens()
@@ -0,0 +1,173 @@
+"""
+In-memory index of files shared in rooms.
+
+"""
+import os
+from collections import OrderedDict
+
+from ..xfer import *
+from .config import *
+from .stats import *
+
+__all__ = ["RoomFiles", "FileIndex", "file_index", "FILE_SORTS"]
+
+# keys files can be listed by, each ascending, or descending with a leading "-"
+FILE_SORTS = {
+    "name": lambda e: e[1],
+    "size": lambda e: (e[0], e[1]),
+    "mtime": lambda e: (e[2], e[1]),
+}
+
+
+def _shown(fn: str) -> bool:
+    return fn[0] not in ".~!?*"  # strange file names are ignored
+
+
+class RoomFiles:
+    """
+    Files in a room dir, as `name -> [size, name, mtime, chksum]`, with `chksum` the
+    crc32 if known, else None
+
+    Sorted views are built on demand, and kept until the files change.
+
+    """
+
+    __slots__ = ("room_dir", "dir_mtime", "entries", "views")
+
+    def __init__(self, room_dir: str):
+        self.room_dir = room_dir
+        self.dir_mtime = None
+        self.entries = {}
+        self.views = {}  # sort key -> sorted entries
+
+    def scan(self, known: dict):
+        """
+        Build entries of the dir, with checksums of unchanged files taken from `known`
+        entries, return `(dir_mtime, entries)` to be `adopt()`ed.
+
+        Blocking, to be run by the I/O executor.
+
+        """
+        if not os.path.isdir(self.room_dir):
+            os.makedirs(self.room_dir, exist_ok=True)
+        dir_mtime = os.stat(self.room_dir).st_mtime_ns
+        entries = {}
+        for entry in os.scandir(self.room_dir):
+            if not _shown(entry.name):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if not entry.is_file():
+                continue
+            # keep the checksum known if the file is unchanged
+            chksum = None
+            old = known.get(entry.name, None)
+            if old is not None and old[::2] == [st.st_size, st.st_mtime]:
+                chksum = old[3]
+            entries[entry.name] = [st.st_size, entry.name, st.st_mtime, chksum]
+        return dir_mtime, entries
+
+    def adopt(self, dir_mtime: int, entries: dict):
+        # take the result of a `scan()`, on the event loop
+        self.entries = entries
+        self.views.clear()
+        self.dir_mtime = dir_mtime
+
+    def stale(self) -> bool:
+        # blocking, to be run by the I/O executor
+        try:
+            return os.stat(self.room_dir).st_mtime_ns != self.dir_mtime
+        except FileNotFoundError:
+            return True
+
+    def update(self, fn: str, st: os.stat_result, chksum: int):
+        if not _shown(fn):
+            return
+        self.entries[fn] = [st.st_size, fn, st.st_mtime, chksum]
+        self.views.clear()
+        # `dir_mtime` is left as is, the dir may have changed otherwise meanwhile, a
+        # rescan keeps the checksum known here
+
+    def view(self, sort: str) -> list:
+        entries = self.views.get(sort, None)
+        if entries is None:
+            key = FILE_SORTS[sort.lstrip("-")]
+            entries = self.views[sort] = sorted(
+                self.entries.values(), key=key, reverse=sort.startswith("-")
+            )
+        return entries
+
+    def listing(self, offset: int, limit: int, sort: str = "name", prefix: str = ""):
+        """
+        Return `(total, entries)` of files named with `prefix`, sorted by `sort`, the
+        page from `offset` on, at most `limit` entries.
+
+        """
+        entries = self.view(sort)
+        if prefix:
+            if sort == "name":
+                # a contiguous range in name order, bisect for its start
+                start, end = 0, len(entries)
+                while start < end:
+                    mid = (start + end) // 2
+                    if entries[mid][1] < prefix:
+                        start = mid + 1
+                    else:
+                        end = mid
+                while end < len(entries) and entries[end][1].startswith(prefix):
+                    end += 1
+                entries = entries[start:end]
+            else:
+                entries = [e for e in entries if e[1].startswith(prefix)]
+        return len(entries), entries[offset : offset + limit]
+
+
+class FileIndex:
+    """
+    Indices of room dirs, at most `service_config.file_index_rooms` kept, in LRU order
+
+    An index is rescanned when its dir's mtime changes, with checksums known through
+    `update()` kept for files unchanged since.
+
+    """
+
+    def __init__(self):
+        self.rooms = OrderedDict()  # room_dir -> RoomFiles
+
+    async def room_files(self, room_dir: str) -> RoomFiles:
+        files = self.rooms.get(room_dir, None)
+        if files is None:
+            files = self.rooms[room_dir] = RoomFiles(room_dir)
+            while len(self.rooms) > service_config.file_index_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room_dir)
+        if files.dir_mtime is None or await run_io(files.stale):
+            service_stats["file_index_scans"] += 1
+            files.adopt(*await run_io(files.scan, dict(files.entries)))
+        else:
+            service_stats["file_index_hits"] += 1
+        return files
+
+    def update(self, fpth: str, st: os.stat_result, chksum: int):
+        # a file just uploaded
+        room_dir, fn = os.path.split(fpth)
+        files = self.rooms.get(room_dir, None)
+        if files is None or files.dir_mtime is None:
+            return  # to be scanned when listed
+        files.update(fn, st, chksum)
+
+    def learn_crc(self, fpth: str, st: os.stat_result, chksum: int):
+        # crc32 of a file computed otherwise, e.g. for download
+        room_dir, fn = os.path.split(fpth)
+        files = self.rooms.get(room_dir, None)
+        if files is None:
+            return
+        entry = files.entries.get(fn, None)
+        if entry is not None and entry[::2] == [st.st_size, st.st_mtime]:
+            entry[3] = chksum
+
+
+file_index = FileIndex()
@@ -0,0 +1,405 @@
+"""
+Serving of files shared in rooms.
+
+An upload is received into a hidden partial file `.<name>.<upload-id>.part` next to
+the file, private to the upload, stored as a blob and linked over the file once
+complete, see `.blobs`. If the upload is interrupted, how much of it has been
+received, and the crc32 of that, are saved in a sidecar next to the partial file,
+`.<name>.<upload-id>.part.json`, so the upload can be resumed from there, under the
+same upload id. Interrupted uploads not resumed within `service_config.partial_max_age`
+are swept away.
+
+"""
+import asyncio
+import json
+import os
+import re
+import secrets
+import stat
+import struct
+import time
+from collections import OrderedDict
+
+from ..delta import *
+from ..log import *
+from ..xfer import *
+from .blobs import *
+from .config import *
+from .stats import *
+
+__all__ = [
+    "content_id",
+    "cached_crc",
+    "cache_crc",
+    "file_crc",
+    "upload_status",
+    "open_partial",
+    "save_partial",
+    "discard_partial",
+    "finish_partial",
+    "collect_partials",
+    "collect_partials_periodically",
+    "range_crc",
+    "block_manifest",
+    "open_download",
+    "close_file",
+]
+
+logger = get_logger(__package__)
+
+
+# path -> (identity of file content, crc32), in LRU order, the most recently used last
+_crcs = OrderedDict()
+
+
+def content_id(st: os.stat_result) -> tuple:
+    # a file is considered unchanged as long as these stay the same
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def cached_crc(fpth: str, st: os.stat_result):
+    entry = _crcs.get(fpth, None)
+    if entry is None or entry[0] != content_id(st):
+        return None
+    _crcs.move_to_end(fpth)
+    return entry[1]
+
+
+def cache_crc(fpth: str, st: os.stat_result, chksum: int):
+    _crcs[fpth] = content_id(st), chksum
+    _crcs.move_to_end(fpth)
+    while len(_crcs) > service_config.crc_cache_size:
+        _crcs.popitem(last=False)
+
+
+async def file_crc(fpth: str, fd: int, st: os.stat_result) -> int:
+    """
+    crc32 of a file's data, computed off the event loop on cache miss.
+
+    """
+    chksum = cached_crc(fpth, st)
+    if chksum is not None:
+        service_stats["crc_cache_hits"] += 1
+        return chksum
+    service_stats["crc_cache_misses"] += 1
+    chksum = await run_io(crc_upto, fd, st.st_size)
+    cache_crc(fpth, st, chksum)
+    return chksum
+
+
+async def range_crc(
+    fpth: str, fd: int, st: os.stat_result, end: int, start: int = 0
+) -> int:
+    """
+    crc32 of a file's data in `[start, end)`, from cache if that's the whole file.
+
+    """
+    if start <= 0 and end >= st.st_size:
+        return await file_crc(fpth, fd, st)
+    return await run_io(crc_upto, fd, end, start)
+
+
+# block manifest of a file is cached in a hidden `.<name>.blocks` file, as a head of
+# (inode, size, mtime_ns, block size) of the file, then (adler32, blake2b) per block
+_MANIFEST_HEAD = struct.Struct("<QQQI")
+_MANIFEST_BLOCK = struct.Struct("<I16s")
+
+
+def _block_manifest(fpth: str, block_size: int):
+    f, st = _open_download(fpth)
+    if f is None:
+        return None
+    with f:
+        head = (*content_id(st), block_size)
+        room_dir, fn = os.path.split(fpth)
+        manifest_pth = os.path.join(room_dir, f".{fn}.blocks")
+        try:
+            with open(manifest_pth, "rb") as mf:
+                buf = mf.read()
+            if _MANIFEST_HEAD.unpack_from(buf) == head:
+                sums = list(_MANIFEST_BLOCK.iter_unpack(buf[_MANIFEST_HEAD.size :]))
+                return [list(head[:3]), block_size, sums], True
+        except (OSError, struct.error):
+            pass
+
+        sums = block_sums(f.fileno(), st.st_size, block_size)
+        with open(manifest_pth + "~", "wb") as mf:
+            mf.write(_MANIFEST_HEAD.pack(*head))
+            for weak, strong in sums:
+                mf.write(_MANIFEST_BLOCK.pack(weak, strong))
+        os.replace(manifest_pth + "~", manifest_pth)
+        return [list(head[:3]), block_size, sums], False
+
+
+async def block_manifest(fpth: str):
+    """
+    Block sums of a file, as `[content-id, block-size, [(adler32, blake2b), ...]]`,
+    cached on disk, or None if there's no such file.
+
+    """
+    manifest = await run_io(_block_manifest, fpth, service_config.block_size)
+    if manifest is None:
+        return None
+    manifest, cached = manifest
+    service_stats["manifest_hits" if cached else "manifest_misses"] += 1
+    return manifest
+
+
+# ids of uploads issued by `upload_status()`, as hex digits
+_UPLOAD_ID = re.compile(r"[0-9a-f]{16}")
+
+
+def _partial_paths(fpth: str, upload_id: str):
+    room_dir, fn = os.path.split(fpth)
+    part_pth = os.path.join(room_dir, f".{fn}.{upload_id}.part")
+    return part_pth, part_pth + ".json"
+
+
+def _partial_status(fpth: str, fsz: int, upload_id: str):
+    part_pth, sidecar_pth = _partial_paths(fpth, upload_id)
+    try:
+        with open(sidecar_pth, "r") as f:
+            status = json.load(f)
+        if (
+            status["fsz"] == fsz
+            and 0 <= status["received"] < fsz
+            and os.path.getsize(part_pth) >= status["received"]
+        ):
+            return status["received"], status["chksum"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return 0, 0
+
+
+def _interrupted_uploads(fpth: str):
+    # ids of interrupted uploads to `fpth`, by their sidecars, those being received
+    # have none
+    room_dir, fn = os.path.split(fpth)
+    head, tail = f".{fn}.", ".part.json"
+    try:
+        names = os.listdir(room_dir)
+    except FileNotFoundError:
+        return []
+    upload_ids = []
+    for name in names:
+        if not name.startswith(head) or not name.endswith(tail):
+            continue
+        upload_id = name[len(head) : -len(tail)]
+        if _UPLOAD_ID.fullmatch(upload_id):
+            upload_ids.append(upload_id)
+    return upload_ids
+
+
+def _upload_status(fpth: str, fsz: int):
+    for upload_id in _interrupted_uploads(fpth):
+        received, chksum = _partial_status(fpth, fsz, upload_id)
+        if received > 0:
+            return upload_id, received, chksum
+    return secrets.token_hex(8), 0, 0
+
+
+async def upload_status(fpth: str, fsz: int):
+    """
+    How much of an interrupted upload of `fsz` bytes has been received, return
+    `(upload_id, offset, chksum)`, with `chksum` the crc32 of data before `offset`,
+    and `upload_id` a new one if there's none to be resumed.
+
+    """
+    return await run_io(_upload_status, fpth, fsz)
+
+
+def _open_partial(fpth: str, fsz: int, upload_id: str, offset: int):
+    os.makedirs(os.path.dirname(fpth), exist_ok=True)
+    part_pth, sidecar_pth = _partial_paths(fpth, upload_id)
+    chksum = 0
+    if offset > 0:
+        received, chksum = _partial_status(fpth, fsz, upload_id)
+        if received != offset:
+            return None, None  # can not resume from there
+    try:
+        # removing the sidecar claims an interrupted upload, atomically even among
+        # workers, the partial file is private to this upload since, and fresh not to
+        # be swept by `collect_partials()`
+        if offset > 0:
+            os.utime(part_pth)
+        os.unlink(sidecar_pth)
+    except FileNotFoundError:
+        if offset > 0 or os.path.exists(part_pth):
+            return None, None  # being received by someone else
+    f = open(part_pth, "rb+" if offset > 0 else "wb")
+    f.seek(offset)
+    f.truncate()
+    return f, chksum
+
+
+async def open_partial(fpth: str, fsz: int, upload_id: str, offset: int = 0):
+    """
+    Open the partial file of an upload of `fsz` bytes, positioned at `offset` to resume
+    receiving from, return `(f, chksum)` with `chksum` the crc32 of data before
+    `offset`, or `(None, None)` if the upload can not be resumed from `offset`, or is
+    being received by someone else.
+
+    """
+    if not _UPLOAD_ID.fullmatch(upload_id):
+        return None, None
+    return await run_io(_open_partial, fpth, fsz, upload_id, offset)
+
+
+def _save_partial(f, fpth: str, fsz: int, upload_id: str, received: int, chksum: int):
+    f.close()
+    part_pth, sidecar_pth = _partial_paths(fpth, upload_id)
+    with open(sidecar_pth + "~", "w") as sf:
+        json.dump({"fsz": fsz, "received": received, "chksum": chksum}, sf)
+    os.replace(sidecar_pth + "~", sidecar_pth)
+
+
+async def save_partial(
+    f, fpth: str, fsz: int, upload_id: str, received: int, chksum: int
+):
+    # close the partial file of an interrupted upload, and record what's received,
+    # for the upload to be resumed
+    await run_io(_save_partial, f, fpth, fsz, upload_id, received, chksum)
+
+
+def _discard_partial(f, fpth: str, upload_id: str):
+    f.close()
+    part_pth, _ = _partial_paths(fpth, upload_id)
+    try:
+        os.unlink(part_pth)
+    except FileNotFoundError:
+        pass
+
+
+async def discard_partial(f, fpth: str, upload_id: str):
+    # close and remove the partial file of an upload not to be resumed
+    await run_io(_discard_partial, f, fpth, upload_id)
+
+
+def _drop_interrupted(fpth: str):
+    # interrupted uploads to a file are stale once it's replaced
+    for upload_id in _interrupted_uploads(fpth):
+        part_pth, sidecar_pth = _partial_paths(fpth, upload_id)
+        try:
+            os.unlink(sidecar_pth)  # claimed first, not to be resumed meanwhile
+            os.unlink(part_pth)
+        except FileNotFoundError:
+            pass
+
+
+async def finish_partial(
+    fpth: str, fsz: int, upload_id: str, digest: str
+) -> os.stat_result:
+    """
+    Make a completely received upload of `fsz` bytes with sha256 `digest`, its partial
+    file closed, the file, stored as a blob, return stat of it.
+
+    """
+    part_pth, _ = _partial_paths(fpth, upload_id)
+    st = await ingest_blob(part_pth, fsz, digest, fpth)
+    await run_io(_drop_interrupted, fpth)
+    return st
+
+
+# partial files and their sidecars, with the sidecars written being `.json~`
+_PARTIAL = re.compile(r"\..+\.[0-9a-f]{16}\.part(\.json~?)?")
+
+
+def _collect_partials(files_dir: str, max_age: float):
+    if not os.path.isdir(files_dir):
+        return 0, 0
+    expire_before = time.time() - max_age
+    n_files = n_bytes = 0
+    for room_dir in os.scandir(files_dir):
+        if room_dir.name.startswith(".") or not room_dir.is_dir(follow_symlinks=False):
+            continue  # e.g. `.blobs`
+        parts = []
+        keep, expired = set(), set()  # names of partial files
+        for entry in os.scandir(room_dir.path):
+            m = _PARTIAL.fullmatch(entry.name)
+            if m is None:
+                continue
+            if m.group(1) is None:
+                parts.append(entry.name)
+                continue
+            part_name = entry.name[: m.start(1)]
+            try:
+                if os.stat(entry.path).st_mtime >= expire_before:
+                    keep.add(part_name)
+                    continue
+                # removing a sidecar claims the upload, as `_open_partial()` does, so
+                # it's not to be resumed meanwhile
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                keep.add(part_name)  # claimed meanwhile, being resumed
+                continue
+            if m.group(1) == ".json":
+                expired.add(part_name)
+        for name in parts:
+            if name in keep:
+                continue
+            part_pth = os.path.join(room_dir.path, name)
+            try:
+                st = os.stat(part_pth)
+                if name not in expired and st.st_mtime >= expire_before:
+                    continue  # being received
+                os.unlink(part_pth)
+            except FileNotFoundError:
+                continue
+            n_files += 1
+            n_bytes += st.st_size
+    return n_files, n_bytes
+
+
+async def collect_partials(files_dir: str = "chat-server-files"):
+    """
+    Remove partial files of uploads interrupted longer than
+    `service_config.partial_max_age` ago, or left over by a worker gone.
+
+    """
+    n_files, n_bytes = await run_io(
+        _collect_partials, files_dir, service_config.partial_max_age
+    )
+    if n_files > 0:
+        service_stats["partials_collected"] += n_files
+        service_stats["partial_bytes_collected"] += n_bytes
+        logger.info(f"Collected {n_files} partial file(s) of {n_bytes} bytes.")
+
+
+async def collect_partials_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await collect_partials()
+        except Exception:
+            logger.error("Failed collecting partial files.", exc_info=True)
+
+
+def _open_download(fpth: str):
+    try:
+        f = open(fpth, "rb")
+    except OSError:
+        return None, None
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        f.close()
+        return None, None
+    return f, st
+
+
+async def open_download(fpth: str):
+    """
+    Open a regular file for download, return `(f, stat)`, or `(None, None)` if there
+    is no such file.
+
+    """
+    return await run_io(_open_download, fpth)
+
+
+async def close_file(f) -> os.stat_result:
+    # close a file, flushing what's buffered, return stat of the file closed
+    def close():
+        st = os.fstat(f.fileno())
+        f.close()
+        return st
+
+    return await run_io(close)
@@ -0,0 +1,221 @@
+"""
+In-memory cache of hot files for download.
+
+A file announced in a busy room tends to be downloaded by many chatters right away.
+Contents of small files recently uploaded or downloaded are kept in memory, with their
+crc32, and frames compressed by codecs once asked for, within a byte budget in LRU
+order. Concurrent downloads of a file are served from the same buffers.
+
+An entry is valid only as long as the file's content identity, see
+`.files.content_id()`, stays the same. Files get replaced, never modified in place,
+so a file re-uploaded under the same name never has a stale entry served.
+
+"""
+import asyncio
+import os
+import stat
+from collections import OrderedDict
+from zlib import crc32
+
+from ..xfer import *
+from .config import *
+from .files import *
+from .stats import *
+from .transfers import *
+
+__all__ = ["HotFile", "HotFiles", "hot_files"]
+
+
+class HotFile:
+    """
+    Content of a file in memory, as a read-only `memoryview`, with its stat and crc32
+
+    """
+
+    __slots__ = ("fpth", "st", "data", "chksum", "framed", "n_bytes")
+
+    def __init__(self, fpth: str, st: os.stat_result, data: memoryview, chksum: int):
+        self.fpth = fpth
+        self.st = st
+        self.data = data
+        self.chksum = chksum
+        self.framed = {}  # codec -> future of frames of the whole file
+        self.n_bytes = len(data)
+
+
+def _read_file(fpth: str):
+    try:
+        f = open(fpth, "rb")
+    except OSError:
+        return None
+    with f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size > service_config.hot_file_max:
+            return None
+        data = f.read(st.st_size)
+    if len(data) != st.st_size:
+        return None  # not the file stat'ed
+    return st, data
+
+
+class HotFiles:
+    """
+    Hot files by path, in LRU order, holding `service_config.hot_cache_bytes` at most
+
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()  # path -> HotFile
+        self.loading = {}  # path -> future of HotFile or None
+        self.n_bytes = 0
+
+    def cacheable(self, fsz: int) -> bool:
+        return (
+            0 < fsz <= service_config.hot_file_max
+            and fsz <= service_config.hot_cache_bytes
+        )
+
+    def _insert(self, fpth: str, hot: HotFile):
+        self.discard(fpth)
+        self.entries[fpth] = hot
+        self.n_bytes += hot.n_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.n_bytes > service_config.hot_cache_bytes and self.entries:
+            _, hot = self.entries.popitem(last=False)
+            self.n_bytes -= hot.n_bytes
+            service_stats["hot_file_evictions"] += 1
+
+    def discard(self, fpth: str):
+        # data being sent stays referenced by the senders till done
+        hot = self.entries.pop(fpth, None)
+        if hot is not None:
+            self.n_bytes -= hot.n_bytes
+
+    def put(self, fpth: str, st: os.stat_result, data: bytearray, chksum: int):
+        """
+        Cache the content of a file just uploaded, `data` is not to be modified
+        afterwards.
+
+        """
+        if len(data) != st.st_size or not self.cacheable(st.st_size):
+            self.discard(fpth)
+            return
+        self._insert(fpth, HotFile(fpth, st, memoryview(data).toreadonly(), chksum))
+
+    async def lookup(self, fpth: str) -> HotFile:
+        """
+        The hot file at `fpth`, loaded if small enough but not cached yet, or None.
+
+        """
+        try:
+            st = await run_io(os.stat, fpth)
+        except OSError:
+            self.discard(fpth)
+            return None
+        if not stat.S_ISREG(st.st_mode) or not self.cacheable(st.st_size):
+            self.discard(fpth)
+            return None
+
+        hot = self.entries.get(fpth, None)
+        if hot is not None:
+            if content_id(hot.st) == content_id(st):
+                self.entries.move_to_end(fpth)
+                service_stats["hot_file_hits"] += 1
+                return hot
+            self.discard(fpth)  # replaced
+
+        # concurrent lookups share a single load
+        loading = self.loading.get(fpth, None)
+        if loading is None:
+            loading = self.loading[fpth] = asyncio.ensure_future(self._load(fpth))
+        return await asyncio.shield(loading)
+
+    async def _load(self, fpth: str) -> HotFile:
+        try:
+            loaded = await run_io(_read_file, fpth)
+            if loaded is None:
+                return None
+            st, data = loaded
+            chksum = cached_crc(fpth, st)
+            if chksum is None:
+                chksum = await run_io(crc32, data)
+                cache_crc(fpth, st, chksum)
+            hot = HotFile(fpth, st, memoryview(data), chksum)
+            if self.cacheable(st.st_size):
+                self._insert(fpth, hot)
+            service_stats["hot_file_loads"] += 1
+            return hot
+        finally:
+            del self.loading[fpth]
+
+    async def frames(self, hot: HotFile, codec: str, start: int, end: int) -> list:
+        # frames of data in `[start, end)`, compressed by `codec`, those of the whole
+        # file are cached along with the data
+        if start > 0 or end < len(hot.data):
+            return await run_io(
+                frame_data, hot.data[start:end], codec, service_config.chunk_max
+            )
+        framing = hot.framed.get(codec, None)
+        if framing is None:
+            # compressed once, for concurrent downloads to share
+            framing = hot.framed[codec] = run_io(
+                frame_data, hot.data, codec, service_config.chunk_max
+            )
+            framing.add_done_callback(lambda fut: self._framed(hot, codec, fut))
+        return await asyncio.shield(framing)
+
+    def _framed(self, hot: HotFile, codec: str, framing: asyncio.Future):
+        if framing.cancelled() or framing.exception() is not None:
+            hot.framed.pop(codec, None)
+            return
+        # raw frames are slices of the data, taking no more memory
+        n_bytes = sum(
+            len(frame)
+            for frame in framing.result()
+            if not isinstance(frame, memoryview)
+        )
+        if self.entries.get(hot.fpth, None) is hot:
+            # the frames take budget along with the data
+            self.n_bytes += n_bytes
+            hot.n_bytes += n_bytes
+            self._evict()
+
+    async def send(
+        self,
+        co,
+        xfer: Transfer,
+        hot: HotFile,
+        start: int,
+        end: int,
+        crc_start: int,
+        codec: str = None,
+    ) -> int:
+        """
+        Send data of a hot file in `[start, end)` through a hosting conversation, each
+        chunk in turn of the transfer `xfer`, return crc32 of data in
+        `[crc_start, end)`.
+
+        """
+        if codec is None:
+            view = hot.data[start:end]
+            step = service_config.chunk_max
+            await send_bufs(
+                co,
+                (view[pos : pos + step] for pos in range(0, len(view), step)),
+                xfer.turn,
+            )
+        else:
+            frames = await self.frames(hot, codec, start, end)
+            await send_bufs(co, frames, xfer.turn)
+            service_stats["download_raw_bytes"] += end - start
+            service_stats["download_wire_bytes"] += sum(len(frame) for frame in frames)
+        service_stats["hot_file_bytes"] += end - start
+
+        if crc_start <= 0 and end >= len(hot.data):
+            return hot.chksum
+        return await run_io(crc32, hot.data[crc_start:end])
+
+
+hot_files = HotFiles()
@@ -0,0 +1,143 @@
+"""
+Compact in-memory storage of recent room msgs.
+
+"""
+import sys
+from array import array
+
+from ..ds import *
+
+__all__ = ["MsgRing"]
+
+
+class MsgRing:
+    """
+    Fixed capacity ring of recent msgs, stored in columns
+
+    Timestamps and sender nick ids live in parallel typed arrays, contents are utf-8
+    encoded into a single byte buffer, and each distinct nick is stored once per ring,
+    so no per-msg Python object is retained. `Msg` objects are only materialized on
+    reads, i.e. when msgs are to be encoded for the wire.
+
+    """
+
+    __slots__ = (
+        "capacity",
+        "head",
+        "size",
+        "times",
+        "nick_ids",
+        "content_ends",
+        "content_buf",
+        "content_base",
+        "head_start",
+        "nicks",
+        "nick_refs",
+        "nick_id_of",
+        "free_nick_ids",
+    )
+
+    def __init__(self, capacity: int, msgs=()):
+        assert capacity > 0, "capacity of a msg ring must be positive"
+        self.capacity = capacity
+        # slot of the oldest msg, and number of msgs in the ring
+        self.head = 0
+        self.size = 0
+
+        self.times = array("d", bytes(8 * capacity))
+        self.nick_ids = array("I", bytes(4 * capacity))
+        # end offset of each msg's content, in bytes ever appended to the buffer
+        self.content_ends = array("Q", bytes(8 * capacity))
+        # contents of msgs in the ring, led by dead bytes of evicted ones, which get
+        # compacted once they take half of the buffer
+        self.content_buf = bytearray()
+        # number of bytes ever appended before `content_buf[0]`
+        self.content_base = 0
+        # start offset of the oldest msg's content, in bytes ever appended
+        self.head_start = 0
+
+        # nick by id, with reference counts by msgs in the ring, ids of nicks no
+        # longer referenced are reused
+        self.nicks = []
+        self.nick_refs = array("I")
+        self.nick_id_of = {}
+        self.free_nick_ids = []
+
+        for msg in msgs:
+            self.append(msg)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.slice(0, self.size))
+
+    def _ref_nick(self, nick: str) -> int:
+        nick_id = self.nick_id_of.get(nick, None)
+        if nick_id is None:
+            nick = sys.intern(nick)
+            if self.free_nick_ids:
+                nick_id = self.free_nick_ids.pop()
+                self.nicks[nick_id] = nick
+                self.nick_refs[nick_id] = 0
+            else:
+                nick_id = len(self.nicks)
+                self.nicks.append(nick)
+                self.nick_refs.append(0)
+            self.nick_id_of[nick] = nick_id
+        self.nick_refs[nick_id] += 1
+        return nick_id
+
+    def _unref_nick(self, nick_id: int):
+        self.nick_refs[nick_id] -= 1
+        if self.nick_refs[nick_id] == 0:
+            del self.nick_id_of[self.nicks[nick_id]]
+            self.nicks[nick_id] = None
+            self.free_nick_ids.append(nick_id)
+
+    def append(self, msg: Msg):
+        content = msg.content.encode("utf-8")
+
+        if self.size < self.capacity:
+            slot = (self.head + self.size) % self.capacity
+            self.size += 1
+        else:  # evict the oldest
+            slot = self.head
+            self.head = (self.head + 1) % self.capacity
+            self._unref_nick(self.nick_ids[slot])
+            self.head_start = self.content_ends[slot]
+
+            dead = self.head_start - self.content_base
+            if dead > len(self.content_buf) // 2:
+                del self.content_buf[:dead]
+                self.content_base += dead
+
+        self.times[slot] = msg.time_
+        self.nick_ids[slot] = self._ref_nick(msg.from_)
+        self.content_buf += content
+        self.content_ends[slot] = self.content_base + len(self.content_buf)
+
+    def slice(self, start: int, end: int) -> list:
+        """
+        Materialize msgs in `[start, end)` of the ring, 0 being the oldest.
+
+        """
+        start, end, _ = slice(start, end).indices(self.size)
+        msgs = []
+        buf = self.content_buf
+        for i in range(start, end):
+            slot = (self.head + i) % self.capacity
+            lo = (
+                self.head_start
+                if i == 0
+                else self.content_ends[(slot - 1) % self.capacity]
+            ) - self.content_base
+            hi = self.content_ends[slot] - self.content_base
+            msgs.append(
+                Msg(
+                    self.nicks[self.nick_ids[slot]],
+                    str(buf[lo:hi], "utf-8"),
+                    self.times[slot],
+                )
+            )
+        return msgs
@@ -0,0 +1,289 @@
+import asyncio
+from collections import deque
+from typing import *
+
+from hbi import *
+
+from ..ds import *
+from ..log import *
+from .config import *
+from .stats import *
+from .transfers import *
+
+__all__ = ["Outbox", "SharedCode", "OVERFLOW_POLICIES"]
+
+logger = get_logger(__package__)
+
+OVERFLOW_POLICIES = ("drop-oldest", "coalesce", "disconnect")
+
+
+class _MsgsBatch:
+    """
+    Room messages pending delivery, still open for more messages to join in
+
+    """
+
+    __slots__ = ("room_id", "msgs", "msg_bins", "deadline", "full")
+
+    def __init__(self, room_id: str, deadline: float):
+        self.room_id = room_id
+        self.msgs = []  # reprs of the msgs
+        self.msg_bins = []  # binary encodings of the msgs, if the consumer takes them
+        self.deadline = deadline
+        # set once the batch gets full, created by the writer when it waits on this
+        self.full = None
+
+    def __str__(self):
+        return f"""
+RoomMsgs({MsgsInRoom.repr_of(self.room_id, self.msgs)})
+"""
+
+    def bin_bufs(self) -> list:
+        # binary encoding of the batch, as buffers to be written out in order, those of
+        # the msgs shared with other outboxes, not copied
+        return [MsgsInRoom.bin_head(self.room_id, len(self.msg_bins)), *self.msg_bins]
+
+
+class _DataNotif:
+    """
+    A notification with binary data, possibly shared with other outboxes
+
+    """
+
+    __slots__ = ("code", "data", "fallback")
+
+    def __init__(self, code: str, data: memoryview, fallback):
+        self.code = code
+        self.data = data
+        # equivalent code without the data, or a function building it, as it's only
+        # needed once coalesced
+        self.fallback = fallback
+
+    def __str__(self):
+        if callable(self.fallback):
+            self.fallback = self.fallback()
+        return self.fallback
+
+
+class SharedCode:
+    """
+    Code of a notification broadcast to many consumers, utf-8 encoded once by the first
+    outbox writing it out, then shared by the others
+
+    """
+
+    __slots__ = ("code", "payload")
+
+    def __init__(self, code: str):
+        self.code = code
+        self.payload = None
+
+    def __str__(self):
+        return self.code
+
+    def encoded(self) -> bytes:
+        if self.payload is None:
+            self.payload = self.code.encode("utf-8")
+            service_stats["bytes_encoded"] += len(self.payload)
+        return self.payload
+
+
+class Outbox:
+    """
+    Bounded queue of notifications pending delivery to a consumer
+
+    Broadcasts only enqueue into outboxes of the recipients, a dedicated writer task per
+    outbox drains it through the posting end, so a slow consumer only delays itself.
+
+    Room messages posted within a coalescing window go out as a single `RoomMsgs`
+    notification, or a `RoomMsgsBin` one with the batch binary encoded as its data,
+    if the consumer declared the `msgs-bin` feature.
+
+    Binary data of broadcasts is encoded once, and handed to the posting end of every
+    recipient as shared buffers, never copied per consumer.
+
+    """
+
+    def __init__(self, po: PostingEnd, max_pending: int = None, overflow: str = None):
+        self.po = po
+        self.max_pending = max_pending or service_config.outbox_max_pending
+        self.overflow = overflow or service_config.outbox_overflow
+        assert self.overflow in OVERFLOW_POLICIES, f"bad policy {self.overflow!r}"
+
+        self.pending = deque()
+        self.has_pending = asyncio.Event()
+        self.closed = False
+        # whether to send room messages in binary
+        self.binary = False
+
+        self.writer = asyncio.create_task(self._write_out())
+
+    def notif(self, code: Union[str, SharedCode]):
+        """
+        Enqueue a notification, never blocks.
+
+        Code broadcast to many outboxes should come as a `SharedCode`, so it's encoded
+        once for all.
+
+        """
+        if self.closed:
+            return
+        if len(self.pending) >= self.max_pending and not self._overflow():
+            return
+        self.pending.append(code)
+        self.has_pending.set()
+
+    def notif_data(
+        self, code: str, data: memoryview, fallback: Union[str, Callable[[], str]]
+    ):
+        """
+        Enqueue a notification with binary data, never blocks.
+
+        The data is sent as is, so it must not be modified afterwards, `fallback` is
+        sent instead if the notification gets coalesced, it can be a function to build
+        that code on demand.
+
+        """
+        if self.closed:
+            return
+        if len(self.pending) >= self.max_pending and not self._overflow():
+            return
+        self.pending.append(_DataNotif(code, data, fallback))
+        self.has_pending.set()
+
+    def notif_room_msg(self, room_id: str, msg_repr: str, msg_bin: memoryview = None):
+        """
+        Enqueue a room message by its repr and binary encoding, never blocks.
+
+        The message joins the last pending batch if that's from the same room and still
+        open, or starts a new batch to be sent after the coalescing window.
+
+        """
+        if self.closed:
+            return
+        batch = self.pending[-1] if self.pending else None
+        if (
+            not isinstance(batch, _MsgsBatch)
+            or batch.room_id != room_id
+            or len(batch.msgs) >= service_config.coalesce_msgs
+        ):
+            if len(self.pending) >= self.max_pending and not self._overflow():
+                return
+            batch = _MsgsBatch(
+                room_id,
+                asyncio.get_running_loop().time() + service_config.coalesce_window,
+            )
+            self.pending.append(batch)
+            self.has_pending.set()
+        batch.msgs.append(msg_repr)
+        if self.binary:
+            batch.msg_bins.append(msg_bin)
+        if len(batch.msgs) >= service_config.coalesce_msgs and batch.full is not None:
+            batch.full.set()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        self.writer.cancel()
+
+    def _overflow(self) -> bool:
+        # apply the overflow policy, return whether there's room for a new notification now
+
+        if self.overflow == "drop-oldest":
+            dropped = self.pending.popleft()
+            if isinstance(dropped, _MsgsBatch):
+                service_stats["room_msgs_dropped"] += len(dropped.msgs)
+            else:
+                service_stats["notifs_dropped"] += 1
+            return True
+
+        if self.overflow == "coalesce":
+            # notifications are code to be landed by the consumer, so concatenated they
+            # can go out as a single packet, room messages fall back to their reprs
+            merged = "".join(str(entry) for entry in self.pending)
+            if len(merged) <= service_config.outbox_max_coalesced:
+                service_stats["notifs_coalesced"] += len(self.pending)
+                service_stats["room_msgs_delivered"] += sum(
+                    len(entry.msgs)
+                    for entry in self.pending
+                    if isinstance(entry, _MsgsBatch)
+                )
+                self.pending.clear()
+                self.pending.append(merged)
+                return True
+
+        logger.warning(
+            f"Disconnecting consumer {self.po.remote_addr!s} with {len(self.pending)} notification(s) pending."
+        )
+        service_stats["consumers_disconnected"] += 1
+        self.close()
+        asyncio.create_task(self.po.disconnect("too slow to receive notifications"))
+        return False
+
+    async def _write_out(self):
+        po = self.po
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                while not self.pending:
+                    self.has_pending.clear()
+                    await self.has_pending.wait()
+
+                entry = self.pending[0]
+                if isinstance(entry, _MsgsBatch):
+                    # leave the batch open until its window passes or it gets full
+                    wait_secs = entry.deadline - loop.time()
+                    if wait_secs > 0 and len(entry.msgs) < service_config.coalesce_msgs:
+                        entry.full = asyncio.Event()
+                        try:
+                            await asyncio.wait_for(entry.full.wait(), wait_secs)
+                        except asyncio.TimeoutError:
+                            pass
+                    if not self.pending or self.pending[0] is not entry:
+                        continue  # dropped or coalesced meanwhile
+                    service_stats["room_msgs_delivered"] += len(entry.msgs)
+
+                    if self.binary and len(entry.msg_bins) == len(entry.msgs):
+                        self.pending.popleft()
+                        bufs = entry.bin_bufs()
+                        n_bytes = sum(len(buf) for buf in bufs)
+                        # file transfers hold their data while notifications are
+                        # written
+                        with transfer_scheduler.chat_writing(po):
+                            await po.notif_data(
+                                f"""
+RoomMsgsBin({n_bytes!r})
+""",
+                                bufs,
+                            )
+                        service_stats["notifs_sent"] += 1
+                        service_stats["bytes_sent"] += n_bytes
+                        continue
+
+                elif isinstance(entry, _DataNotif):
+                    self.pending.popleft()
+                    with transfer_scheduler.chat_writing(po):
+                        await po.notif_data(entry.code, entry.data)
+                    service_stats["notifs_sent"] += 1
+                    service_stats["bytes_sent"] += len(entry.data)
+                    continue
+
+                self.pending.popleft()
+                if isinstance(entry, SharedCode):
+                    code = entry.encoded()
+                else:
+                    code = str(entry)
+                with transfer_scheduler.chat_writing(po):
+                    await po.notif(code)
+                service_stats["notifs_sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            if po.is_connected():
+                logger.error(
+                    f"Failed notifying consumer {po.remote_addr!s}.", exc_info=True
+                )
+            self.closed = True
+            self.pending.clear()
@@ -0,0 +1,103 @@
+"""
+Per-chatter rate limiting of hot service methods.
+
+"""
+import asyncio
+import time
+
+from .config import *
+from .stats import *
+
+__all__ = ["TokenBucket", "RateLimiter"]
+
+
+class TokenBucket:
+    """
+    Classic token bucket, refilled at `rate` tokens per second, holding `burst` at most
+
+    Tokens can go negative, by calls admitted ahead of time to be delayed.
+
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reconfigure(self, rate: float, burst: int):
+        self.refill()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def acquire(self, max_delay: float):
+        """
+        Take a token, return seconds to wait before it's actually available, or None if
+        that'd be longer than `max_delay`, in which case no token is taken.
+
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        delay = (1 - self.tokens) / self.rate
+        if delay > max_delay:
+            return None
+        self.tokens -= 1
+        return delay
+
+
+class RateLimiter:
+    """
+    Token buckets of a chatter, one per limited method
+
+    Limits come from `service_config.room_rate_limits` for the room a call is about,
+    falling back to `service_config.rate_limits`.
+
+    """
+
+    __slots__ = ("buckets",)
+
+    def __init__(self):
+        self.buckets = {}  # method -> TokenBucket
+
+    @staticmethod
+    def limits_of(method: str, room_id: str):
+        room_limits = service_config.room_rate_limits.get(room_id, None)
+        if room_limits is not None and method in room_limits:
+            return room_limits[method]
+        return service_config.rate_limits.get(method, None)
+
+    async def admit(self, method: str, room_id: str) -> bool:
+        """
+        Throttle a call, return whether it's admitted, after some delay if over limit
+        but not too much. A rejected call should be refused without doing its work.
+
+        """
+        limits = self.limits_of(method, room_id)
+        if limits is None or limits[0] <= 0:
+            return True  # unlimited
+        rate, burst = limits
+
+        bucket = self.buckets.get(method, None)
+        if bucket is None:
+            bucket = self.buckets[method] = TokenBucket(rate, burst)
+        elif bucket.rate != rate or bucket.burst != burst:
+            bucket.reconfigure(rate, burst)
+
+        delay = bucket.acquire(service_config.rate_limit_max_delay)
+        if delay is None:
+            service_stats[f"rate_rejected_{method}"] += 1
+            return False
+        if delay > 0:
+            service_stats[f"rate_delayed_{method}"] += 1
+            await asyncio.sleep(delay)
+        return True
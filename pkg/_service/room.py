@@ -7,44 +7,307 @@ import hbi
 
 from ..ds import *
 from ..log import *
+from .bus import *
+from .config import *
+from .msgring import *
+from .outbox import *
+from .roomindex import *
+from .roomlog import *
+from .stats import *
 
 __all__ = ["Room"]
 
 logger = get_logger(__package__)
 
 
+class _JoinedTail:
+    """
+    Encodings of msgs in a hot tail joined into one buffer, kept up to date per post
+    by cutting those evicted off the head and appending those posted, so no msg in
+    the tail gets encoded again
+
+    """
+
+    __slots__ = ("sep", "joined", "lens", "posted")
+
+    def __init__(self, sep, pieces: list):
+        self.sep = sep
+        self.joined = sep.join(pieces)
+        self.lens = deque(len(piece) for piece in pieces)
+        self.posted = []  # encodings of msgs posted since last joined
+
+    def post(self, piece, capacity: int):
+        self.posted.append(piece)
+        if len(self.posted) > capacity:  # all joined so far evicted
+            del self.posted[0]
+            self.joined = self.sep[:0]
+            self.lens.clear()
+
+    def current(self, n_msgs: int):
+        # the joined encodings of the last `n_msgs` msgs, all posted ones included
+        posted, self.posted = self.posted, []
+        if posted:
+            cut = 0
+            for _ in range(len(self.lens) + len(posted) - n_msgs):  # evicted ones
+                cut += self.lens.popleft() + len(self.sep)
+            if self.lens:
+                self.joined = self.sep.join([self.joined[cut:], *posted])
+            else:
+                self.joined = self.sep.join(posted)
+            self.lens.extend(len(piece) for piece in posted)
+        return self.joined
+
+
 class Room:
     """
     Service side room object
 
     """
 
-    def __init__(self, room_id: str, max_hist=10):
+    def __init__(self, room_id: str, max_hist: int = None):
         self.room_id = room_id
-        self.msgs = deque((), max_hist)
-        self.cached_msg_log = None
+        if max_hist is None:
+            max_hist = service_config.room_hist_msgs
+        # all msgs go to the durable log, recent ones are kept in memory as the hot tail.
+        # only the worker owning the room writes its log, others follow it.
+        self.log = RoomLog(room_id, follower=not room_bus.owns(room_id))
+        # the hot tail is stored compactly, msgs get materialized only for encoding.
+        # it's warmed up with msgs from the log by `recover()`
+        self.msgs = MsgRing(max_hist)
+        # reprs and binary encodings of the hot tail joined, built for the first
+        # joiner, then updated per post
+        self.tail_reprs = None
+        self.tail_bins = None
+        # ready-to-send code and binary encoding of the hot tail, shared by all
+        # joiners till next post
+        self.cached_msgs_code = None
+        self.cached_msgs_bin = None
         self.chatters = set()
+        # monotonic time of last activity, for idle rooms to be hibernated
+        self.last_active = time.monotonic()
+
+        # presence changes pending, as `(nick, chatter, mover)`, debounced per window
+        self.joined = []
+        self.left = []
+        self.presence_flush = None
+
+    async def recover(self):
+        # recover the log and warm up the hot tail, before the room is put to use
+        recent = await self.log.recover(self.msgs.capacity)
+        self.msgs = MsgRing(self.msgs.capacity, recent)
+
+    async def take_over(self):
+        # become the owner of this room, its owner worker gone
+        if not self.log.follower or self.log.deferred is not None:
+            return  # taken over already, or being so
+        try:
+            recent = await self.log.take_over(self.msgs.capacity)
+        except Exception:
+            logger.error(f"Failed taking over room log [{self.room_id}]", exc_info=True)
+            return
+        # the hot tail follows seqs of the log from now on
+        self.msgs = MsgRing(self.msgs.capacity, recent)
+        self.tail_reprs = self.tail_bins = None
+        self.cached_msgs_code = None
+        self.cached_msgs_bin = None
+        service_stats["rooms_taken_over"] += 1
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def enter(self, chatter: "Chatter"):
+        self.chatters.add(chatter)
+        self.touch()
+        room_bus.publish(
+            "occupancy", self.room_id, room_bus.worker_idx, len(self.chatters)
+        )
+        room_index.update(self.room_id, self.population())
+
+    def leave(self, chatter: "Chatter"):
+        if chatter not in self.chatters:
+            return
+        self.chatters.discard(chatter)
+        self.touch()
+        room_bus.publish(
+            "occupancy", self.room_id, room_bus.worker_idx, len(self.chatters)
+        )
+        room_index.update(self.room_id, self.population())
+
+    def population(self) -> int:
+        # number of chatters in this room, across all worker processes
+        return len(self.chatters) + room_bus.remote_population(self.room_id)
+
+    def notif_presence(self, nick: str, joined: bool, chatter=None, mover=None):
+        """
+        Have chatters in room notified about `nick` joined/left, and other workers too
+        unless it's notified from another worker, identifying the chatter moving by
+        `mover`.
+
+        Changes are aggregated over `service_config.presence_window` into one delta,
+        where a join and a leave of the same chatter cancel each other out, chatters
+        sharing a nick don't. `chatter` doing the move is not notified about itself.
+
+        """
+        if mover is None:  # moving here, not on another worker
+            mover = (room_bus.worker_idx, id(chatter))
+            room_bus.publish("presence", self.room_id, nick, joined, mover)
+
+        if self.population() > service_config.presence_max_occupancy:
+            service_stats["presence_suppressed"] += 1
+            return
+
+        pending, opposite = (
+            (self.joined, self.left) if joined else (self.left, self.joined)
+        )
+        for i, (_, _, opposite_mover) in enumerate(opposite):
+            if opposite_mover == mover:
+                del opposite[i]
+                service_stats["presence_cancelled"] += 2
+                return
+        pending.append((nick, chatter, mover))
 
-    async def each_in_room(self, with_chatter: Callable[["Chatter"], None]):
-        # enumerate chatters in room, drop those disconnected and causing errors
+        if self.presence_flush is None:
+            self.presence_flush = asyncio.get_running_loop().call_later(
+                service_config.presence_window, self._flush_presence
+            )
+
+    def _flush_presence(self):
+        joined, left = self.joined, self.left
+        self.joined, self.left = [], []
+        self.presence_flush = None
+        if not joined and not left:
+            return
+
+        movers = {chatter for nick, chatter, _ in joined + left if chatter is not None}
+        # presence code for chatters not moving, by feature support, encoded once for
+        # all of them
+        common_codes = {}
+
+        def presence_code(recipient: "Chatter") -> str:
+            delta = "presence-delta" in recipient.features
+            if recipient in movers:
+                return self._presence_code(
+                    [nick for nick, chatter, _ in joined if chatter is not recipient],
+                    [nick for nick, chatter, _ in left if chatter is not recipient],
+                    delta,
+                )
+            code = common_codes.get(delta, None)
+            if code is None:
+                code = self._presence_code(
+                    [nick for nick, _, _ in joined],
+                    [nick for nick, _, _ in left],
+                    delta,
+                )
+                code = common_codes[delta] = SharedCode(code) if code else ""
+            return code
+
+        def notif_chatter(chatter: "Chatter"):
+            code = presence_code(chatter)
+            if code:
+                chatter.outbox.notif(code)
+
+        self.each_in_room(notif_chatter)
+
+    def _presence_code(self, joined: list, left: list, delta: bool) -> str:
+        if not joined and not left:
+            return ""
+        if delta:
+            return f"""
+PresenceDelta({self.room_id!r}, {joined!r}, {left!r})
+"""
+        # for consumers not supporting presence deltas
+        return "".join(
+            [
+                *(f"\nChatterJoined({nick!r}, {self.room_id!r})\n" for nick in joined),
+                *(f"\nChatterLeft({nick!r}, {self.room_id!r})\n" for nick in left),
+            ]
+        )
+
+    def is_idle(self, ttl: float) -> bool:
+        return not self.chatters and time.monotonic() - self.last_active >= ttl
+
+    def each_in_room(self, with_chatter: Callable[["Chatter"], None]):
+        # enumerate chatters in room, drop those disconnected or given up.
+        # `with_chatter` is supposed to only enqueue into the chatter's outbox, it's
+        # the outbox writer to actually send out notifications.
         err_chatters = set()
         for chatter in [  # snapshot the chatters set into a list for enumeration
             *self.chatters
         ]:
-            try:
-                await with_chatter(chatter)
-            except Exception:
-                if not chatter.po.is_connected():
-                    err_chatters.add(chatter)
-        if err_chatters:
-            self.chatters -= err_chatters
-
-    def recent_msg_log(self):
-        if self.cached_msg_log is None:
-            self.cached_msg_log = MsgsInRoom(self.room_id, [*self.msgs])
-        return self.cached_msg_log
-
-    async def post_msg(self, from_chatter, content: str):
+            if chatter.outbox.closed or not chatter.po.is_connected():
+                err_chatters.add(chatter)
+                continue
+            with_chatter(chatter)
+        for chatter in err_chatters:
+            self.leave(chatter)
+
+    async def history_before(self, before_seq: int = None, limit: int = 10):
+        """
+        Get a page of msgs right before `before_seq`, or the latest page if it's None.
+
+        Return `(first_seq, msgs)`, where `first_seq` is the seq of the first msg in
+        the page, to be passed as `before_seq` for the previous page.
+
+        """
+        log = self.log
+        if log.follower:
+            # the hot tail is not aligned to seqs of a log written by another worker,
+            # catch up with the log and read all from disk
+            await log.follow()
+        end = log.next_seq
+        if before_seq is not None:
+            end = max(log.first_seq, min(int(before_seq), end))
+        start = max(log.first_seq, end - max(0, int(limit)))
+
+        hot_first = log.next_seq - len(self.msgs)
+        if start >= hot_first and not log.follower:  # serve from the hot tail
+            return start, self.msgs.slice(start - hot_first, end - hot_first)
+        return start, await log.read(start, end)
+
+    def recent_msgs_code(self) -> SharedCode:
+        # ready-to-send code of recent msgs, reused by all joiners till next post
+        if self.cached_msgs_code is None:
+            if self.tail_reprs is None:
+                self.tail_reprs = _JoinedTail(
+                    ", ", [repr(msg) for msg in self.msgs.slice(0, len(self.msgs))]
+                )
+            self.cached_msgs_code = SharedCode(
+                f"""
+RoomMsgs({MsgsInRoom.repr_of(self.room_id, [self.tail_reprs.current(len(self.msgs))])})
+"""
+            )
+        return self.cached_msgs_code
+
+    def notif_recent_msgs(self, chatter: "Chatter"):
+        # have recent msgs sent to a joiner, binary encoded if it takes that
+        if not chatter.outbox.binary:
+            chatter.outbox.notif(self.recent_msgs_code())
+            return
+        if self.cached_msgs_bin is None:
+            if self.tail_bins is None:
+                pieces = [msg.to_bin() for msg in self.msgs.slice(0, len(self.msgs))]
+                service_stats["bytes_encoded"] += sum(len(piece) for piece in pieces)
+                self.tail_bins = _JoinedTail(b"", pieces)
+            head = MsgsInRoom.bin_head(self.room_id, len(self.msgs))
+            service_stats["bytes_encoded"] += len(head)
+            # the msgs are joined as encoded already, not encoded again
+            self.cached_msgs_bin = memoryview(
+                b"".join([head, self.tail_bins.current(len(self.msgs))])
+            )
+        data = self.cached_msgs_bin
+        chatter.outbox.notif_data(
+            f"""
+RoomMsgsBin({len(data)!r})
+""",
+            data,
+            # only built if coalesced, from the data for it to be the same msgs, the
+            # hot tail may have moved on
+            lambda: f"""
+RoomMsgs({MsgsInRoom.from_bin(data)!r})
+""",
+        )
+
+    def post_msg(self, from_chatter, content: str):
         from .chatter import Chatter
 
         msg = Msg(
@@ -54,19 +317,41 @@ class Room:
             content,
             time.time(),
         )
-        self.msgs.append(msg)
-        self.cached_msg_log = None
+        room_bus.publish("post", self.room_id, msg.from_, msg.content, msg.time_)
+        self.accept_msg(msg, from_chatter)
 
-        # notify all chatters but the OP in this room about the new msg
-        room_msgs = MsgsInRoom(self.room_id, [msg])
-        notif_code = rf"""
-RoomMsgs({room_msgs!r})
-"""
+    def accept_msg(self, msg: Msg, from_chatter=None):
+        # log the msg and deliver it to chatters in room, it's either posted here, or
+        # relayed from another worker
+        # both encodings are done once, then shared by all recipients, the binary one
+        # only if any takes it
+        msg_repr = repr(msg)
+        msg_bin = None
+
+        def binary() -> memoryview:
+            nonlocal msg_bin
+            if msg_bin is None:
+                msg_bin = memoryview(msg.to_bin())
+                service_stats["bytes_encoded"] += len(msg_bin)
+            return msg_bin
+
+        self.log.append(msg)
+        self.msgs.append(msg)
+        if self.tail_reprs is not None:
+            self.tail_reprs.post(msg_repr, self.msgs.capacity)
+        if self.tail_bins is not None:
+            self.tail_bins.post(binary(), self.msgs.capacity)
+        self.cached_msgs_code = None
+        self.cached_msgs_bin = None
+        self.touch()
 
-        async def deliver_room_msg(chatter: "Chatter"):
+        # notify all chatters but the OP in this room about the new msg, the outboxes
+        # coalesce msgs posted in quick succession into a single notification
+        def deliver_room_msg(chatter: "Chatter"):
             if chatter is from_chatter:
                 return  # not to the OP
-            await chatter.po.notif(notif_code)
+            chatter.outbox.notif_room_msg(
+                self.room_id, msg_repr, binary() if chatter.outbox.binary else None
+            )
 
-        # send notification to others in a separated aio task to avoid deadlock
-        asyncio.create_task(self.each_in_room(deliver_room_msg))
+        self.each_in_room(deliver_room_msg)
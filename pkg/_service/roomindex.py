@@ -0,0 +1,73 @@
+from bisect import bisect_left, insort
+
+__all__ = ["OccupancyIndex", "room_index"]
+
+
+class OccupancyIndex:
+    """
+    Rooms with chatters in them, ordered by population
+
+    Rooms are bucketed by population, with populations of non-empty buckets kept
+    sorted, and each bucket an array of rooms sorted by arrival, so a room is found
+    in its bucket by bisection. Listing K rooms after an offset costs O(L + K), with L
+    the number of distinct populations, rooms skipped are never enumerated.
+
+    """
+
+    def __init__(self):
+        self.populations = {}  # room_id -> population
+        # population -> [(arrival, room_id)], sorted by arrival into the bucket
+        self.buckets = {}
+        self.arrivals = {}  # room_id -> arrival into its current bucket
+        self.n_arrivals = 0
+        self.levels = []  # populations of non-empty buckets, ascending
+        self.total_chatters = 0
+
+    def __len__(self):
+        return len(self.populations)
+
+    def update(self, room_id: str, population: int):
+        old = self.populations.get(room_id, 0)
+        if population == old:
+            return
+        self.total_chatters += population - old
+
+        if old > 0:
+            bucket = self.buckets[old]
+            del bucket[bisect_left(bucket, (self.arrivals[room_id], room_id))]
+            if not bucket:
+                del self.buckets[old]
+                del self.levels[bisect_left(self.levels, old)]
+
+        if population > 0:
+            self.populations[room_id] = population
+            bucket = self.buckets.get(population, None)
+            if bucket is None:
+                bucket = self.buckets[population] = []
+                insort(self.levels, population)
+            self.n_arrivals += 1
+            self.arrivals[room_id] = self.n_arrivals
+            bucket.append((self.n_arrivals, room_id))
+        else:
+            del self.populations[room_id]
+            del self.arrivals[room_id]
+
+    def top(self, limit: int, offset: int = 0):
+        """
+        Yield `(population, room_id)` of most populated rooms, skipping `offset` ones.
+
+        """
+        for population in reversed(self.levels):
+            if limit <= 0:
+                return
+            bucket = self.buckets[population]
+            if offset >= len(bucket):
+                offset -= len(bucket)
+                continue
+            for _, room_id in bucket[offset : offset + limit]:
+                yield population, room_id
+                limit -= 1
+            offset = 0
+
+
+room_index = OccupancyIndex()
@@ -0,0 +1,514 @@
+"""
+Durable per-room message log.
+
+Each room has its msgs appended to segment files under `chat-server-logs/<room>`, with
+the room id percent-encoded into a single path component. A segment is named after the
+seq of its first record, and rolled over once it grows beyond
+`service_config.log_segment_bytes`.
+
+A record is a fixed header followed by utf-8 bytes of the nick and the content:
+
+    crc32 u32 | body_len u32 | seq u64 | time f64 | nick_len u16 | nick | content
+
+with the crc32 calculated over all bytes after itself, so a torn tail can be detected
+and truncated on recovery.
+
+A sparse in-memory index maps every `service_config.log_index_interval`-th seq of a
+segment to its file offset, so reading a page of history costs a single positioned
+read of a bounded span.
+
+When multiple worker processes serve the chat, a room log is written by the worker
+owning the room only, other workers open it as followers, reading what's on disk.
+
+"""
+import asyncio
+import atexit
+import hashlib
+import os
+import queue
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from urllib.parse import quote, unquote
+from zlib import crc32
+
+from ..ds import *
+from ..log import *
+from .config import *
+
+__all__ = ["RoomLog", "LogWriter", "log_writer", "log_dir_name", "logged_rooms"]
+
+logger = get_logger(__package__)
+
+_REC_HEAD = struct.Struct("<IIQdH")
+_SEG_SUFFIX = ".seg"
+
+
+def log_dir_name(room_id: str) -> str:
+    # room ids come from consumers, never to be taken as paths, dots are encoded too
+    # so it can't be `.` or `..`, and overlong ones are cut with a digest appended
+    name = quote(room_id, safe="").replace(".", "%2E") or "%"
+    if len(name) > 200:
+        name = name[:150] + "~" + hashlib.sha256(room_id.encode("utf-8")).hexdigest()
+    return name
+
+
+def logged_rooms() -> list:
+    """
+    Ids of rooms having logs on disk, except those with overlong ids, which can't be
+    told from their directory names.
+
+    """
+    log_dir = service_config.log_dir
+    if not os.path.isdir(log_dir):
+        return []
+    room_ids = []
+    for name in os.listdir(log_dir):
+        room_id = unquote(name)
+        if log_dir_name(room_id) == name:
+            room_ids.append(room_id)
+    return room_ids
+
+
+def encode_record(seq: int, msg: Msg) -> bytes:
+    nick = msg.from_[:0x3FFF].encode("utf-8")  # fits in u16 even all 4-byte chars
+    content = msg.content.encode("utf-8")
+    body_len = len(nick) + len(content)
+    tail = _REC_HEAD.pack(0, body_len, seq, msg.time_, len(nick))[4:] + nick + content
+    return struct.pack("<I", crc32(tail)) + tail
+
+
+def decode_records(buf, offset: int = 0):
+    """
+    Decode records from `buf` starting at `offset`, yield `(seq, msg, end_offset)` for
+    each, until the buffer ends or a torn/corrupted record is hit.
+
+    """
+    buf = memoryview(buf)
+    while offset + _REC_HEAD.size <= len(buf):
+        chksum, body_len, seq, time_, nick_len = _REC_HEAD.unpack_from(buf, offset)
+        end = offset + _REC_HEAD.size + body_len
+        if end > len(buf) or nick_len > body_len:
+            return  # torn tail
+        if crc32(buf[offset + 4 : end]) != chksum:
+            return  # corrupted
+        body = offset + _REC_HEAD.size
+        nick = str(buf[body : body + nick_len], "utf-8")
+        content = str(buf[body + nick_len : end], "utf-8")
+        yield seq, Msg(nick, content, time_), end
+        offset = end
+
+
+class LogWriter:
+    """
+    Background thread writing appended records to disk
+
+    Records queued while an fsync is in progress are written together, and every log
+    file touched by such a group is fsync'ed once per group, so a busy service pays
+    few syncs, while `RoomLog.append()` never waits for disk at all.
+
+    """
+
+    def __init__(self):
+        self.q = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, log: "RoomLog", path: str, seq: int, rec: bytes):
+        # `path` being None means to close the log file
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self._write_loop, name="RoomLogWriter", daemon=True
+                    )
+                    self.thread.start()
+                    atexit.register(self.stop)
+        self.q.put((log, path, seq, rec))
+
+    def stop(self):
+        # flush all records submitted so far, then stop the writer thread
+        if self.thread is None:
+            return
+        self.q.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            group = [self.q.get()]
+            try:
+                while True:
+                    group.append(self.q.get_nowait())
+            except queue.Empty:
+                pass
+
+            dirty = {}
+            for item in group:
+                if item is None:
+                    stopping = True
+                    continue
+                log, path, seq, rec = item
+                try:
+                    f = log._wfile
+                    if path is None:  # done with this log
+                        if f is not None:
+                            dirty.pop(id(f), None)
+                            f.flush()
+                            os.fsync(f.fileno())
+                            f.close()
+                            log._wfile = None
+                        continue
+                    if f is None or f.name != path:
+                        if f is not None:  # rolled over, done with the old segment
+                            dirty.pop(id(f), None)
+                            f.flush()
+                            os.fsync(f.fileno())
+                            f.close()
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        f = log._wfile = open(path, "ab")
+                    f.write(rec)
+                    dirty[id(f)] = f
+                except Exception:
+                    logger.error(f"Failed writing room log [{path}]", exc_info=True)
+
+            for f in dirty.values():
+                try:
+                    f.flush()
+                    os.fsync(f.fileno())
+                except Exception:
+                    logger.error(f"Failed syncing room log [{f.name}]", exc_info=True)
+
+            for item in group:
+                if item is not None:
+                    log, path, seq, rec = item
+                    if seq > log.durable_seq:
+                        log.durable_seq = seq
+
+
+log_writer = LogWriter()
+
+
+class _SegIndex:
+    """
+    Sparse seq to file offset index of a log segment
+
+    """
+
+    __slots__ = ("seqs", "offsets")
+
+    def __init__(self):
+        self.seqs = array("Q")
+        self.offsets = array("Q")
+
+    @classmethod
+    def scan(cls, first_seq: int, data) -> "_SegIndex":
+        idx = cls()
+        offset = 0
+        for seq, msg, end in decode_records(data):
+            idx.note(first_seq, seq, offset)
+            offset = end
+        return idx
+
+    def note(self, first_seq: int, seq: int, offset: int):
+        if (seq - first_seq) % service_config.log_index_interval == 0:
+            self.seqs.append(seq)
+            self.offsets.append(offset)
+
+    def span(self, start_seq: int, end_seq: int):
+        # file span covering records [start_seq, end_seq), the end being None means
+        # till end of the segment
+        i = bisect_right(self.seqs, start_seq) - 1
+        lo = self.offsets[i] if i >= 0 else 0
+        j = bisect_left(self.seqs, end_seq)
+        hi = self.offsets[j] if j < len(self.seqs) else None
+        return lo, hi
+
+
+class RoomLog:
+    """
+    Append-only message log of a room
+
+    All methods but the writer's are meant to be called from the event loop thread.
+
+    A follower log never writes, it catches up with records appended by the owner
+    process on reads.
+
+    A log is to be `recover()`ed from disk before use.
+
+    """
+
+    def __init__(self, room_id: str, follower: bool = False):
+        self.room_id = room_id
+        self.follower = follower
+        self.log_dir = os.path.abspath(
+            os.path.join(service_config.log_dir, log_dir_name(room_id))
+        )
+
+        # seq of first record of each segment, in ascending order
+        self.segments = []
+        # sparse index per segment, keyed by its first seq. segments left over from
+        # previous runs are indexed on first read
+        self.seg_index = {}
+        # seq to be assigned to next appended record
+        self.next_seq = 0
+        # size of the tail segment, including records not written yet
+        self.tail_size = 0
+        # highest seq known to have been fsync'ed, updated by the writer thread
+        self.durable_seq = -1
+
+        # catch up in progress of a follower
+        self.following = None
+        # msgs appended while being taken over, to be logged once caught up
+        self.deferred = None
+
+        # tail segment file opened for append, only touched by the writer thread
+        self._wfile = None
+
+    def seg_path(self, first_seq: int) -> str:
+        return os.path.join(self.log_dir, f"{first_seq:016d}{_SEG_SUFFIX}")
+
+    def _list_segments(self) -> list:
+        if not os.path.isdir(self.log_dir):
+            return []
+        return sorted(
+            int(fn[: -len(_SEG_SUFFIX)])
+            for fn in os.listdir(self.log_dir)
+            if fn.endswith(_SEG_SUFFIX) and fn[: -len(_SEG_SUFFIX)].isdigit()
+        )
+
+    def _read_from(self, first_seq: int, offset: int):
+        # return size of a segment file, and its data from `offset` on
+        with open(self.seg_path(first_seq), "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            data = os.pread(f.fileno(), max(0, file_size - offset), offset)
+        return file_size, data
+
+    def _index_tail(self, first_seq: int, data):
+        # index records read from the tail segment, that beyond `tail_size`
+        tail_index = self.seg_index.setdefault(first_seq, _SegIndex())
+        if self.next_seq < first_seq:
+            self.next_seq = first_seq
+        offset = self.tail_size
+        for seq, msg, end in decode_records(data):
+            tail_index.note(first_seq, seq, offset)
+            self.next_seq = seq + 1
+            offset = self.tail_size + end
+        self.tail_size = offset
+
+    def _truncate_tail(self, file_size: int):
+        tail_path = self.seg_path(self.segments[-1])
+        logger.warning(
+            f"Truncating torn tail of room log [{tail_path}] at {self.tail_size}/{file_size}"
+        )
+        with open(tail_path, "rb+") as f:
+            f.truncate(self.tail_size)
+
+    def _recover(self):
+        self.segments = self._list_segments()
+        if not self.segments:
+            return
+
+        file_size, data = self._read_from(self.segments[-1], 0)
+        self._index_tail(self.segments[-1], data)
+        if file_size > self.tail_size and not self.follower:
+            self._truncate_tail(file_size)
+        self.durable_seq = self.next_seq - 1
+
+    async def recover(self, n_recent: int) -> list:
+        """
+        Recover the log from disk, off the event loop, and return last `n_recent` msgs
+        logged, for the hot tail to be warmed up.
+
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._recover_recent, n_recent
+        )
+
+    def _recover_recent(self, n_recent: int) -> list:
+        # the log is not used by anyone else till recovered, so it's safe to touch here
+        self._recover()
+        return self.recent(n_recent)
+
+    def _read_appended(self, tail_seq: int, tail_size: int) -> list:
+        # read what the owner process appended to the tail segment and newer ones, as
+        # `(first_seq, file_size, data)` of each
+        appended = []
+        for first_seq in self._list_segments():
+            if tail_seq is not None and first_seq < tail_seq:
+                continue
+            offset = tail_size if first_seq == tail_seq else 0
+            appended.append((first_seq, *self._read_from(first_seq, offset)))
+        return appended
+
+    async def follow(self) -> int:
+        """
+        Catch up with records appended by the owner process, read off the event loop,
+        then indexed here. Concurrent calls share a single catch up.
+
+        Return size of the tail segment file.
+
+        """
+        assert self.follower, "only a follower log needs to catch up"
+        if self.following is None:
+            self.following = asyncio.ensure_future(self._follow())
+        return await asyncio.shield(self.following)
+
+    async def _follow(self) -> int:
+        try:
+            appended = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self._read_appended,
+                self.segments[-1] if self.segments else None,
+                self.tail_size,
+            )
+            tail_file_size = self.tail_size
+            for first_seq, file_size, data in appended:
+                if not self.segments or first_seq > self.segments[-1]:
+                    self.segments.append(first_seq)
+                    self.tail_size = 0
+                self._index_tail(first_seq, data)
+                tail_file_size = file_size
+            self.durable_seq = self.next_seq - 1
+            return tail_file_size
+        finally:
+            self.following = None
+
+    async def take_over(self, n_recent: int) -> list:
+        """
+        Become the writer of this log, its owner process gone, and return last
+        `n_recent` msgs logged, for the hot tail to be realigned with the log.
+
+        Msgs appended while catching up with what the owner has written are logged
+        afterwards, and included in the msgs returned.
+
+        """
+        assert self.follower, "only a follower log can be taken over"
+        loop = asyncio.get_running_loop()
+        self.deferred = []
+        try:
+            await self.follow()  # one in progress may have started before the owner died
+            file_size = await self.follow()
+            if file_size > self.tail_size:  # the owner died amid a write
+                await loop.run_in_executor(None, self._truncate_tail, file_size)
+            recent = await loop.run_in_executor(None, self.recent, n_recent)
+        except BaseException:
+            self.deferred = None
+            raise
+        self.follower = False
+        self.durable_seq = self.next_seq - 1
+        deferred, self.deferred = self.deferred, None
+        for msg in deferred:
+            self.append(msg)
+        recent.extend(deferred)
+        return recent[-n_recent:]
+
+    def recent(self, n: int) -> list:
+        """
+        Read back last `n` msgs from disk, used to warm up the in-memory hot tail.
+
+        """
+        msgs = []
+        for first_seq in reversed(self.segments):
+            with open(self.seg_path(first_seq), "rb") as f:
+                seg_msgs = [msg for seq, msg, end in decode_records(f.read())]
+            msgs[:0] = seg_msgs[-(n - len(msgs)) :]
+            if len(msgs) >= n:
+                break
+        return msgs
+
+    def append(self, msg: Msg) -> int:
+        """
+        Append a msg to the log, return its seq. The record is written and fsync'ed
+        in the background.
+
+        A follower log ignores appends, returns -1.
+
+        """
+        if self.deferred is not None:  # being taken over
+            self.deferred.append(msg)
+            return -1
+        if self.follower:
+            return -1
+        seq = self.next_seq
+        rec = encode_record(seq, msg)
+        if not self.segments or (
+            self.tail_size > 0
+            and self.tail_size + len(rec) > service_config.log_segment_bytes
+        ):
+            # roll over to a new segment
+            self.segments.append(seq)
+            self.seg_index[seq] = _SegIndex()
+            self.tail_size = 0
+        self.seg_index[self.segments[-1]].note(self.segments[-1], seq, self.tail_size)
+        self.next_seq = seq + 1
+        self.tail_size += len(rec)
+        log_writer.submit(self, self.seg_path(self.segments[-1]), seq, rec)
+        return seq
+
+    def all_durable(self) -> bool:
+        return self.durable_seq >= self.next_seq - 1
+
+    def close(self):
+        """
+        Release the log file after all records appended so far are written, the log
+        should not be appended to anymore.
+
+        """
+        log_writer.submit(self, None, -1, None)
+
+    @property
+    def first_seq(self) -> int:
+        return self.segments[0] if self.segments else self.next_seq
+
+    async def wait_durable(self, seq: int):
+        # group commits take some milliseconds at most, just poll for it
+        while self.durable_seq < seq:
+            await asyncio.sleep(0.002)
+
+    async def read(self, start_seq: int, end_seq: int) -> list:
+        """
+        Read msgs with seq in `[start_seq, end_seq)` back from disk, off the event loop.
+
+        """
+        await self.wait_durable(end_seq - 1)
+        # file spans are located here, by the indexes only the loop touches, segments
+        # not indexed yet get scanned by the reader and indexed here afterwards
+        spans = []
+        segments = self.segments
+        for i in range(max(0, bisect_right(segments, start_seq) - 1), len(segments)):
+            first_seq = segments[i]
+            if first_seq >= end_seq:
+                break
+            idx = self.seg_index.get(first_seq, None)
+            spans.append(
+                (first_seq, None if idx is None else idx.span(start_seq, end_seq))
+            )
+        msgs, scanned = await asyncio.get_running_loop().run_in_executor(
+            None, self._read_span, spans, start_seq, end_seq
+        )
+        for first_seq, idx in scanned.items():
+            self.seg_index.setdefault(first_seq, idx)
+        return msgs
+
+    def _read_span(self, spans: list, start_seq: int, end_seq: int):
+        # return the msgs read, and indexes of segments scanned by first seq
+        msgs = []
+        scanned = {}
+        for first_seq, span in spans:
+            with open(self.seg_path(first_seq), "rb") as f:
+                if span is None:  # left over from previous runs, index it once
+                    idx = scanned[first_seq] = _SegIndex.scan(first_seq, f.read())
+                    span = idx.span(start_seq, end_seq)
+                lo, hi = span
+                if hi is None:
+                    hi = os.fstat(f.fileno()).st_size
+                data = os.pread(f.fileno(), hi - lo, lo)
+            for seq, msg, end in decode_records(data):
+                if seq >= end_seq:
+                    break
+                if seq >= start_seq:
+                    msgs.append(msg)
+        return msgs, scanned
@@ -0,0 +1,47 @@
+"""
+Counters of the chatting service.
+
+"""
+import asyncio
+import time
+from collections import Counter
+
+from ..log import *
+
+__all__ = ["service_stats", "log_stats_periodically"]
+
+logger = get_logger(__package__)
+
+
+# service wide counters, bumped in place by whoever is concerned
+service_stats = Counter()
+
+
+async def log_stats_periodically(interval: float):
+    last_stats = Counter()
+    last_cpu = time.process_time()
+    while True:
+        await asyncio.sleep(interval)
+
+        cpu = time.process_time()
+        delta = service_stats - last_stats
+        n_notifs = delta["notifs_sent"]
+        n_delivered = delta["room_msgs_delivered"]
+        n_encoded = delta["bytes_encoded"]
+
+        lines = [f"Service stats over last {interval} second(s):"]
+        for name, value in sorted(service_stats.items()):
+            lines.append(f"  * {name}: {value} (+{delta[name]})")
+        if n_notifs > 0 and n_delivered > 0:
+            lines.append(
+                f"  = {n_delivered / n_notifs:0.2f} msg(s) per notification packet, "
+                f"{1e6 * (cpu - last_cpu) / n_delivered:0.1f} CPU us per delivered msg"
+            )
+        if n_encoded > 0:
+            lines.append(
+                f"  = {delta['bytes_sent'] / n_encoded:0.2f} byte(s) sent per byte encoded"
+            )
+        logger.info("\n".join(lines))
+
+        last_stats = service_stats.copy()
+        last_cpu = cpu
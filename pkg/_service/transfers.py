@@ -0,0 +1,225 @@
+"""
+Admission and pacing of file transfers.
+
+Bulk data of uploads and downloads competes with chat traffic for the event loop, the
+disk and the wire. A transfer is admitted only while fewer than
+`service_config.max_transfers` are active service wide, and fewer than
+`service_config.max_transfers_per_chatter` by its chatter, others wait in a FIFO
+queue. Chunks of active transfers are then granted turns by weighted fair queueing,
+optionally within a service wide bandwidth, and never while notifications are being
+written to the same wire, within a bounded deferral.
+
+"""
+import asyncio
+import heapq
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .config import *
+from .stats import *
+
+__all__ = ["Transfer", "TransferScheduler", "transfer_scheduler"]
+
+
+class Transfer:
+    """
+    An upload or download by a chatter, to be run as `async with`, admitted on enter
+    if not `admit()`ted ahead, and released on exit
+
+    Each chunk of data streamed should wait for its `turn()`, e.g. with that as the
+    pace of `send_bufs()`/`recv_bufs()`. `wire` is the posting end the data goes over,
+    chunks are held only while notifications are written there.
+
+    """
+
+    __slots__ = ("sched", "chatter", "wire", "weight", "finish", "admitted")
+
+    def __init__(self, sched, chatter, wire=None, weight: float = 1.0):
+        self.sched = sched
+        self.chatter = chatter
+        self.wire = wire
+        self.weight = weight
+        # virtual finish time of the last chunk granted, per weighted fair queueing
+        self.finish = 0.0
+        self.admitted = False
+
+    async def admit(self):
+        # wait till admitted, e.g. before the peer is told to stream data
+        if not self.admitted:
+            await self.sched.admit(self)
+            self.admitted = True
+
+    def release(self):
+        if self.admitted:
+            self.admitted = False
+            self.sched.release(self)
+
+    async def __aenter__(self):
+        await self.admit()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    async def turn(self, n_bytes: int):
+        await self.sched.turn(self, n_bytes)
+
+
+class TransferScheduler:
+    """
+    Admits transfers in FIFO order under concurrency limits, and grants their chunks
+    turns in order of virtual finish time
+
+    A chunk of `n` bytes gets the finish tag `max(vtime, last finish) + n / weight`,
+    with `vtime` the tag of the chunk granted last, so each active transfer gets its
+    share of bandwidth by weight, and an idle one can't save credit up. Turns are
+    granted one per loop iteration, and paced by `service_config.transfer_rate` if
+    that's not 0.
+
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.by_chatter = {}  # chatter -> number of active transfers
+        self.waiting = deque()  # (transfer, future) in arrival order
+
+        self.vtime = 0.0
+        self.turns = []  # heap of (finish, seq, n_bytes, future)
+        self.seq = 0
+        self.granter = None
+        # when the bandwidth is free again, in `time.monotonic()`
+        self.link_free = 0.0
+
+        # wire -> number of notification writes in progress over it
+        self.chatting = {}
+        # wire -> event set once no notification is being written over it
+        self.chat_idle = {}
+
+    def _can_run(self, chatter) -> bool:
+        return (
+            self.active < service_config.max_transfers
+            and self.by_chatter.get(chatter, 0)
+            < service_config.max_transfers_per_chatter
+        )
+
+    def _start(self, xfer: Transfer):
+        self.active += 1
+        self.by_chatter[xfer.chatter] = self.by_chatter.get(xfer.chatter, 0) + 1
+        xfer.finish = self.vtime
+        service_stats["transfers_admitted"] += 1
+
+    async def admit(self, xfer: Transfer):
+        fut = asyncio.get_running_loop().create_future()
+        entry = (xfer, fut)
+        self.waiting.append(entry)
+        self._wake()
+        if fut.done():
+            return  # admitted right away
+        service_stats["transfers_queued"] += 1
+        queued_since = time.monotonic()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(xfer)  # admitted meanwhile
+            else:
+                self.waiting.remove(entry)
+                self._wake()  # those behind may be admissible now
+            raise
+        service_stats["transfer_queued_ms"] += int(
+            1000 * (time.monotonic() - queued_since)
+        )
+
+    def release(self, xfer: Transfer):
+        self.active -= 1
+        n = self.by_chatter[xfer.chatter] - 1
+        if n > 0:
+            self.by_chatter[xfer.chatter] = n
+        else:
+            del self.by_chatter[xfer.chatter]
+        self._wake()
+
+    def _wake(self):
+        # admit waiting transfers in FIFO order, skipping those with their chatters at
+        # the limit, which stay in place
+        for entry in list(self.waiting):
+            if self.active >= service_config.max_transfers:
+                break
+            xfer, fut = entry
+            if fut.done():
+                continue  # cancelled, to be removed by its waiter
+            if not self._can_run(xfer.chatter):
+                continue
+            self.waiting.remove(entry)
+            self._start(xfer)
+            fut.set_result(None)
+
+    async def turn(self, xfer: Transfer, n_bytes: int):
+        """
+        Wait till a chunk of `n_bytes` of the transfer can go.
+
+        """
+        chat_idle = self.chat_idle.get(xfer.wire, None)
+        if chat_idle is not None:
+            # notifications sharing the wire go first, but bulk data is not to be
+            # starved by them
+            service_stats["transfer_chat_deferrals"] += 1
+            try:
+                await asyncio.wait_for(
+                    chat_idle.wait(), service_config.transfer_chat_defer
+                )
+            except asyncio.TimeoutError:
+                pass
+
+        xfer.finish = max(self.vtime, xfer.finish) + n_bytes / xfer.weight
+        fut = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.turns, (xfer.finish, self.seq, n_bytes, fut))
+        if self.granter is None:
+            self.granter = asyncio.create_task(self._grant_turns())
+        await fut
+
+    async def _grant_turns(self):
+        try:
+            while self.turns:
+                # let chunks of other transfers queue up, for the turn to go by tag
+                await asyncio.sleep(0)
+                finish, _, n_bytes, fut = heapq.heappop(self.turns)
+                if fut.done():
+                    continue  # the transfer is gone
+                self.vtime = finish
+                rate = service_config.transfer_rate
+                if rate > 0:
+                    now = time.monotonic()
+                    start = max(now, self.link_free)
+                    self.link_free = start + n_bytes / rate
+                    if start > now:
+                        await asyncio.sleep(start - now)
+                if not fut.done():
+                    fut.set_result(None)
+        finally:
+            self.granter = None
+
+    @contextmanager
+    def chat_writing(self, wire):
+        """
+        Have chunks of transfers over `wire` wait while writing a notification to it.
+
+        """
+        n = self.chatting.get(wire, 0)
+        if n <= 0:
+            self.chat_idle[wire] = asyncio.Event()
+        self.chatting[wire] = n + 1
+        try:
+            yield
+        finally:
+            n = self.chatting[wire] - 1
+            if n > 0:
+                self.chatting[wire] = n
+            else:
+                del self.chatting[wire]
+                self.chat_idle.pop(wire).set()
+
+
+transfer_scheduler = TransferScheduler()
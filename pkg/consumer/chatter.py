@@ -1,7 +1,11 @@
 import asyncio
+from datetime import datetime
 import math
+import mmap
 import os.path
 import random
+import re
+import secrets
 import stat
 import sys
 import time
@@ -10,9 +14,11 @@ from zlib import crc32
 
 import hbi
 
+from ..delta import *
 from ..ds import *
 from ..getline import *
 from ..log import *
+from ..xfer import *
 
 __all__ = ["Chatter"]
 
@@ -20,6 +26,53 @@ __all__ = ["Chatter"]
 logger = get_logger(__package__)
 
 
+# a partial file of a download is named `.<name>.<download-id>.down` while data is
+# being received into it, and `.<name>.<download-id>.part` once interrupted, to be
+# resumed by whichever download renames it first
+_DOWNLOAD_ID = re.compile(r"[0-9a-f]{16}")
+
+
+def _open_partial(room_dir: str, fn: str, resume: bool):
+    # open a partial file private to a new download, positioned at the end of data
+    # received by an interrupted download if resumed, return `(f, path)`
+    down_pth = os.path.join(room_dir, f".{fn}.{secrets.token_hex(8)}.down")
+    head, tail = f".{fn}.", ".part"
+    for name in os.listdir(room_dir) if resume else ():
+        if not name.startswith(head) or not name.endswith(tail):
+            continue
+        if not _DOWNLOAD_ID.fullmatch(name[len(head) : -len(tail)]):
+            continue
+        try:
+            os.rename(os.path.join(room_dir, name), down_pth)
+        except FileNotFoundError:
+            continue  # resumed by someone else
+        break
+    f = open(down_pth, "ab+")
+    f.seek(0, 2)
+    return f, down_pth
+
+
+def _close_partial(f, down_pth: str):
+    # close the partial file of an interrupted download, for it to be resumed
+    f.close()
+    os.replace(down_pth, down_pth[: -len(".down")] + ".part")
+
+
+def _open_ranges(ranges_pth: str, fsz: int):
+    # create the file for ranges of a download to be received into, return `(f, mm)`
+    f = open(ranges_pth, "wb+")
+    try:
+        # preallocate disk space, so writing to the mmap never fails with SIGBUS
+        try:
+            os.posix_fallocate(f.fileno(), 0, fsz)
+        except (AttributeError, OSError):
+            f.truncate(fsz)
+        return f, mmap.mmap(f.fileno(), fsz)
+    except BaseException:
+        f.close()
+        raise
+
+
 class Chatter:
     """
     Consumer side chatter object
@@ -32,20 +85,61 @@ class Chatter:
         "NickChanged",
         "InRoom",
         "RoomMsgs",
+        "RoomMsgsBin",
         "Said",
+        "NotSaid",
         "ChatterJoined",
         "ChatterLeft",
+        "PresenceDelta",
+        "DataConn",
+    ]
+
+    # optional protocol features supported, declared to the service on start
+    features = [
+        "presence-delta",
+        "msgs-bin",
+        "resumable",
+        "zlib",
+        "data-conn",
+        "not-said",
     ]
 
-    def __init__(self, line_getter: GetLine, po: hbi.PostingEnd, ho: hbi.HostingEnd):
+    # compression codecs of file data to use, in order of preference
+    codecs = ["zlib"]
+
+    # ranges of a file to download in parallel by default, more than the service's
+    # default of transfers per chatter would just wait for their turns there
+    n_ranges = 2
+
+    def __init__(
+        self,
+        line_getter: GetLine,
+        po: hbi.PostingEnd,
+        ho: hbi.HostingEnd,
+        service_addr: dict = None,
+    ):
         self.line_getter = line_getter
         self.po = po
         self.ho = ho
+        # where the service is, to dial a data connection to, if it offers one
+        self.service_addr = service_addr
+        # posting end of the data connection, file data goes through it once attached
+        self.data_po = None
 
         self.nick = "?"
         self.in_room = "?"
         self.sent_msgs = []
 
+        # lazy pager over history of the room being scrolled back
+        self.history_room = None
+        self.history_pages = None
+
+        # transfers cut by the chatting connection lost, as `(transfer, args)`, to be
+        # resumed once reconnected
+        self.interrupted = []
+        # set once the user ended chatting, no more to reconnect
+        self.ended = False
+
     async def _set_nick(self, nick: str):
 
         # showcase the classic request/response pattern of service invocation over HBI wire.
@@ -138,7 +232,7 @@ Say({msg_id!r}, {len(msg_buf)!r})
 
         print("\n".join(fnl))
 
-    async def _upload_file(self, room_id: str, fn: str):
+    async def _upload_file(self, room_id: str, fn: str, resume: bool = True):
         room_dir = os.path.abspath(f"chat-client-files/{room_id}")
         if not os.path.isdir(room_dir):
             print(f"Room dir not there: [{room_dir}]")
@@ -160,66 +254,111 @@ Say({msg_id!r}, {len(msg_buf)!r})
             total_kb = int(math.ceil(fsz / 1024))
             print(f" Start uploading {total_kb} KB data ...")
 
+            # the service stores file data by sha256, it needs no data sent if it has
+            # the same already
+            digest = (await run_io(sha256_upto, f.fileno(), fsz)).hexdigest()
+
             async with self.po.co() as co:  # request the upload with a posting conversation
 
                 # submit an upload request
                 await co.send_code(
                     rf"""
-UploadReq({room_id!r}, {fn!r}, {fsz!r})
+UploadReq({room_id!r}, {fn!r}, {fsz!r}, {digest!r})
 """
                 )
 
                 # transit the conversation to `recv` stage a.s.a.p.
                 await co.start_recv()
 
-                # receive upload confirmation
-                refuse_reason = await co.recv_obj()
+                # receive upload confirmation, a resumable service tells how much has
+                # been received by an interrupted upload as well
+                reply = await co.recv_obj()
+                codecs, upload_id = [], None
+                if isinstance(reply, list):
+                    refuse_reason, offset, peer_chksum, *more = reply
+                    if more:  # and codecs the service supports
+                        codecs = more[0]
+                    if len(more) > 1:  # and the id of this upload
+                        upload_id = more[1]
+                else:
+                    refuse_reason, offset, peer_chksum = reply, 0, 0
                 if refuse_reason is not None:
                     print(f"Server refused the upload: {refuse_reason}")
                     return
 
                 # upload accepted
 
-            # prepare to send file data from beginning, calculate checksum by the way
-            f.seek(0, 0)
-            chksum = 0
-
-            def stream_file_data():  # a generator function is ideal for binary data streaming
-                nonlocal chksum  # this is needed outer side, write to that var
-
-                # nothing prevents the file from growing as we're sending, we only send
-                # as much as glanced above, so count remaining bytes down,
-                # send one 1-KB-chunk at max at a time.
-                bytes_remain = fsz
-                while bytes_remain > 0:
-                    remain_kb = int(math.ceil(bytes_remain / 1024))
-                    print(  # overwrite line above prompt
-                        f"\x1B[1A\r\x1B[0K {remain_kb:12d} of {total_kb:12d} KB remaining ..."
-                    )
-
-                    chunk = f.read(min(1024, bytes_remain))
-                    assert len(chunk) > 0, "file shrunk !?!"
-
-                    yield chunk  # yield it so as to be streamed to server
-
-                    bytes_remain -= len(chunk)
-                    chksum = crc32(chunk, chksum)  # update chksum
-
-                assert bytes_remain == 0, "?!"
+            if offset == fsz:
+                # all data there already
+                print(  # overwrite line above
+                    f"\x1B[1A\r\x1B[0K All {total_kb} KB there already, none sent."
+                )
+                print(
+                    rf"""
+@@ uploaded {peer_chksum:x} [{fn}]
+"""
+                )
+                return
 
-                # overwrite line above prompt
-                print(f"\x1B[1A\r\x1B[0K All {total_kb} KB sent out.")
+            chksum = 0
+            if offset > 0 and resume:
+                # resume only if the data received is still what we have
+                chksum = await run_io(crc_upto, f.fileno(), offset)
+                if chksum != peer_chksum:
+                    offset, chksum = 0, 0
+            else:
+                offset = 0
+            if offset > 0:
+                print(f" Resuming after {offset // 1024} KB uploaded ...")
+            elif resume and await self._upload_delta(room_id, fn, f, fsz, upload_id):
+                return  # a changed version uploaded as delta
+
+            # block sums for the service to check data against as it streams in
+            sums = await run_io(block_sums, f.fileno(), fsz, BLOCK_SIZE, False)
+
+            # compress file data if both sides support a codec, and it's not
+            # compressed already
+            codec = next((codec for codec in self.codecs if codec in codecs), None)
+            if codec is not None and not await run_io(
+                worth_compressing, fn, f.fileno(), fsz
+            ):
+                codec = None
+
+            # prepare to send file data from offset, calculate checksum by the way
+            f.seek(offset, 0)
+            fs = FileStream(f, fsz - offset, chksum=chksum)
+
+            def show_progress(bytes_remain):
+                remain_kb = int(math.ceil(bytes_remain / 1024))
+                print(  # overwrite line above prompt
+                    f"\x1B[1A\r\x1B[0K {remain_kb:12d} of {total_kb:12d} KB remaining ..."
+                )
 
-            async with self.po.co() as co:  # establish a posting conversation for uploading
+            async with self._file_po().co() as co:  # establish a posting conversation for uploading
 
                 # send out receiving-code followed by binary stream
                 await co.send_code(
                     rf"""
-RecvFile({room_id!r}, {fn!r}, {fsz!r})
+RecvFile({room_id!r}, {fn!r}, {fsz!r}, {offset!r}, {BLOCK_SIZE!r}, {sums!r}, {codec!r}, {upload_id!r})
 """
                 )
                 start_time = time.monotonic()
-                await co.send_data(stream_file_data())
+                # a generator is ideal for binary data streaming
+                if codec is None:
+                    await send_bufs(co, fs.send_chunks(show_progress))
+                else:
+                    await send_bufs(co, fs.send_frames(codec, show_progress))
+                assert fs.bytes_remain == 0, "?!"
+
+                # overwrite line above prompt
+                if codec is None:
+                    print(f"\x1B[1A\r\x1B[0K All {total_kb} KB sent out.")
+                else:
+                    wire_kb = int(math.ceil(fs.wire_bytes / 1024))
+                    print(
+                        f"\x1B[1A\r\x1B[0K All {total_kb} KB sent out, "
+                        f"{wire_kb} KB on the wire with {codec}."
+                    )
 
                 # transit the conversation to `recv` stage a.s.a.p.
                 await co.start_recv()
@@ -233,6 +372,110 @@ RecvFile({room_id!r}, {fn!r}, {fsz!r})
             f"\x1B[1A\r\x1B[0K All {total_kb} KB uploaded in {elapsed_seconds:0.2f} second(s)."
         )
         # validate chksum calculated at peer side as it had all data received
+        chksum = fs.chksum
+        if offset > 0 and peer_chksum != chksum:
+            print(f"Resumed upload failed, uploading from beginning ...")
+            await self._upload_file(room_id, fn, resume=False)
+        elif peer_chksum != chksum:
+            print(f"But checksum mismatch !?!")
+        else:
+            print(
+                rf"""
+@@ uploaded {chksum:x} [{fn}]
+"""
+            )
+
+    async def _upload_delta(
+        self, room_id: str, fn: str, f, fsz: int, upload_id: str = None
+    ) -> bool:
+        # upload a changed version of a file the service has, by blocks changed only,
+        # return False if it's not worth it, for the file to be uploaded as a whole
+
+        async with self.po.co() as co:  # start a posting conversation
+
+            # ask for block sums of the version the service has
+            await co.send_code(
+                rf"""
+BlockSums({room_id!r}, {fn!r})
+"""
+            )
+
+            # transit the conversation to `recv` stage a.s.a.p.
+            await co.start_recv()
+
+            manifest = await co.recv_obj()
+        if manifest is None:
+            return False  # no such file at the service
+        base_id, block_size, base_sums = manifest
+        base_fsz = base_id[1]
+
+        fd = f.fileno()
+        ops = await run_io(compute_delta, fd, fsz, block_size, base_sums)
+        # positions of literal data in the file
+        literals = []
+        pos = 0
+        for op in ops:
+            if op >= 0:
+                pos += min(block_size, base_fsz - op * block_size)
+            else:
+                literals.append((pos, -op))
+                pos -= op
+        assert pos == fsz, "?!"
+        literal_bytes = sum(n for _, n in literals)
+        if literal_bytes > fsz * 3 // 4:
+            return False  # changed too much
+
+        sums = await run_io(block_sums, fd, fsz, block_size, False)
+        chksum = await run_io(crc_upto, fd, fsz)
+
+        total_kb = int(math.ceil(fsz / 1024))
+        literal_kb = int(math.ceil(literal_bytes / 1024))
+        print(f" Uploading {literal_kb} KB changed of {total_kb} KB data ...")
+
+        async def literal_chunks():
+            bytes_remain = literal_bytes
+            for pos, n in literals:
+                end = pos + n
+                while pos < end:
+                    chunk = await run_io(os.pread, fd, min(CHUNK_MAX, end - pos), pos)
+                    assert len(chunk) > 0, "file shrunk !?!"
+
+                    yield chunk
+
+                    pos += len(chunk)
+                    bytes_remain -= len(chunk)
+                    remain_kb = int(math.ceil(bytes_remain / 1024))
+                    print(  # overwrite line above prompt
+                        f"\x1B[1A\r\x1B[0K {remain_kb:12d} of {literal_kb:12d} KB remaining ..."
+                    )
+
+        async with self._file_po().co() as co:  # establish a posting conversation for uploading
+
+            # send out receiving-code followed by literal data
+            await co.send_code(
+                rf"""
+RecvDelta({room_id!r}, {fn!r}, {fsz!r}, {base_id!r}, {block_size!r}, {ops!r}, {sums!r}, {upload_id!r})
+"""
+            )
+            start_time = time.monotonic()
+            await send_bufs(co, literal_chunks())
+
+            # transit the conversation to `recv` stage a.s.a.p.
+            await co.start_recv()
+
+            # receive the checksum calculated as peer rebuilt the file
+            peer_chksum = await co.recv_obj()
+
+        elapsed_seconds = time.monotonic() - start_time
+
+        if peer_chksum is None:
+            print(  # overwrite line above
+                f"\x1B[1A\r\x1B[0K The file changed at the service meanwhile."
+            )
+            return False
+        print(  # overwrite line above
+            f"\x1B[1A\r\x1B[0K {literal_kb} of {total_kb} KB uploaded in {elapsed_seconds:0.2f} second(s)."
+        )
         if peer_chksum != chksum:
             print(f"But checksum mismatch !?!")
         else:
@@ -241,101 +484,159 @@ RecvFile({room_id!r}, {fn!r}, {fsz!r})
 @@ uploaded {chksum:x} [{fn}]
 """
             )
+        return True
 
-    async def _list_server_files(self, room_id: str):
+    async def _list_server_files(
+        self,
+        room_id: str,
+        offset: int = 0,
+        sort: str = "name",
+        prefix: str = "",
+        limit: int = 20,
+    ):
 
         async with self.po.co() as co:  # start a posting conversation
 
-            # send the file listing request
+            # send the file listing request, for a page of files
             await co.send_code(
                 rf"""
-ListFiles({room_id!r})
+ListFiles({room_id!r}, {offset!r}, {limit!r}, {sort!r}, {prefix!r})
 """
             )
 
             # transit the conversation to `recv` stage a.s.a.p.
             await co.start_recv()
 
-            fil = await co.recv_obj()
+            n_files, fil = await co.recv_obj()
 
         # show received file info list
+        print(f"@@ {n_files} file(s), listing from #{offset + 1}:")
         print(
-            "\n".join(f"{int(math.ceil(fsz / 1024)):12d} KB\t{fn}" for fsz, fn in fil)
+            "\n".join(
+                f"{int(math.ceil(fsz / 1024)):12d} KB\t"
+                f"{datetime.fromtimestamp(mtime).strftime('%F %T')}\t"
+                f"{'' if chksum is None else format(chksum, 'x'):>8s}\t{fn}"
+                for fsz, fn, mtime, chksum in fil
+            )
         )
 
-    async def _download_file(self, room_id: str, fn: str):
+    async def _list_rooms(self, offset: int, limit: int = 20):
+
+        async with self.po.co() as co:  # start a posting conversation
+
+            # send the room listing request
+            await co.send_code(
+                rf"""
+ListRooms({offset!r}, {limit!r})
+"""
+            )
+
+            # transit the conversation to `recv` stage a.s.a.p.
+            await co.start_recv()
+
+            n_rooms, ril = await co.recv_obj()
+
+        # show received room info list
+        print(f"@@ {n_rooms} room(s) with chatters, listing from #{offset + 1}:")
+        print(
+            "\n".join(
+                f"{population:12d} chatter(s)\t#{room_id}"
+                for population, room_id in ril
+            )
+        )
+
+    async def _download_file(self, room_id: str, fn: str, resume: bool = True):
         room_dir = os.path.abspath(f"chat-client-files/{room_id}")
         if not os.path.isdir(room_dir):
             print(f"Making room dir [{room_dir}] ...")
             os.makedirs(room_dir, exist_ok=True)
 
-        async with self.po.co() as co:  # start a new posting conversation
-
-            # send out download request
-            await co.send_code(
-                rf"""
+        fpth = os.path.join(room_dir, fn)
+        # data is downloaded into a hidden partial file private to this download,
+        # renamed to the file once complete, an interrupted download is resumed from
+        # what's left in its partial file
+        f, part_pth = await run_io(_open_partial, room_dir, fn, resume)
+        offset = f.tell()
+
+        async with self._file_po().co() as co:  # start a new posting conversation
+
+            # send out download request, ranged from offset to resume, with a codec
+            # to compress data with, unless it's compressed already by its format, the
+            # service uses it if supported
+            if self.codecs and worth_compressing(fn):
+                await co.send_code(
+                    rf"""
+SendFile({room_id!r}, {fn!r}, {offset!r}, codec={self.codecs[0]!r})
+"""
+                )
+            else:
+                await co.send_code(
+                    rf"""
+SendFile({room_id!r}, {fn!r}, {offset!r})
+"""
+                    if offset > 0
+                    else rf"""
 SendFile({room_id!r}, {fn!r})
 """
-            )
+                )
 
             # transit the conversation to `recv` stage a.s.a.p.
             await co.start_recv()
 
-            fsz, msg = await co.recv_obj()
+            fsz, msg, *rest = await co.recv_obj()
+            codec = rest[1] if len(rest) > 1 else None
             if fsz < 0:
+                await run_io(_close_partial, f, part_pth)
                 print(f"Server refused file downlaod: {msg}")
                 return
 
             if msg is not None:
                 print(f"@@ Server: {msg}")
 
-            fpth = os.path.join(room_dir, fn)
-
-            # no truncate in case another spammer is racing to upload the same file.
-            # concurrent reading and writing to a same file is wrong in most but this spamming case.
-            f = os.fdopen(os.open(fpth, os.O_RDWR | os.O_CREAT), "rb+")
             try:
                 total_kb = int(math.ceil(fsz / 1024))
-                print(f" Start downloading {total_kb} KB data ...")
-
-                # prepare to recv file data from beginning, calculate checksum by the way
-                chksum = 0
-
-                def stream_file_data():  # a generator function is ideal for binary data streaming
-                    nonlocal chksum  # this is needed outer side, write to that var
-
-                    # receive 1 KB at most at a time
-                    buf = bytearray(1024)
-
-                    bytes_remain = fsz
-                    while bytes_remain > 0:
-
-                        if len(buf) > bytes_remain:
-                            buf = buf[:bytes_remain]
-
-                        yield buf  # yield it so as to be streamed from client
-
-                        f.write(buf)  # write received data to file
-
-                        bytes_remain -= len(buf)
+                if offset > 0:
+                    print(
+                        f" Resuming download of {total_kb} KB data "
+                        f"after {offset // 1024} KB ..."
+                    )
+                else:
+                    print(f" Start downloading {total_kb} KB data ...")
 
-                        chksum = crc32(buf, chksum)  # update chksum
+                # prepare to recv file data from offset, calculate checksum by the way
+                chksum = await run_io(crc_upto, f.fileno(), offset)
+                fs = FileStream(f, fsz, chksum=chksum)
 
-                        remain_kb = int(math.ceil(bytes_remain / 1024))
-                        print(  # overwrite line above prompt
-                            f"\x1B[1A\r\x1B[0K {remain_kb:12d} of {total_kb:12d} KB remaining ..."
-                        )
+                def show_progress(bytes_remain):
+                    remain_kb = int(math.ceil(bytes_remain / 1024))
+                    print(  # overwrite line above prompt
+                        f"\x1B[1A\r\x1B[0K {remain_kb:12d} of {total_kb:12d} KB remaining ..."
+                    )
 
-                    assert bytes_remain == 0, "?!"
+                # receive data stream from server, a generator is ideal for binary data
+                # streaming
+                start_time = time.monotonic()
+                if codec is None:
+                    await recv_bufs(co, fs.recv_chunks(show_progress))
+                else:
+                    await recv_bufs(co, fs.recv_frames(codec, show_progress))
+                assert fs.bytes_remain == 0, "?!"
 
-                    # overwrite line above prompt
+                # overwrite line above prompt
+                if codec is None:
                     print(f"\x1B[1A\r\x1B[0K All {total_kb} KB received.")
-
-                # receive data stream from server
-                start_time = time.monotonic()
-                await co.recv_data(stream_file_data())
-            finally:
-                f.close()
+                else:
+                    wire_kb = int(math.ceil(fs.wire_bytes / 1024))
+                    print(
+                        f"\x1B[1A\r\x1B[0K All {total_kb} KB received, "
+                        f"{wire_kb} KB on the wire with {codec}."
+                    )
+            except BaseException:
+                # left for the download to be resumed, this task may be being
+                # cancelled, not to be interrupted again
+                await asyncio.shield(run_io(_close_partial, f, part_pth))
+                raise
+            await run_io(f.close)
 
             peer_chksum = await co.recv_obj()
 
@@ -345,101 +646,461 @@ SendFile({room_id!r}, {fn!r})
             f"\x1B[1A\r\x1B[0K All {total_kb} KB downloaded in {elapsed_seconds:0.2f} second(s)."
         )
         # validate chksum calculated at peer side as it had all data sent
+        chksum = fs.chksum
         if peer_chksum != chksum:
+            await run_io(os.unlink, part_pth)
+        if offset > 0 and peer_chksum != chksum:
+            print(f"Resumed download failed, downloading from beginning ...")
+            await self._download_file(room_id, fn, resume=False)
+        elif peer_chksum != chksum:
             print(f"But checksum mismatch !?!")
         else:
+            await run_io(os.replace, part_pth, fpth)
             print(
                 rf"""
 @@ downloaded {chksum:x} [{fn}]
 """
             )
 
-    async def keep_chatting(self):
-        po = self.po
+    async def _download_range(
+        self,
+        room_id: str,
+        fn: str,
+        file_id: list,
+        start: int,
+        buf: memoryview,
+        progress,
+    ):
+        async with self._file_po().co() as co:  # start a new posting conversation per range
+
+            # request the range, with checksum of the range only
+            await co.send_code(
+                rf"""
+SendFile({room_id!r}, {fn!r}, {start!r}, {len(buf)!r}, {start!r})
+"""
+            )
 
-        disc_reason = None
-        try:
-            while po.is_connected():  # until disconnected from chat service
+            # transit the conversation to `recv` stage a.s.a.p.
+            await co.start_recv()
 
-                sl = await self.line_getter.get_line()
-                if sl is None:
-                    # User pressed Ctrl^D to end chatting.
-                    break
+            length, msg, *rest = await co.recv_obj()
+            if length < 0:
+                return None  # the file's gone
 
-                if len(sl.strip()) < 1:  # only white space(s) or just enter pressed
-                    continue
+            # the file may have changed meanwhile, data is still to be received, but
+            # thrown away
+            intact = length == len(buf) and len(rest) > 2 and list(rest[2]) == file_id
+            target = buf if intact else memoryview(bytearray(length))
 
-                if sl[0] == "#":
-                    # goto the specified room
-                    room_id = sl[1:].strip()
-                    await self._goto_room(room_id)
-                elif sl[0] == "$":
-                    # change nick
-                    nick = sl[1:].strip()
-                    await self._set_nick(nick)
-                elif sl[0] == ".":
-                    # list local files
-                    await self._list_local_files(self.in_room)
-                elif sl[0] == "^":
-                    # list server files
-                    await self._list_server_files(self.in_room)
-                elif sl[0] == ">":
-                    # upload file
-                    fn = sl[1:].strip()
-                    await self._upload_file(self.in_room, fn)
-                elif sl[0] == "<":
-                    # download file
-                    fn = sl[1:].strip()
-                    await self._download_file(self.in_room, fn)
-                elif sl[0] == "*":
-                    # spam the service for stress-test
-                    spec = sl[1:]
-                    await self._spam(spec)
-                elif sl[0] == "!":
-                    # dump stacktrace of all aio tasks
-                    hbi.dump_aio_task_stacks()
-                elif sl[0] == "?":
-                    # show usage
-                    print(
-                        rf"""
-Usage:
+            def range_chunks():
+                # receive straight into the mmap, in chunks for progress to be shown
+                for pos in range(0, length, CHUNK_MAX):
+                    chunk = target[pos : pos + CHUNK_MAX]
+                    yield chunk
+                    progress(len(chunk))
 
- # _room_
-    goto a room
+            await co.recv_data(range_chunks())
 
- $ _nick_
-    change nick
+            peer_chksum = await co.recv_obj()
 
- . 
-    list local files
+        if not intact:
+            return None
+        return peer_chksum, await run_io(crc32, buf)
 
- ^ 
-    list server files
+    async def _download_ranges(self, room_id: str, fn: str, n_ranges: int):
+        room_dir = os.path.abspath(f"chat-client-files/{room_id}")
+        if not os.path.isdir(room_dir):
+            print(f"Making room dir [{room_dir}] ...")
+            os.makedirs(room_dir, exist_ok=True)
 
- > _file-name_
-    upload a file
+        async with self._file_po().co() as co:  # start a new posting conversation
 
- < _file-name_
-    download a file
+            # request an empty range to get the file size
+            await co.send_code(
+                rf"""
+SendFile({room_id!r}, {fn!r}, 0, 0)
+"""
+            )
 
-! 
-    dump stacktraces of all asyncio tasks
+            # transit the conversation to `recv` stage a.s.a.p.
+            await co.start_recv()
 
-* [ _n_bots_=10 ] [ _n_rooms_=10 ] [ _n_msgs_=10 ] [ _n_files_=10 ] [ _file_max_kb_=1234 ] [ _file_min_kb_=2 ]
-    spam the service for stress-test
+            length, msg, *rest = await co.recv_obj()
+            if length < 0:
+                print(f"Server refused file downlaod: {msg}")
+                return
+            await co.recv_obj()  # checksum of no data
+        fsz = rest[0]
+        if len(rest) < 4:
+            # the service tells no version of the file, ranges can't be checked as
+            # of the same one
+            n_ranges = 1
+        else:
+            # the version of the file and its crc32, all ranges must be of it
+            file_id, file_chksum = list(rest[2]), rest[3]
 
-"""
+        # ranges of 1 MB at least, or it's not worth it
+        n_ranges = min(n_ranges, fsz // (1024 * 1024))
+        if n_ranges < 2:
+            await self._download_file(room_id, fn)
+            return
+
+        if msg is not None:
+            print(f"@@ Server: {msg}")
+
+        fpth = os.path.join(room_dir, fn)
+        # ranges are downloaded into a hidden file, renamed to the file once complete
+        ranges_pth = os.path.join(room_dir, f".{fn}.{secrets.token_hex(8)}.ranges")
+        f, mm = await run_io(_open_ranges, ranges_pth, fsz)
+        try:
+            try:
+                total_kb = int(math.ceil(fsz / 1024))
+                print(f" Start downloading {total_kb} KB data in {n_ranges} ranges ...")
+
+                bytes_remain = fsz
+
+                def show_progress(n_bytes):
+                    nonlocal bytes_remain
+                    bytes_remain -= n_bytes
+                    remain_kb = int(math.ceil(bytes_remain / 1024))
+                    print(  # overwrite line above prompt
+                        f"\x1B[1A\r\x1B[0K {remain_kb:12d} of {total_kb:12d} KB remaining ..."
                     )
+
+                range_size = -(-fsz // n_ranges)
+                bounds = [
+                    (start, min(fsz, start + range_size))
+                    for start in range(0, fsz, range_size)
+                ]
+                view = memoryview(mm)
+                start_time = time.monotonic()
+                # ranges are received over concurrent posting conversations
+                results = await asyncio.gather(
+                    *(
+                        self._download_range(
+                            room_id, fn, file_id, start, view[start:end], show_progress
+                        )
+                        for start, end in bounds
+                    )
+                )
+                elapsed_seconds = time.monotonic() - start_time
+                del view
+            finally:
+                try:
+                    mm.close()
+                except BufferError:
+                    pass  # chunks still referenced, leave it to gc
+        finally:
+            f.close()
+
+        print(  # overwrite line above
+            f"\x1B[1A\r\x1B[0K All {total_kb} KB downloaded in {elapsed_seconds:0.2f} second(s)."
+        )
+        if None in results:
+            await run_io(os.unlink, ranges_pth)
+            print(f"But the file changed meanwhile !?!")
+            return
+
+        # validate chksum of each range calculated at peer side as it had the data
+        # sent, and combine them into chksum of the whole file
+        chksum = 0
+        for (start, end), (peer_chksum, range_chksum) in zip(bounds, results):
+            if peer_chksum != range_chksum:
+                await run_io(os.unlink, ranges_pth)
+                print(f"But checksum mismatch of range [{start}, {end}) !?!")
+                return
+            chksum = crc32_combine(chksum, range_chksum, end - start)
+        if file_chksum is not None and chksum != file_chksum:
+            await run_io(os.unlink, ranges_pth)
+            print(f"But checksum mismatch of the whole file !?!")
+            return
+
+        await run_io(os.replace, ranges_pth, fpth)
+        print(
+            rf"""
+@@ downloaded {chksum:x} [{fn}]
+"""
+        )
+
+    async def _iter_history(self, room_id: str, page_size: int):
+
+        # showcase lazy streaming of a large result set, pages are pulled from the
+        # service one posting conversation each, only as the consumer asks for more.
+
+        before_seq = None  # None for the latest page
+        while True:
+            async with self.po.co() as co:
+                await co.send_code(
+                    rf"""
+HistoryBefore({room_id!r}, {before_seq!r}, {page_size!r})
+"""
+                )
+                await co.start_recv()
+                if "msgs-bin" in self.features:
+                    first_seq, n_bytes = await co.recv_obj()
+                    buf = bytearray(n_bytes)
+                    await co.recv_data(buf)
+                    room_msgs = MsgsInRoom.from_bin(buf)
                 else:
-                    msg = sl
-                    await self._say(msg)
+                    first_seq, room_msgs = await co.recv_obj()
+
+            if len(room_msgs.msgs) < 1:
+                return  # reached the very beginning
+            yield room_msgs
+            before_seq = first_seq
+
+    async def _scroll_back(self, room_id: str, page_size: int):
+        if self.history_room != room_id or self.history_pages is None:
+            self.history_room = room_id
+            self.history_pages = self._iter_history(room_id, page_size)
+
+        try:
+            room_msgs = await self.history_pages.__anext__()
+        except StopAsyncIteration:
+            print(f"@@ No earlier messages in #{room_id!s}")
+            self.history_pages = None
+            return
+
+        print(f" *** Earlier messages in #{room_id!s} ***")
+        print("\n".join(str(msg) for msg in room_msgs.msgs))
+
+    def _file_po(self) -> hbi.PostingEnd:
+        # file data goes through the data connection if attached, so it won't delay
+        # chatting, or falls back to the chatting connection
+        data_po = self.data_po
+        if data_po is not None and data_po.is_connected():
+            return data_po
+        return self.po
+
+    async def _file_transfer(self, transfer, *args):
+        # run an upload or download, resumed if a connection is lost meanwhile: again
+        # over the chatting connection if the data connection dropped, or once
+        # reconnected if the chatting connection did
+        data_po = self.data_po
+        if data_po is not None and not data_po.is_connected():
+            data_po = None
+        try:
+            try:
+                return await transfer(*args)
+            except Exception as exc:
+                if (
+                    data_po is None
+                    or data_po.is_connected()
+                    or not self.po.is_connected()
+                ):
+                    raise
+                logger.warning(f"Data connection lost: {exc!s}")
+                if self.data_po is data_po:
+                    self.data_po = None
+            print(f"@@ Data connection lost, retrying over the chatting connection ...")
+            return await transfer(*args)
+        except Exception as exc:
+            if self.po.is_connected():
+                raise
+            logger.warning(f"Connection lost: {exc!s}")
+            self.interrupted.append((transfer, args))
+            print(
+                f"@@ Connection lost, the transfer is to be resumed once reconnected."
+            )
+
+    def reconnected(self, po: hbi.PostingEnd, ho: hbi.HostingEnd):
+        """
+        Continue the session over a new connection to the service, the previous one
+        lost, with interrupted transfers resumed.
+
+        """
+        nick, room_id = self.nick, self.in_room
+        self.po, self.ho = po, ho
+        self.data_po = None
+        self.history_pages = None
+        asyncio.create_task(self._resume_session(nick, room_id))
+
+    async def _resume_session(self, nick: str, room_id: str):
+        try:
+            await self._declare_features()
+            # the service sees a new chatter, take the nick and room back
+            await self._set_nick(nick)
+            await self._goto_room(room_id)
+
+            interrupted, self.interrupted = self.interrupted, []
+            for transfer, args in interrupted:
+                print(f"@@ Resuming an interrupted transfer ...")
+                await self._file_transfer(transfer, *args)
+        except Exception:
+            logger.error(f"Failure in resuming the session.", exc_info=True)
+
+    async def _declare_features(self):
+        # declare optional protocol features, by the fire-and-forget idiom
+        await self.po.notif(
+            rf"""
+Features({self.features!r})
+"""
+        )
+
+    async def _open_data_conn(self, token: str, port: int):
+        he = hbi.HostingEnv()
+        # objects sent back are plain values
+        hbi.expose_interop_values(he)
+        try:
+            data_po, data_ho = await hbi.dial_tcp(
+                {"host": self.service_addr["host"], "port": port}, he
+            )
+        except OSError as exc:
+            logger.warning(f"No data connection to port {port!r}: {exc!s}")
+            return
+
+        # attach it to this chatter by the fire-and-forget idiom, conversations
+        # following are landed after it
+        await data_po.notif(
+            rf"""
+AttachData({token!r})
+"""
+        )
+        self.data_po = data_po
+
+    async def keep_chatting(self):
+        disc_reason = None
+        try:
+            await self._declare_features()
+
+            while True:  # until ended, across reconnections to chat service
+
+                sl = await self.line_getter.get_line()
+                if sl is None:
+                    # User pressed Ctrl^D to end chatting.
+                    break
+
+                if len(sl.strip()) < 1:  # only white space(s) or just enter pressed
+                    continue
+
+                if not self.po.is_connected():
+                    print(f"@@ Not connected to chat service, reconnecting ...")
+                    continue
+
+                try:
+                    if sl[0] == "#":
+                        # goto the specified room
+                        room_id = sl[1:].strip()
+                        await self._goto_room(room_id)
+                    elif sl[0] == "$":
+                        # change nick
+                        nick = sl[1:].strip()
+                        await self._set_nick(nick)
+                    elif sl[0] == ".":
+                        # list local files
+                        await self._list_local_files(self.in_room)
+                    elif sl[0] == "^":
+                        # list server files, a page from offset, optionally sorted and
+                        # filtered by name prefix
+                        offset, sort, prefix = 0, "name", ""
+                        for arg in sl[1:].split():
+                            if arg.isdigit():
+                                offset = int(arg)
+                            elif arg.lstrip("-") in ("name", "size", "mtime"):
+                                sort = arg
+                            else:
+                                prefix = arg
+                        await self._list_server_files(
+                            self.in_room, offset, sort, prefix
+                        )
+                    elif sl[0] == ">":
+                        # upload file
+                        fn = sl[1:].strip()
+                        await self._file_transfer(self._upload_file, self.in_room, fn)
+                    elif sl[:2] == "<<":
+                        # download file by ranges in parallel
+                        spec = sl[2:].split(None, 1)
+                        if len(spec) > 1 and spec[0].isdigit():
+                            n_ranges, fn = int(spec[0]), spec[1].strip()
+                        else:
+                            n_ranges, fn = self.n_ranges, sl[2:].strip()
+                        await self._file_transfer(
+                            self._download_ranges, self.in_room, fn, n_ranges
+                        )
+                    elif sl[0] == "<":
+                        # download file
+                        fn = sl[1:].strip()
+                        await self._file_transfer(self._download_file, self.in_room, fn)
+                    elif sl[0] == "@":
+                        # list rooms by population
+                        arg = sl[1:].strip() or "0"
+                        if not arg.isdigit():
+                            print(f"@@ Not an offset: {arg}")
+                            continue
+                        await self._list_rooms(int(arg))
+                    elif sl[0] == "[":
+                        # scroll back history of current room
+                        arg = sl[1:].strip() or "10"
+                        if not arg.isdigit() or int(arg) < 1:
+                            print(f"@@ Not a page size: {arg}")
+                            continue
+                        await self._scroll_back(self.in_room, int(arg))
+                    elif sl[0] == "*":
+                        # spam the service for stress-test
+                        spec = sl[1:]
+                        await self._spam(spec)
+                    elif sl[0] == "!":
+                        # dump stacktrace of all aio tasks
+                        hbi.dump_aio_task_stacks()
+                    elif sl[0] == "?":
+                        # show usage
+                        print(
+                            rf"""
+    Usage:
+
+     # _room_
+        goto a room
+
+     $ _nick_
+        change nick
+
+     . 
+        list local files
+
+     ^ [ _offset_=0 ] [ [-]name | [-]size | [-]mtime ] [ _name-prefix_ ]
+        list server files, a page each time
+
+     > _file-name_
+        upload a file
+
+     < _file-name_
+        download a file
+
+     << [ _n_ranges_=2 ] _file-name_
+        download a file by ranges in parallel
+
+     @ [ _offset_=0 ]
+        list rooms with chatters, most populated first
+
+     [ [ _n_msgs_=10 ]
+        scroll back history of current room, a page each time
+
+    ! 
+        dump stacktraces of all asyncio tasks
+
+    * [ _n_bots_=10 ] [ _n_rooms_=10 ] [ _n_msgs_=10 ] [ _n_files_=10 ] [ _file_max_kb_=1234 ] [ _file_min_kb_=2 ]
+        spam the service for stress-test
+
+    """
+                        )
+                    else:
+                        msg = sl
+                        await self._say(msg)
+                except Exception:
+                    if self.po.is_connected():
+                        raise
+                    logger.warning(f"Connection lost: {sl!r}", exc_info=True)
+                    print(f"@@ Connection lost, reconnecting ...")
 
         except Exception:
             logger.error(f"Failure in chatting.", exc_info=True)
             disc_reason = traceback.print_exc()
 
-        if po.is_connected():
-            await po.disconnect(disc_reason)
+        self.ended = True
+        if self.data_po is not None and self.data_po.is_connected():
+            await self.data_po.disconnect()
+        if self.po.is_connected():
+            await self.po.disconnect(disc_reason)
 
         print("Bye.")
 
@@ -566,6 +1227,12 @@ Spammed with {n_bots} bots in up to {n_rooms} rooms,
             self.line_getter.show(f" *** Messages from #{room_msgs.room_id!s} ***")
         self.line_getter.show("\n".join(str(msg) for msg in room_msgs.msgs))
 
+    async def RoomMsgsBin(self, n_bytes: int):
+        # a batch of room msgs binary encoded, decoded in bulk as received
+        buf = bytearray(n_bytes)
+        await self.ho.co().recv_data(buf)
+        self.RoomMsgs(MsgsInRoom.from_bin(buf))
+
     def Said(self, msg_id: int):
         msg = self.sent_msgs[msg_id]
         self.line_getter.show(
@@ -573,6 +1240,11 @@ Spammed with {n_bots} bots in up to {n_rooms} rooms,
         )
         self.sent_msgs[msg_id] = None
 
+    def NotSaid(self, msg_id: int, reason: str):
+        # the msg is not posted, free its slot all the same
+        self.line_getter.show(reason)
+        self.sent_msgs[msg_id] = None
+
     def ShowNotice(self, text: str):
         self.line_getter.show(text)
 
@@ -581,3 +1253,17 @@ Spammed with {n_bots} bots in up to {n_rooms} rooms,
 
     def ChatterLeft(self, nick: str, room_id: str):
         self.line_getter.show(f"@@ {nick!s} has left #{room_id!s}")
+
+    def PresenceDelta(self, room_id: str, joined: list, left: list):
+        lines = []
+        if joined:
+            lines.append(f"@@ {', '.join(joined)!s} joined #{room_id!s}")
+        if left:
+            lines.append(f"@@ {', '.join(left)!s} left #{room_id!s}")
+        self.line_getter.show("\n".join(lines))
+
+    def DataConn(self, token: str, port: int):
+        # the service offers a data connection for file transfers
+        if self.service_addr is None or self.data_po is not None:
+            return
+        asyncio.create_task(self._open_data_conn(token, port))
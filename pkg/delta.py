@@ -0,0 +1,265 @@
+"""
+Block checksums and delta encoding of file data, rsync style, shared by the service
+and consumers.
+
+A file is cut into blocks of `block_size`, each summed with a weak checksum that can
+be rolled along the data byte by byte (adler32), and a strong one (blake2b). Given
+sums of the blocks of an old version, a new version is encoded as a list of ops:
+an op `i >= 0` copies block `i` of the old version, and an op `-n` is `n` bytes of
+literal data, to be sent along. So a changed file is re-uploaded with only the
+changed blocks sent.
+
+"""
+import asyncio
+import hashlib
+import mmap
+import os
+from zlib import adler32, crc32
+
+from .xfer import *
+
+__all__ = [
+    "BLOCK_SIZE",
+    "strong_sum",
+    "block_sums",
+    "compute_delta",
+    "BlockVerifier",
+    "DeltaStream",
+]
+
+# default size of blocks to checksum files by
+BLOCK_SIZE = 64 * 1024
+
+# max number of bytes to roll the weak checksum over, per delta computation, looking
+# for blocks moved to unaligned offsets, rolling is done byte by byte in Python
+ROLL_BUDGET = 4 * 1024 * 1024
+
+_ADLER_MOD = 65521
+
+
+def strong_sum(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def block_sums(fd: int, fsz: int, block_size: int = BLOCK_SIZE, weak: bool = True):
+    """
+    Sums of the blocks of a file, as a list of `(adler32, blake2b)`, or of `blake2b`
+    only if not `weak`, blocking, to be run by the I/O executor.
+
+    """
+    sums = []
+    for offset in range(0, fsz, block_size):
+        data = os.pread(fd, min(block_size, fsz - offset), offset)
+        assert len(data) > 0, "file shrunk !?!"
+        sums.append((adler32(data), strong_sum(data)) if weak else strong_sum(data))
+    return sums
+
+
+def _roll_to_match(data, pos: int, end: int, block_size: int, weak: int, table: dict):
+    # roll the weak checksum of the block at `pos` forward, up to `end`, return the
+    # offset where a block matches, or None
+    a, b = weak & 0xFFFF, weak >> 16
+    for q in range(pos + 1, end + 1):
+        out, in_ = data[q - 1], data[q + block_size - 1]
+        a = (a - out + in_) % _ADLER_MOD
+        b = (b - block_size * out + a - 1) % _ADLER_MOD
+        strongs = table.get((b << 16) | a, None)
+        if strongs is not None and strong_sum(data[q : q + block_size]) in strongs:
+            return q
+    return None
+
+
+def compute_delta(fd: int, fsz: int, block_size: int, sums: list) -> list:
+    """
+    Encode a file of `fsz` bytes as ops against an old version with block `sums`, see
+    the module doc, blocking, to be run by the I/O executor.
+
+    Blocks are matched at aligned offsets first, then looked for at unaligned offsets
+    by rolling the weak checksum, up to `ROLL_BUDGET` bytes, so moved blocks are still
+    found after insertions or deletions.
+
+    """
+    table = {}  # adler32 -> {blake2b: block index}
+    for i, (weak, strong) in enumerate(sums):
+        table.setdefault(weak, {}).setdefault(strong, i)
+
+    ops = []
+    lit_start = 0
+
+    def literal_till(end: int):
+        if end <= lit_start:
+            return
+        if ops and ops[-1] < 0:
+            ops[-1] -= end - lit_start
+        else:
+            ops.append(lit_start - end)
+
+    if fsz <= 0:
+        return ops
+    data = mmap.mmap(fd, fsz, access=mmap.ACCESS_READ)
+    try:
+        pos = 0
+        roll_budget = ROLL_BUDGET
+        while pos < fsz:
+            n = min(block_size, fsz - pos)
+            block = data[pos : pos + n]
+            weak = adler32(block)
+            strongs = table.get(weak, None)
+            if strongs is not None:
+                i = strongs.get(strong_sum(block), None)
+                if i is not None:
+                    literal_till(pos)
+                    ops.append(i)
+                    pos += n
+                    lit_start = pos
+                    continue
+
+            if n == block_size and roll_budget > 0:
+                end = min(pos + block_size, fsz - block_size)
+                q = _roll_to_match(data, pos, end, block_size, weak, table)
+                if q is not None:
+                    roll_budget -= q - pos
+                    pos = q  # to be matched as aligned
+                    continue
+                roll_budget -= end - pos
+            pos += n  # the block goes as literal data
+        literal_till(fsz)
+    finally:
+        data.close()
+    return ops
+
+
+class BlockVerifier:
+    """
+    A `hashlib` like object, fed with data of a file from `start`, checking strong
+    sums of its blocks by the way, and feeding a whole file `hasher` as well
+
+    `ValueError` is raised as soon as a block mismatches, so a corrupted transfer is
+    aborted early. `verified` is where the data checks up to, with `verified_chksum`
+    the crc32 of data before it, given `chksum` as crc32 of data before `start`.
+
+    """
+
+    def __init__(
+        self,
+        block_size: int,
+        sums: list,
+        hasher,
+        start: int = 0,
+        chksum: int = 0,
+    ):
+        self.block_size = block_size
+        self.sums = sums
+        self.hasher = hasher
+        self.pos = start
+        self.verified = start
+        self.verified_chksum = chksum
+        self.chksum = chksum
+        self.ended = False
+        # the block `start` falls into can't be checked unless `start` is aligned
+        self.block_hasher = (
+            hashlib.blake2b(digest_size=16) if start % block_size == 0 else None
+        )
+
+    def update(self, data):
+        self.hasher.update(data)
+        data = memoryview(data)
+        while len(data) > 0:
+            boundary = (self.pos // self.block_size + 1) * self.block_size
+            piece = data[: boundary - self.pos]
+            data = data[len(piece) :]
+            self.pos += len(piece)
+            self.chksum = crc32(piece, self.chksum)
+            if self.block_hasher is not None:
+                self.block_hasher.update(piece)
+            if self.pos < boundary:
+                break  # block incomplete, unless it's the last, see `digest()`
+            self._check_block(boundary)
+
+    def _check_block(self, end: int):
+        i = (end - 1) // self.block_size
+        if self.block_hasher is not None:
+            if i >= len(self.sums) or self.block_hasher.digest() != self.sums[i]:
+                raise ValueError(f"Block #{i} mismatch at offset {i * self.block_size}")
+            self.verified = end
+            self.verified_chksum = self.chksum
+        self.block_hasher = hashlib.blake2b(digest_size=16)
+
+    def digest(self):
+        if not self.ended:
+            self.ended = True
+            if self.pos % self.block_size != 0:
+                self._check_block(self.pos)  # the last block, shorter
+        return self.hasher.digest()
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+class DeltaStream:
+    """
+    A new version of a file to be streamed in as delta ops, written to `f`, with
+    blocks copied from the old version of the file opened as `base_fd`, and crc32 of
+    the data calculated by the way
+
+    With `base_fd` of None, the ops are consumed with literal data thrown away.
+
+    """
+
+    def __init__(self, f, base_fd, block_size: int, ops: list, hasher=None):
+        self.f = f
+        self.base_fd = base_fd
+        self.block_size = block_size
+        self.ops = ops
+        self.hasher = hasher
+        self.chksum = 0
+
+    def _write(self, data):
+        # run by the I/O executor
+        if self.base_fd is None:
+            return
+        self.f.write(data)
+        self.chksum = crc32(data, self.chksum)
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+    def _copy_block(self, i: int):
+        # run by the I/O executor
+        if self.base_fd is None:
+            return
+        data = os.pread(self.base_fd, self.block_size, i * self.block_size)
+        assert len(data) > 0, "base file shrunk !?!"
+        self._write(data)
+
+    def literal_bytes(self) -> int:
+        return -sum(op for op in self.ops if op < 0)
+
+    async def recv_chunks(self, progress=None):
+        # yield buffers for literal data to be filled from peer, by `recv_bufs()`
+        bytes_remain = self.literal_bytes()
+        buf = memoryview(bytearray(max(1, min(CHUNK_MAX, bytes_remain))))
+        writing = None
+        try:
+            for op in self.ops:
+                if op >= 0:
+                    # shielded, as the copy can't be cancelled once run
+                    writing = run_io(self._copy_block, op)
+                    await asyncio.shield(writing)
+                    continue
+                n = -op
+                while n > 0:
+                    chunk = buf[: min(len(buf), n)]
+
+                    yield chunk  # yield it so as to be filled from peer
+
+                    # shielded, as the write can't be cancelled once run
+                    writing = run_io(self._write, chunk)
+                    await asyncio.shield(writing)
+                    n -= len(chunk)
+                    bytes_remain -= len(chunk)
+                    if progress is not None:
+                        progress(bytes_remain)
+        finally:
+            # never leave the file to be closed under the I/O executor
+            if writing is not None and not writing.done():
+                await asyncio.wait([writing])
@@ -1,22 +1,74 @@
 import struct
+import sys
 import time
 from datetime import datetime
 
 __all__ = ["MsgsInRoom", "Msg"]
 
+# binary encoding of a batch of msgs, all integers little endian:
+#
+#   batch:  room_id_len u16 | n_msgs u32 | room_id | msg ...
+#   msg:    time f64 | nick_len u16 | content_len u32 | nick | content
+#
+# with strs utf-8 encoded, to be sent as binary data following a receiving-code
+_BATCH_HEAD = struct.Struct("<HI")
+_MSG_HEAD = struct.Struct("<dHI")
+
 
 class MsgsInRoom:
+    __slots__ = ("room_id", "msgs")
+
     def __init__(self, room_id, msgs):
         self.room_id = room_id
         self.msgs = msgs
 
     def __repr__(self):
-        return f"MsgsInRoom(({self.room_id!r}),({self.msgs!r}))"
+        return MsgsInRoom.repr_of(self.room_id, [repr(msg) for msg in self.msgs])
+
+    @staticmethod
+    def repr_of(room_id, msg_reprs):
+        # assemble the repr from reprs of the msgs, those can be encoded once and reused
+        return f"MsgsInRoom(({room_id!r}),([{', '.join(msg_reprs)}]))"
+
+    def to_bin(self) -> bytes:
+        return MsgsInRoom.bin_of(self.room_id, [msg.to_bin() for msg in self.msgs])
+
+    @staticmethod
+    def bin_of(room_id, msg_bins) -> bytes:
+        # assemble the binary encoding from those of the msgs, likewise reusable
+        return b"".join([MsgsInRoom.bin_head(room_id, len(msg_bins)), *msg_bins])
+
+    @staticmethod
+    def bin_head(room_id, n_msgs: int) -> bytes:
+        # leading bytes of the binary encoding, the msgs' follow
+        room_id = room_id.encode("utf-8")
+        return _BATCH_HEAD.pack(len(room_id), n_msgs) + room_id
+
+    @staticmethod
+    def from_bin(buf) -> "MsgsInRoom":
+        buf = memoryview(buf)
+        room_id_len, n_msgs = _BATCH_HEAD.unpack_from(buf, 0)
+        offset = _BATCH_HEAD.size
+        room_id = str(buf[offset : offset + room_id_len], "utf-8")
+        offset += room_id_len
+        msgs = []
+        for _ in range(n_msgs):
+            time_, nick_len, content_len = _MSG_HEAD.unpack_from(buf, offset)
+            offset += _MSG_HEAD.size
+            nick = str(buf[offset : offset + nick_len], "utf-8")
+            offset += nick_len
+            content = str(buf[offset : offset + content_len], "utf-8")
+            offset += content_len
+            msgs.append(Msg(nick, content, time_))
+        return MsgsInRoom(room_id, msgs)
 
 
 class Msg:
+    __slots__ = ("from_", "content", "time_")
+
     def __init__(self, from_, content, time_):
-        self.from_ = str(from_)
+        # nicks repeat a lot across msgs, share a single str object per nick
+        self.from_ = sys.intern(str(from_))
         self.content = str(content)
         if time_ is None:
             self.time_ = time.time()
@@ -27,6 +79,11 @@ class Msg:
         else:
             raise ValueError(f"Invalid time type: {type(time_)!s}")
 
+    def to_bin(self) -> bytes:
+        nick = self.from_[:0x3FFF].encode("utf-8")  # fits in u16 even all 4-byte chars
+        content = self.content.encode("utf-8")
+        return _MSG_HEAD.pack(self.time_, len(nick), len(content)) + nick + content
+
     def __repr__(self):
         return f"Msg(({self.from_!r}),({self.content!r}),({self.time_!r}))"
 
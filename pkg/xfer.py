@@ -0,0 +1,535 @@
+"""
+Streaming of file data over HBI, shared by the service and consumers.
+
+"""
+import asyncio
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zlib import crc32
+
+__all__ = [
+    "ChunkSizer",
+    "FileStream",
+    "CHUNK_INITIAL",
+    "CHUNK_MAX",
+    "CODECS",
+    "io_executor",
+    "run_io",
+    "crc_upto",
+    "crc32_combine",
+    "sha256_upto",
+    "frame_data",
+    "worth_compressing",
+    "send_bufs",
+    "recv_bufs",
+]
+
+# default chunk size to start a stream with, and to grow up to
+CHUNK_INITIAL = 64 * 1024
+CHUNK_MAX = 1024 * 1024
+
+# default number of threads doing blocking file I/O
+IO_THREADS = 4
+
+_io_executor = None
+
+_MADV_WILLNEED = getattr(mmap, "MADV_WILLNEED", None)
+
+# head of a frame of compressed file data, as (flag, payload size, raw data size),
+# with flag 1 for payload compressed, or 0 for raw data as is
+_FRAME_HEAD = struct.Struct("<BII")
+
+# a chunk is sent raw unless it compresses to this ratio at least
+_COMPRESS_RATIO = 0.9
+# after an incompressible chunk, up to this many chunks are sent raw without trying
+_RAW_SKIP_MAX = 32
+
+# extensions of files compressed already by their formats
+_COMPRESSED_EXTS = frozenset(
+    """
+    7z apk avi bz2 docx epub flac gif gz heic jar jpeg jpg lz4 lzma m4a mkv mov mp3
+    mp4 odt ogg opus png pptx rar tgz txz webm webp woff2 xlsx xz zip zst
+    """.split()
+)
+# number and size of pieces sampled from a file, to tell whether it compresses
+_SAMPLE_PIECES = 3
+_SAMPLE_SIZE = 16 * 1024
+
+
+def _zlib_decompress(data, raw_size: int) -> bytes:
+    # never inflate beyond the size told, against zlib bombs
+    d = zlib.decompressobj()
+    raw = d.decompress(data, raw_size)
+    if len(raw) != raw_size or d.unconsumed_tail or not d.eof:
+        raise ValueError("Corrupted zlib frame")
+    return raw
+
+
+# compression codecs of file data streams, by name, as `(compress, decompress)`,
+# `compress(chunk) -> bytes` and `decompress(payload, raw_size) -> bytes` are run by
+# the I/O executor, each chunk is compressed independently
+CODECS = {
+    "zlib": (lambda chunk: zlib.compress(chunk, 1), _zlib_decompress),
+}
+
+
+def io_executor(max_workers: int = None) -> ThreadPoolExecutor:
+    """
+    The thread pool doing blocking file I/O and checksumming, off the event loop.
+
+    It's created on first call, with `max_workers` threads if specified.
+
+    """
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(
+            max_workers or IO_THREADS, thread_name_prefix="FileIO"
+        )
+    return _io_executor
+
+
+def run_io(func, *args) -> asyncio.Future:
+    # get `func` called by the I/O executor right away, return the future of its result
+    return asyncio.get_running_loop().run_in_executor(io_executor(), func, *args)
+
+
+class ChunkSizer:
+    """
+    Adaptive chunk size of a data stream
+
+    Throughput is sampled over a few chunks at a time, the chunk size doubles as long
+    as that keeps improving, up to `max_size`, and halves back on a notable drop.
+
+    """
+
+    __slots__ = ("size", "min_size", "max_size", "best_rate", "sample_bytes", "stamp")
+
+    # seconds to sample throughput over
+    SAMPLE_SECS = 0.01
+
+    def __init__(self, initial: int = CHUNK_INITIAL, max_size: int = CHUNK_MAX):
+        self.max_size = max(1, max_size)
+        self.size = self.min_size = max(1, min(initial, self.max_size))
+        self.best_rate = 0.0
+        self.sample_bytes = 0
+        self.stamp = time.monotonic()
+
+    def update(self, n_bytes: int):
+        # account bytes just moved, adapt the size once a sample is complete
+        self.sample_bytes += n_bytes
+        now = time.monotonic()
+        elapsed = now - self.stamp
+        if elapsed < self.SAMPLE_SECS or self.sample_bytes < 2 * self.size:
+            return
+        rate = self.sample_bytes / elapsed
+        self.sample_bytes = 0
+        self.stamp = now
+
+        if rate > 1.05 * self.best_rate:
+            self.best_rate = rate
+            if self.size < self.max_size:
+                self.size = min(self.max_size, 2 * self.size)
+        elif rate < 0.5 * self.best_rate and self.size > self.min_size:
+            self.size = max(self.min_size, self.size // 2)
+            self.best_rate = rate
+
+
+def _chunks_upto(fd: int, end: int, start: int = 0):
+    offset = start
+    while offset < end:
+        chunk = os.pread(fd, min(CHUNK_MAX, end - offset), offset)
+        assert len(chunk) > 0, "file shrunk !?!"
+        yield chunk
+        offset += len(chunk)
+
+
+def crc_upto(fd: int, end: int, start: int = 0) -> int:
+    """
+    crc32 of file data in `[start, end)`, blocking, to be run by the I/O executor.
+
+    """
+    chksum = 0
+    for chunk in _chunks_upto(fd, end, start):
+        chksum = crc32(chunk, chksum)
+    return chksum
+
+
+def _gf2_times(mat: list, vec: int) -> int:
+    prod = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            prod ^= mat[i]
+        vec >>= 1
+        i += 1
+    return prod
+
+
+def _gf2_square(mat: list) -> list:
+    return [_gf2_times(mat, row) for row in mat]
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """
+    crc32 of 2 pieces of data concatenated, from crc32 of each, and length of the
+    latter, as `crc32_combine()` of zlib does, not exposed by Python's `zlib` module.
+
+    So ranges of a file can be checksummed separately, e.g. as they're transferred
+    in parallel, and still verified as a whole.
+
+    """
+    if len2 <= 0:
+        return crc1
+    # operator for 1 zero bit, then squared to operators for 2 and 4 zero bits
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    # apply len2 zero bytes to crc1
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+def sha256_upto(fd: int, end: int):
+    """
+    sha256 hash object fed with file data in `[0, end)`, blocking, to be run by the I/O
+    executor.
+
+    """
+    hasher = hashlib.sha256()
+    for chunk in _chunks_upto(fd, end):
+        hasher.update(chunk)
+    return hasher
+
+
+async def send_bufs(co, bufs, pace=None):
+    """
+    Send buffers from a sync or async iterable through the HBI conversation `co`, each
+    by a `send_data()` call of its own, after `await pace(n_bytes)` if given.
+
+    HBI pulls buffers from sync iterables only, a chunk generator doing async work in
+    between, e.g. reading ahead by the I/O executor, is driven from here instead.
+
+    """
+    if not hasattr(bufs, "__aiter__"):
+        if pace is None:
+            await co.send_data(bufs)
+            return
+        for buf in bufs:
+            await pace(len(buf))
+            await co.send_data(buf)
+        return
+    try:
+        async for buf in bufs:
+            if pace is not None:
+                await pace(len(buf))
+            await co.send_data(buf)
+    finally:
+        await bufs.aclose()
+
+
+async def recv_bufs(co, bufs, pace=None):
+    """
+    Fill buffers from a sync or async iterable through the HBI conversation `co`, each
+    by a `recv_data()` call of its own, after `await pace(n_bytes)` if given.
+
+    A buffer is filled before the next one is pulled, so a chunk generator may write a
+    buffer behind once it's resumed.
+
+    """
+    if not hasattr(bufs, "__aiter__"):
+        if pace is None:
+            await co.recv_data(bufs)
+            return
+        for buf in bufs:
+            await pace(len(buf))
+            await co.recv_data(buf)
+        return
+    try:
+        async for buf in bufs:
+            if pace is not None:
+                await pace(len(buf))
+            await co.recv_data(buf)
+    finally:
+        await bufs.aclose()
+
+
+def frame_data(data, codec: str, chunk_size: int = CHUNK_MAX) -> list:
+    """
+    Frames of data in memory, as streamed by `FileStream.send_frames()`, blocking, to be
+    run by the I/O executor. The frames are to be sent by `send_bufs()`.
+
+    """
+    compress = CODECS[codec][0]
+    frames = []
+    view = memoryview(data)
+    for pos in range(0, len(view), chunk_size):
+        chunk = view[pos : pos + chunk_size]
+        payload = compress(chunk)
+        if len(payload) > _COMPRESS_RATIO * len(chunk):
+            frames.append(_FRAME_HEAD.pack(0, len(chunk), len(chunk)))
+            frames.append(chunk)
+        else:
+            frames.append(_FRAME_HEAD.pack(1, len(payload), len(chunk)))
+            frames.append(payload)
+    return frames
+
+
+def worth_compressing(fn: str, fd: int = None, fsz: int = 0) -> bool:
+    """
+    Whether data of a file is worth streaming with a codec, by its name, and by
+    pieces sampled from its data if `fd` given, blocking then, to be run by the I/O
+    executor.
+
+    """
+    if fn.rpartition(".")[2].lower() in _COMPRESSED_EXTS:
+        return False
+    if fd is None or fsz <= 0:
+        return True
+    sample = bytearray()
+    step = max(_SAMPLE_SIZE, -(-fsz // _SAMPLE_PIECES))
+    for pos in range(0, fsz, step):
+        sample += os.pread(fd, _SAMPLE_SIZE, pos)
+    return len(zlib.compress(sample, 1)) <= _COMPRESS_RATIO * len(sample)
+
+
+class FileStream:
+    """
+    Data of a file to be streamed out or in, in adaptively sized chunks, with crc32 of
+    the data calculated by the way
+
+    `chksum` starts with the crc32 of data before the file's current position, so it
+    ends up covering all data up to where the stream ends, for resumed transfers. So
+    does `hasher`, a `hashlib` object to be fed with the data as well, if given.
+
+    The chunk generators are async, to be driven by `send_bufs()`/`recv_bufs()` over
+    HBI conversations, never passed to their `send_data()`/`recv_data()` directly.
+    The next chunk is read ahead by the I/O executor while one is on the wire, or the
+    last one written behind while the next is filled from the wire. Disk access
+    overlaps network transfer, and never blocks the event loop. `mapped_chunks()` is a
+    plain generator, the data being in memory.
+
+    Chunks to send are newly read `bytes` each, never modified afterwards, as the
+    transport may still hold a chunk after `send_data()` returns. Buffers to receive
+    into are `memoryview` slices of 2 buffers allocated per transfer, and reused, each
+    is to be filled before the next one is pulled, as `recv_bufs()` does, the data is
+    copied out by the write behind before its buffer is yielded again.
+
+    With a codec from `CODECS` negotiated, data is streamed as frames instead, each
+    a chunk compressed, or raw if it doesn't compress. Checksums are still of the
+    raw data, and `wire_bytes` counts bytes actually streamed.
+
+    Data streamed in is appended to `keep` as well, if given a `bytearray`.
+
+    """
+
+    def __init__(
+        self,
+        f,
+        fsz: int,
+        chunk_initial: int = CHUNK_INITIAL,
+        chunk_max: int = CHUNK_MAX,
+        chksum: int = 0,
+        hasher=None,
+        keep: bytearray = None,
+    ):
+        self.f = f
+        self.fsz = fsz
+        self.bytes_remain = fsz
+        self.chksum = chksum
+        self.hasher = hasher
+        self.keep = keep
+        self.sizer = ChunkSizer(chunk_initial, chunk_max)
+        self.wire_bytes = 0
+
+    def _alloc_bufs(self):
+        buf_size = max(1, min(self.fsz, self.sizer.max_size))
+        return memoryview(bytearray(buf_size)), memoryview(bytearray(buf_size))
+
+    def _read_chunk(self, n: int) -> bytes:
+        # run by the I/O executor
+        chunk = self.f.read(n)
+        assert len(chunk) > 0, "file shrunk !?!"
+        self.chksum = crc32(chunk, self.chksum)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        return chunk
+
+    def _write_chunk(self, chunk: memoryview):
+        # run by the I/O executor
+        self.f.write(chunk)
+        self.chksum = crc32(chunk, self.chksum)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        if self.keep is not None:
+            self.keep += chunk
+
+    async def send_chunks(self, progress=None):
+        # nothing prevents the file from growing as we're sending, we only send as much
+        # as told, so count remaining bytes down
+        if self.bytes_remain <= 0:
+            return
+        to_read = self.bytes_remain
+        reading = run_io(self._read_chunk, min(self.sizer.size, to_read))
+        try:
+            while self.bytes_remain > 0:
+                # shielded, as the read can't be cancelled once run
+                chunk = await asyncio.shield(reading)
+                n = len(chunk)
+                to_read -= n
+                if to_read > 0:  # read the next chunk ahead
+                    reading = run_io(self._read_chunk, min(self.sizer.size, to_read))
+
+                yield chunk  # yield it so as to be streamed to peer
+
+                self.bytes_remain -= n
+                self.sizer.update(n)
+                if progress is not None:
+                    progress(self.bytes_remain)
+        finally:
+            # never leave the file to be closed under the I/O executor
+            await asyncio.wait([reading])
+
+    def mapped_chunks(self):
+        """
+        Yield chunks as slices of the file mmap'ed, from its current position, nothing
+        allocated per chunk, and no crc32 calculated, the data is never touched here.
+
+        The kernel is advised to read the next chunk ahead, so page faults on the wire
+        rarely wait for disk.
+
+        """
+        if self.bytes_remain <= 0:
+            return
+        pos = self.f.tell()
+        end = pos + self.bytes_remain
+        mm = mmap.mmap(self.f.fileno(), end, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        try:
+            while self.bytes_remain > 0:
+                n = min(self.sizer.size, self.bytes_remain)
+                if _MADV_WILLNEED is not None and pos + n < end:
+                    ahead = pos + n - (pos + n) % mmap.PAGESIZE
+                    mm.madvise(_MADV_WILLNEED, ahead, min(end, pos + 2 * n) - ahead)
+                yield view[pos : pos + n]  # yield it so as to be streamed to peer
+                pos += n
+                self.bytes_remain -= n
+                self.sizer.update(n)
+        finally:
+            del view
+            try:
+                mm.close()
+            except BufferError:
+                pass  # chunks still referenced by the transport, leave it to gc
+
+    async def recv_chunks(self, progress=None):
+        if self.bytes_remain <= 0:
+            return
+        bufs = self._alloc_bufs()
+        i = 0
+        writing = None
+        try:
+            while self.bytes_remain > 0:
+                chunk = bufs[i][: min(self.sizer.size, self.bytes_remain)]
+
+                yield chunk  # yield it so as to be filled from peer
+
+                # the other buffer is to be filled next, after written behind, the
+                # write is shielded, as it can't be cancelled once run
+                if writing is not None:
+                    await asyncio.shield(writing)
+                writing = run_io(self._write_chunk, chunk)
+
+                self.bytes_remain -= len(chunk)
+                self.sizer.update(len(chunk))
+                if progress is not None:
+                    progress(self.bytes_remain)
+                i = 1 - i
+            await asyncio.shield(writing)
+        finally:
+            # never leave the file to be closed under the I/O executor
+            if writing is not None and not writing.done():
+                await asyncio.wait([writing])
+
+    async def send_frames(self, codec: str, progress=None):
+        compress = CODECS[codec][0]
+        skip = n_skip = 0
+        async for chunk in self.send_chunks(progress):
+            payload = None
+            if skip > 0:
+                skip -= 1  # likely incompressible still
+            else:
+                payload = await run_io(compress, chunk)
+                if len(payload) > _COMPRESS_RATIO * len(chunk):
+                    payload = None
+                    # skip trying more and more chunks, as long as they don't compress
+                    skip = n_skip = min(_RAW_SKIP_MAX, 2 * n_skip or 1)
+                else:
+                    n_skip = 0
+
+            if payload is None:
+                yield _FRAME_HEAD.pack(0, len(chunk), len(chunk))
+                yield chunk
+                self.wire_bytes += _FRAME_HEAD.size + len(chunk)
+            else:
+                yield _FRAME_HEAD.pack(1, len(payload), len(chunk))
+                yield payload
+                self.wire_bytes += _FRAME_HEAD.size + len(payload)
+
+    def _write_frame(self, flag: int, payload: memoryview, raw_size: int, decompress):
+        # run by the I/O executor
+        self._write_chunk(payload if flag == 0 else decompress(payload, raw_size))
+
+    async def recv_frames(self, codec: str, progress=None):
+        decompress = CODECS[codec][1]
+        head = bytearray(_FRAME_HEAD.size)
+        buf = bytearray(0)
+        writing = None
+        try:
+            while self.bytes_remain > 0:
+
+                yield head  # yield it so as to be filled from peer
+
+                flag, payload_size, raw_size = _FRAME_HEAD.unpack(head)
+                if (
+                    flag not in (0, 1)
+                    or not 0 < raw_size <= self.bytes_remain
+                    or not 0 < payload_size <= raw_size
+                    or (flag == 0 and payload_size != raw_size)
+                ):
+                    raise ValueError(
+                        f"Bad frame head {(flag, payload_size, raw_size)!r}"
+                    )
+                if len(buf) < payload_size:
+                    buf = bytearray(payload_size)
+                payload = memoryview(buf)[:payload_size]
+
+                yield payload  # yield it so as to be filled from peer
+
+                # shielded, as the write can't be cancelled once run
+                writing = run_io(self._write_frame, flag, payload, raw_size, decompress)
+                await asyncio.shield(writing)
+                self.wire_bytes += _FRAME_HEAD.size + payload_size
+                self.bytes_remain -= raw_size
+                if progress is not None:
+                    progress(self.bytes_remain)
+        finally:
+            # never leave the file to be closed under the I/O executor
+            if writing is not None and not writing.done():
+                await asyncio.wait([writing])